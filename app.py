@@ -8,8 +8,15 @@ from stratum.coin_rpc import CoinRPC
 from mining.block_template import BlockTemplate
 from mining.metric_generator import MetricGenerator
 from stratum.handler import ACPoolHandler
+from mining.supervisor import Supervisor, WorkerBlockUpdater
+from common.logger import get_logger
+from common.server import install_event_loop, create_server
 import signal
 import sys
+import os
+
+# Before any loop, lock or semaphore is created, ex: in CoinRPC
+install_event_loop()
 
 if len(sys.argv) <= 1:
     raise Exception('Coin name is not set.')
@@ -20,13 +27,29 @@ else:
     net_type = sys.argv[2]
 
 coin_name = sys.argv[1]
+logger = get_logger(__name__)
 
 
 def kill_handler(_signal, _frame):
-    db.disconnect_all_worker()
+    if supervisor is not None and worker_id is None:
+        # Template owner, workers flush their own shares
+        supervisor.stop_workers()
+    else:
+        db.share_writer.close(timeout=float(os.getenv("SHARE_FLUSH_TIMEOUT", 10)))
+        db.credit_pending_blocks()
+        if worker_id is not None:
+            # Pending connects are written before the template owner closes every worker row
+            db.worker_presence.close()
+        if Interfaces.stratum_handler is not None:
+            Interfaces.stratum_handler.pow_hash_executor.shutdown()
+
+    if worker_id is None:
+        db.disconnect_all_worker()
     sys.exit(0)
 
 
+supervisor = None
+worker_id = None
 signal.signal(signal.SIGTERM, kill_handler)
 signal.signal(signal.SIGINT, kill_handler)
 
@@ -37,21 +60,59 @@ if coin is None:
 elif coin.pool_address is None:
     raise Exception('Coin Pool Address is null.')
 
+# 0 runs everything in this process, N forks N Stratum workers and this process owns the block template
+stratum_workers = int(os.getenv("STRATUM_WORKERS", 0))
+if stratum_workers > 0:
+    db.before_fork()
+    supervisor = Supervisor(stratum_workers)
+    worker_id = supervisor.fork_workers()
+
+# Created after the fork, every process has its own loop of the installed policy
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
 Interfaces.set_coin_rpc(CoinRPC())
-Interfaces.set_block_template(BlockTemplate(coin.pool_address))
-Interfaces.set_stratum_handler(ACPoolHandler())
+# From here shutdown runs between callbacks, never in the middle of a database commit
+loop.add_signal_handler(signal.SIGTERM, kill_handler, signal.SIGTERM, None)
+loop.add_signal_handler(signal.SIGINT, kill_handler, signal.SIGINT, None)
+server = None
+
+if supervisor is None:
+    Interfaces.set_block_template(BlockTemplate(coin.pool_address))
+    Interfaces.set_stratum_handler(ACPoolHandler())
+
+    MetricGenerator(db)
 
-MetricGenerator(db)
+    loop.run_until_complete(Interfaces.block_updater.start())
+    coro = create_server(loop, StratumProtocol, coin.port)
+    server = loop.run_until_complete(coro)
+
+elif worker_id is None:
+    Interfaces.set_block_template(BlockTemplate(coin.pool_address))
+    Interfaces.set_stratum_handler(supervisor)
+
+    MetricGenerator(db)
+
+    loop.run_until_complete(supervisor.start_owner())
+    loop.run_until_complete(Interfaces.block_updater.start())
+
+else:
+    logger.info('Stratum worker %d, pid %d' % (worker_id, os.getpid()))
+    db.reset_after_fork()
+    Interfaces.job_manager.set_instance_id(worker_id)
+    # Jobs from the template owner are handled as soon as the pipe is read
+    Interfaces.set_stratum_handler(ACPoolHandler())
+    update_pipe = loop.run_until_complete(supervisor.start_worker())
+    Interfaces.block_updater = WorkerBlockUpdater(Interfaces.coin_rpc, update_pipe)
 
-loop = asyncio.get_event_loop()
-coro = loop.create_server(StratumProtocol, host='0.0.0.0', port=coin.port)
-server = loop.run_until_complete(coro)
+    coro = create_server(loop, StratumProtocol, coin.port, reuse_port=True)
+    server = loop.run_until_complete(coro)
 
 try:
     loop.run_forever()
 except KeyboardInterrupt:
     pass
 
-server.close()
-loop.run_until_complete(server.wait_closed())
+if server is not None:
+    server.close()
+    loop.run_until_complete(server.wait_closed())
 loop.close()
@@ -0,0 +1,67 @@
+# Duplicate share tracking, global set of hex string tuples vs per job set of 64 bit keys.
+# python -m benchmarks.bench_duplicate_shares [share_count]
+import binascii
+import os
+import sys
+import time
+import tracemalloc
+
+JOB_COUNT = 4
+
+
+def make_submits(share_count):
+    nonce_1 = [binascii.hexlify(os.urandom(4)) for _ in range(1000)]
+    return [(str(i % JOB_COUNT), nonce_1[i % 1000], binascii.hexlify(os.urandom(4)).decode(), binascii.hexlify(os.urandom(4)).decode(), '%08x' % (0x5c8a3f00 + i % 2))
+            for i in range(share_count)]
+
+
+def parse(value):
+    # Every submit is decoded from its own JSON line, so the hex strings are new objects
+    return str(value.encode(), 'ascii')
+
+
+def tuple_set(submits):
+    submits_set = set()
+    for _, nonce_1, nonce_2, nonce, n_time in submits:
+        submit = (nonce_1, parse(nonce_2), parse(nonce), parse(n_time))
+        if submit not in submits_set:
+            submits_set.add(submit)
+    return submits_set
+
+
+def packed_per_job(submits):
+    submits_by_job = {str(i): set() for i in range(JOB_COUNT)}
+    for job_id, nonce_1, nonce_2, nonce, n_time in submits:
+        job_submits = submits_by_job[job_id]
+        submit = hash(binascii.unhexlify(nonce_1) + binascii.unhexlify(parse(nonce_2)) + binascii.unhexlify(parse(nonce)) + binascii.unhexlify(parse(n_time)))
+        if submit not in job_submits:
+            job_submits.add(submit)
+    return submits_by_job
+
+
+def measure(func, submits):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = func(submits)
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+
+    started = time.perf_counter()
+    func(submits)
+    elapsed = time.perf_counter() - started
+    return memory, elapsed
+
+
+def main(share_count):
+    submits = make_submits(share_count)
+    scale = 1000000 / share_count
+
+    print('shares : %d (per million values are extrapolated)' % share_count)
+    for name, func in [('global tuple set', tuple_set), ('per job packed set', packed_per_job)]:
+        memory, elapsed = measure(func, submits)
+        print('%-20s : %8.1f MB per million shares, %6.0f ns per register' % (name, memory * scale / 1024 / 1024, elapsed / share_count * 1e9))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
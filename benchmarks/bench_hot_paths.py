@@ -0,0 +1,115 @@
+# Micro benchmarks of the hash_util and bitcoin_util helpers used by share validation and template updates.
+# python -m benchmarks.bench_hot_paths [--filter name] [--save file.json] [--compare file.json] [--threshold 0.1]
+# --compare exits with 1 when a case is slower than the saved run by more than threshold.
+import os
+os.environ.setdefault('COIN_TYPE', 'bitcoin')
+
+from common import hash_util, bitcoin_util
+from mining.job import Job
+from types import SimpleNamespace
+import argparse
+import binascii
+import simplejson
+import timeit
+import sys
+
+TX_COUNTS = [1, 10, 100, 1000, 5000]
+HEADER_SIZES = [80, 140]
+
+
+def random_hex(size):
+    return binascii.hexlify(os.urandom(size)).decode()
+
+
+def make_cases():
+    # name: (function, args), each case is timed as function(*args)
+    cases = {}
+    for size in HEADER_SIZES:
+        header = os.urandom(size)
+        cases['double_sha/%d' % size] = (hash_util.double_sha, (header,))
+        cases['reverse_bytes/%d' % size] = (hash_util.reverse_bytes, (header,))
+        cases['hex_to_reverse_hex/%d' % size] = (hash_util.hex_to_reverse_hex, (binascii.hexlify(header),))
+        cases['bytes_to_reverse_hash/%d' % size] = (hash_util.bytes_to_reverse_hash, (header,))
+
+    header_hash = os.urandom(32)
+    cases['hash_util.uint256_from_str/32'] = (hash_util.uint256_from_str, (header_hash,))
+    cases['bitcoin_util.uint256_from_str/32'] = (bitcoin_util.uint256_from_str, (header_hash,))
+    cases['ser_uint256/32'] = (bitcoin_util.ser_uint256, (int(random_hex(32), 16),))
+    cases['reverse_hash/32'] = (bitcoin_util.reverse_hash, (random_hex(32).encode(),))
+
+    for tx_count in TX_COUNTS:
+        tx_hashes = [random_hex(32) for _ in range(tx_count)]
+        serialized = [None] + [bitcoin_util.ser_uint256(int(h, 16)) for h in tx_hashes]
+        cases['merkle_root/%d' % tx_count] = (hash_util.merkle_root, (tx_hashes,))
+        cases['merkle_root_bytes/%d' % tx_count] = (hash_util.merkle_root_bytes, ([binascii.unhexlify(h)[::-1] for h in tx_hashes],))
+        cases['ser_uint256_list/%d' % tx_count] = (lambda hashes: [bitcoin_util.ser_uint256(int(h, 16)) for h in hashes], (tx_hashes,))
+        cases['MerkleTree/%d' % tx_count] = (lambda data: bitcoin_util.MerkleTree(list(data)), (serialized,))
+        tree = bitcoin_util.MerkleTree(list(serialized))
+        cases['MerkleTree.withFirst/%d' % tx_count] = (tree.withFirst, (header_hash,))
+
+    # Per share header of a submit, hex fields from the miner vs binary fields
+    job = make_job()
+    merkle_root = os.urandom(32)
+    cases['Job.serialize_block_header/80'] = (job.serialize_block_header, (b'5c8a3f00', b'12345678', binascii.hexlify(merkle_root)))
+    cases['Job.build_block_header/80'] = (job.build_block_header, (b'\x00\x3f\x8a\x5c', b'\x78\x56\x34\x12', merkle_root))
+    return cases
+
+
+def make_job():
+    block_template = SimpleNamespace(
+        version=0x20000000, prev_hash=random_hex(32), prev_hash_reverse_hex=random_hex(32), merkle_root_reverse_hex='',
+        n_bits='1d00ffff', n_bits_reverse_hex='ffff001d', curtime='5c8a3f00', difficulty=1.0, block_height=1, pool_reward=0,
+        tx_count=1, transactions=[], coinbase_tx=b'', coinbase_prefix=b'', coinbase_suffix=b'', merkle_branch=[],
+        merkle_tree=None, extranonce_placeholder=b'f000000ff111111f')
+    return Job('1', block_template)
+
+
+def measure(function, args, repeat=5):
+    timer = timeit.Timer(lambda: function(*args))
+    number, _ = timer.autorange()
+    # Best of repeat, the least disturbed run
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description='hash_util and bitcoin_util micro benchmarks')
+    parser.add_argument('--filter', default='', help='only cases containing this text')
+    parser.add_argument('--save', help='write the results to a json file')
+    parser.add_argument('--compare', help='compare with a json file written by --save')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = simplejson.load(f)
+
+    results = {}
+    regressions = []
+    for name, (function, function_args) in make_cases().items():
+        if args.filter not in name:
+            continue
+
+        seconds = measure(function, function_args)
+        results[name] = seconds
+
+        line = '%-36s %12.3f us' % (name, seconds * 1e6)
+        if name in baseline:
+            ratio = seconds / baseline[name]
+            line += '   %6.2fx of baseline' % ratio
+            if ratio > 1 + args.threshold:
+                line += '   REGRESSION'
+                regressions.append(name)
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            simplejson.dump(results, f, indent=2, sort_keys=True)
+
+    if regressions:
+        print('%d regressions : %s' % (len(regressions), ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
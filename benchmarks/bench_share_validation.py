@@ -0,0 +1,60 @@
+# Share validation merkle cost, full merkle_root over every transaction vs precomputed merkle branch.
+# python -m benchmarks.bench_share_validation [tx_count]
+from common import hash_util, bitcoin_util
+from common.hash_util import double_sha
+import binascii
+import os
+import sys
+import time
+
+EXTRANONCE_PLACEHOLDER = b'f000000ff111111f'
+
+
+def make_template(tx_count):
+    coinbase_tx = os.urandom(42) + binascii.unhexlify(EXTRANONCE_PLACEHOLDER) + os.urandom(120)
+    transactions = [{'hash': binascii.hexlify(os.urandom(32)).decode()} for _ in range(tx_count)]
+    return coinbase_tx, transactions
+
+
+def full_merkle_share(coinbase_tx, transactions, nonce_1, nonce_2):
+    coinbase = binascii.hexlify(coinbase_tx).split(EXTRANONCE_PLACEHOLDER)
+    serialized_coinbase = binascii.unhexlify(coinbase[0] + nonce_1 + nonce_2 + coinbase[1])
+    coinbase_hash = hash_util.bytes_to_reverse_hash(serialized_coinbase)
+    tx_hashes = [coinbase_hash] + [h['hash'] for h in transactions]
+    return hash_util.hex_to_reverse_hex(hash_util.merkle_root(tx_hashes))
+
+
+def merkle_branch_share(coinbase_prefix, coinbase_suffix, merkle_tree, nonce_1, nonce_2):
+    serialized_coinbase = coinbase_prefix + binascii.unhexlify(nonce_1 + nonce_2) + coinbase_suffix
+    return binascii.hexlify(merkle_tree.withFirst(double_sha(serialized_coinbase))).decode()
+
+
+def shares_per_sec(func, args_list):
+    started = time.perf_counter()
+    for args in args_list:
+        func(*args)
+    return len(args_list) / (time.perf_counter() - started)
+
+
+def main(tx_count):
+    coinbase_tx, transactions = make_template(tx_count)
+    coinbase_prefix, _, coinbase_suffix = coinbase_tx.partition(binascii.unhexlify(EXTRANONCE_PLACEHOLDER))
+    merkle_tree = bitcoin_util.MerkleTree([None] + [bitcoin_util.ser_uint256(int(t['hash'], 16)) for t in transactions])
+
+    nonces = [(binascii.hexlify(os.urandom(4)), binascii.hexlify(os.urandom(4))) for _ in range(200)]
+
+    for nonce_1, nonce_2 in nonces[:10]:
+        if full_merkle_share(coinbase_tx, transactions, nonce_1, nonce_2) != merkle_branch_share(coinbase_prefix, coinbase_suffix, merkle_tree, nonce_1, nonce_2):
+            raise Exception('merkle root mismatch')
+
+    old = shares_per_sec(full_merkle_share, [(coinbase_tx, transactions, n1, n2) for n1, n2 in nonces])
+    new = shares_per_sec(merkle_branch_share, [(coinbase_prefix, coinbase_suffix, merkle_tree, n1, n2) for n1, n2 in nonces * 50])
+
+    print('transactions : %d' % tx_count)
+    print('full merkle_root : %12.1f shares/sec' % old)
+    print('merkle branch    : %12.1f shares/sec' % new)
+    print('speed up         : %12.1fx' % (new / old))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
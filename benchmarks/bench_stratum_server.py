@@ -0,0 +1,161 @@
+# Stratum server event loop, default asyncio loop vs uvloop with the same socket tuning as StratumProtocol.
+# Reports connection accept rate and mining.notify fan-out latency to every simulated miner.
+# python -m benchmarks.bench_stratum_server [miners] [rounds]
+import os
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from common import server
+import multiprocessing
+import resource
+import asyncio
+import simplejson
+import socket
+import struct
+import time
+import sys
+
+NOTIFY_PARAMS = ['1f', '00' * 32, '01' * 60, '02' * 40, ['03' * 32] * 12, '20000000', '1d00ffff', '5c8a3f00', True]
+
+
+class BenchProtocol(asyncio.Protocol):
+    # Server side, only accepts, tunes and fans out, no share handling
+    def __init__(self, state):
+        self.state = state
+        self.transport = None
+        self._buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        server.tune_transport(transport)
+        state = self.state
+        now = time.perf_counter()
+        if state['first_accept'] is None:
+            state['first_accept'] = now
+        state['last_accept'] = now
+        state['connections'].append(self)
+
+    def data_received(self, data):
+        self._buffer += data
+        if b'\n' not in self._buffer:
+            return
+        command = bytes(self._buffer).strip()
+        self._buffer.clear()
+        if command == b'notify':
+            asyncio.ensure_future(fan_out(self.state, self))
+
+
+async def fan_out(state, control):
+    connections = state['connections']
+    for _ in range(state['rounds']):
+        message = simplejson.dumps({'id': None, 'method': 'mining.notify', 'params': NOTIFY_PARAMS + [time.time()]})
+        message = ('%s\n' % message).encode()
+        started = time.perf_counter()
+        for connection in connections:
+            connection.transport.write(message)
+        state['write_times'].append(time.perf_counter() - started)
+        await asyncio.sleep(0.5)
+
+    accept_time = state['last_accept'] - state['first_accept']
+    result = {'accept_rate': len(connections) / accept_time if accept_time > 0 else 0,
+              'write_time': max(state['write_times'])}
+    control.transport.write(('%s\n' % simplejson.dumps(result)).encode())
+
+
+def run_server(use_uvloop, port, rounds, ready):
+    os.environ['UVLOOP'] = 'true' if use_uvloop else 'false'
+    server.install_event_loop()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    state = {'connections': [], 'first_accept': None, 'last_accept': None, 'rounds': rounds, 'write_times': []}
+    loop.run_until_complete(server.create_server(loop, lambda: BenchProtocol(state), port))
+    ready.set()
+    loop.run_forever()
+
+
+class MinerProtocol(asyncio.Protocol):
+    def __init__(self, latencies):
+        self.latencies = latencies
+        self._buffer = bytearray()
+        self.transport = None
+        self.result = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        received = time.time()
+        self._buffer += data
+        while True:
+            end = self._buffer.find(b'\n')
+            if end == -1:
+                break
+            message = simplejson.loads(bytes(self._buffer[:end]))
+            del self._buffer[:end + 1]
+            if 'params' in message:
+                self.latencies.append(received - message['params'][-1])
+            else:
+                self.result = message
+
+
+async def run_miners(miners, rounds, port):
+    loop = asyncio.get_event_loop()
+    latencies = []
+    protocols = []
+    for start in range(0, miners, 500):
+        connections = [loop.create_connection(lambda: MinerProtocol(latencies), '127.0.0.1', port) for _ in range(start, min(start + 500, miners))]
+        protocols += [protocol for _, protocol in await asyncio.gather(*connections)]
+
+    for protocol in protocols:
+        # Short connection life time must not wait for the peer on close
+        protocol.transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+
+    control = protocols[0]
+    control.transport.write(b'notify\n')
+    while control.result is None:
+        await asyncio.sleep(0.1)
+
+    # Wait the last round to arrive everywhere
+    await asyncio.sleep(0.5)
+    for protocol in protocols:
+        protocol.transport.close()
+
+    latencies.sort()
+    return control.result, latencies, len(latencies) / rounds
+
+
+def bench(use_uvloop, miners, rounds, port):
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=run_server, args=(use_uvloop, port, rounds, ready))
+    process.start()
+    ready.wait()
+    try:
+        result, latencies, received = asyncio.run(run_miners(miners, rounds, port))
+    finally:
+        process.terminate()
+        process.join()
+
+    name = 'uvloop' if use_uvloop else 'asyncio'
+    print('%-8s: accept %8.0f conn/sec, notify write %7.1f ms, fan-out p50 %7.1f ms, p99 %7.1f ms, max %7.1f ms (%d/%d delivered)' % (
+        name, result['accept_rate'], result['write_time'] * 1000, latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000, received, miners))
+
+
+def main(miners, rounds):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if hard < miners + 100:
+        print('open file limit %d is lower than %d miners' % (hard, miners))
+        return
+
+    print('miners : %d, notify rounds : %d' % (miners, rounds))
+    bench(False, miners, rounds, 13331)
+    try:
+        import uvloop  # noqa: F401
+    except ImportError:
+        print('uvloop   : not installed')
+        return
+    bench(True, miners, rounds, 13332)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000, int(sys.argv[2]) if len(sys.argv) > 2 else 5)
@@ -0,0 +1,454 @@
+# Offline load test, runs app.py against a fake coin daemon and a sqlite database and simulates Stratum miners.
+# Miners submit a mix of valid, low difficulty, duplicate and stale shares and the pool is measured from outside.
+# python -m benchmarks.load_test --coin-type bitcoin --miners 1000 --rate 1 --duration 30
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+from hashlib import sha256
+import subprocess
+import threading
+import argparse
+import tempfile
+import binascii
+import asyncio
+import random
+import signal
+import base58
+import simplejson
+import time
+import sys
+import os
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from mining.models import Base, Coins, Shares  # noqa: E402
+
+POW_LIMITS = {
+    'bitcoin': 0x00000000ffff0000000000000000000000000000000000000000000000000000,
+    'zcash': 0x0007ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff,
+}
+SHARE_KINDS = ['valid', 'low', 'duplicate', 'stale']
+
+
+def double_sha(b):
+    return sha256(sha256(b).digest()).digest()
+
+
+def random_hex(size):
+    return binascii.hexlify(os.urandom(size)).decode()
+
+
+def make_address():
+    payload = b'\x00' + os.urandom(20)
+    return base58.b58encode(payload + double_sha(payload)[:4]).decode()
+
+
+class FakeCoinDaemon(object):
+    # JSON-RPC coin daemon in a thread, a new block every block_interval seconds, 0 only on new_block()
+    def __init__(self, port, tx_count, block_interval):
+        self.port = port
+        self.tx_count = tx_count
+        self.block_interval = block_interval
+        self.height = 1000
+        self.template = None
+        self.submitted_blocks = 0
+        self.longpoll_requests = 0
+        self.batch_support = True
+        self.changed = threading.Condition()
+        self.new_block()
+
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                request = simplejson.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if isinstance(request, list) and not daemon.batch_support:
+                    response = {'result': None, 'error': {'code': -32700, 'message': 'Parse error'}, 'id': None}
+                elif isinstance(request, list):
+                    response = [daemon.call(item) for item in request]
+                else:
+                    response = daemon.call(request)
+                body = simplejson.dumps(response).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        if self.block_interval > 0:
+            threading.Thread(target=self.rotate, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def rotate(self):
+        while True:
+            time.sleep(self.block_interval)
+            self.new_block()
+
+    def new_block(self):
+        self.height += 1
+        transactions = [{'hash': random_hex(32), 'data': random_hex(200), 'fee': 1000} for _ in range(self.tx_count)]
+        # A network difficulty no simulated share can reach
+        with self.changed:
+            self.template = {'version': 0x20000000, 'previousblockhash': random_hex(32), 'height': self.height, 'curtime': int(time.time()),
+                             'bits': '1d00ffff', 'target': '%064x' % (1 << 160), 'coinbasevalue': 5000000000, 'transactions': transactions,
+                             'longpollid': str(self.height)}
+            self.changed.notify_all()
+
+    def wait_template(self, params):
+        # A longpoll is held until the template has another longpollid, like bitcoind
+        longpollid = params[0].get('longpollid') if params and isinstance(params[0], dict) else None
+        if longpollid is None:
+            return self.template
+        self.longpoll_requests += 1
+        with self.changed:
+            self.changed.wait_for(lambda: self.template['longpollid'] != longpollid)
+            return self.template
+
+    def call(self, request):
+        method = request.get('method')
+        result = None
+        error = None
+        if method == 'getblocktemplate':
+            result = self.wait_template(request.get('params'))
+        elif method == 'getmininginfo':
+            result = {'blocks': self.height, 'difficulty': 1.0, 'networkhashps': 1000000}
+        elif method == 'validateaddress':
+            result = {'isvalid': True}
+        elif method == 'submitblock':
+            self.submitted_blocks += 1
+        else:
+            error = {'code': -32601, 'message': 'Method not found'}
+        return {'result': result, 'error': error, 'id': request.get('id')}
+
+
+class Stats(object):
+    def __init__(self):
+        self.latencies = {kind: [] for kind in SHARE_KINDS}
+        self.results = {kind: {} for kind in SHARE_KINDS}
+        self.notify_times = {}  # job_id: [first, last, count]
+        self.connected = 0
+        self.authorized = 0
+
+    def add_result(self, kind, latency, response):
+        self.latencies[kind].append(latency)
+        if response.get('result') is True:
+            outcome = 'accepted'
+        elif response.get('error'):
+            outcome = str(response['error'][1]).split(' of ')[0]
+        else:
+            outcome = 'rejected'
+        self.results[kind][outcome] = self.results[kind].get(outcome, 0) + 1
+
+    def add_notify(self, job_id):
+        now = time.perf_counter()
+        notify_time = self.notify_times.get(job_id)
+        if notify_time is None:
+            self.notify_times[job_id] = [now, now, 1]
+        else:
+            notify_time[1] = now
+            notify_time[2] += 1
+
+
+class Miner(asyncio.Protocol):
+    def __init__(self, index, args, stats):
+        self.index = index
+        self.args = args
+        self.stats = stats
+        self.transport = None
+        self._buffer = bytearray()
+        self.request_id = 0
+        self.pending = {}  # id: (kind, sent time)
+        self.extranonce1 = None
+        self.extranonce2 = 0
+        self.job = None
+        self.previous_job_id = None  # job of the previous block, stale after a clean notify
+        self.last_valid = None
+        self.worker_name = '%s.w%d' % (args.address, index)
+        self.pow_limit = POW_LIMITS[args.coin_type]
+        self.pool_diff = args.pool_diff
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.stats.connected += 1
+        self.send('mining.subscribe', ['load_test/0.1'], 'subscribe')
+
+    def send(self, method, params, kind):
+        self.request_id += 1
+        self.pending[self.request_id] = (kind, time.perf_counter())
+        self.transport.write(('%s\n' % simplejson.dumps({'id': self.request_id, 'method': method, 'params': params})).encode())
+
+    def data_received(self, data):
+        self._buffer += data
+        while True:
+            end = self._buffer.find(b'\n')
+            if end == -1:
+                break
+            message = simplejson.loads(bytes(self._buffer[:end]))
+            del self._buffer[:end + 1]
+            self.message_received(message)
+
+    def message_received(self, message):
+        method = message.get('method')
+        if method == 'mining.notify':
+            self.notify(message['params'])
+            return
+        elif method is not None:
+            return
+
+        kind, sent = self.pending.pop(message.get('id'), (None, None))
+        if kind == 'subscribe':
+            self.extranonce1 = message['result'][1]
+            self.send('mining.authorize', [self.worker_name, 'x'], 'authorize')
+        elif kind == 'authorize':
+            if message.get('result') is True:
+                self.stats.authorized += 1
+        elif kind in SHARE_KINDS:
+            self.stats.add_result(kind, time.perf_counter() - sent, message)
+
+    def notify(self, params):
+        self.stats.add_notify(params[0])
+        prevhash = params[1] if self.args.coin_type == 'bitcoin' else params[2]
+        if self.job is not None and self.job['prevhash'] != prevhash:
+            self.previous_job_id = self.job['job_id']
+
+        if self.args.coin_type == 'bitcoin':
+            job_id, prevhash, coinbase_1, coinbase_2, merkle_branch, version, n_bits, n_time = params[:8]
+            # prevhash comes in 4 byte words of reversed order, the header needs it byte reversed
+            prev_hash = ''.join([prevhash[56 - i:64 - i] for i in range(0, 64, 8)])
+            self.job = {'job_id': job_id, 'prevhash': prevhash, 'coinbase_1': coinbase_1, 'coinbase_2': coinbase_2,
+                        'merkle_branch': [binascii.unhexlify(b) for b in merkle_branch], 'n_time': n_time,
+                        'header_prefix': binascii.unhexlify(version)[::-1] + binascii.unhexlify(prev_hash)[::-1],
+                        'header_suffix': binascii.unhexlify(n_time)[::-1] + binascii.unhexlify(n_bits)[::-1]}
+        else:
+            job_id, version, prevhash, merkle_root, reserved, n_time, n_bits = params[:7]
+            self.job = {'job_id': job_id, 'prevhash': prevhash, 'n_time': n_time,
+                        'header': binascii.unhexlify(version + prevhash + merkle_root + reserved + n_time + n_bits)}
+
+    def share_diff(self, job, nonce_2, nonce):
+        if self.args.coin_type == 'bitcoin':
+            coinbase = binascii.unhexlify(job['coinbase_1'] + self.extranonce1 + nonce_2 + job['coinbase_2'])
+            merkle_root = double_sha(coinbase)
+            for branch in job['merkle_branch']:
+                merkle_root = double_sha(merkle_root + branch)
+            header_hash = double_sha(job['header_prefix'] + merkle_root + job['header_suffix'] + binascii.unhexlify(nonce)[::-1])
+        else:
+            header_hash = double_sha(job['header'] + binascii.unhexlify(self.extranonce1 + nonce_2) + binascii.unhexlify(nonce))
+        return self.pow_limit / int.from_bytes(header_hash, 'little')
+
+    def make_share(self, valid):
+        job = self.job
+        self.extranonce2 += 1
+        if self.args.coin_type == 'bitcoin':
+            nonce_2 = '%08x' % (self.extranonce2 & 0xffffffff)
+        else:
+            nonce_2 = '%0*x' % (64 - len(self.extranonce1), self.extranonce2)
+
+        # Grinds the nonce until the share is (or is not) above the pool difficulty
+        while True:
+            if self.args.coin_type == 'bitcoin':
+                nonce = random_hex(4)
+            else:
+                nonce = '00fd4005' + random_hex(1343)
+            if (self.share_diff(job, nonce_2, nonce) >= self.pool_diff) == valid:
+                break
+
+        if self.args.coin_type == 'bitcoin':
+            return [self.worker_name, job['job_id'], nonce_2, job['n_time'], nonce]
+        return [self.worker_name, job['job_id'], job['n_time'], nonce_2, nonce]
+
+    def submit(self, kind):
+        if kind == 'duplicate' and self.last_valid is None:
+            kind = 'valid'
+        if kind == 'stale' and self.previous_job_id is None:
+            kind = 'valid'
+
+        if kind == 'valid':
+            params = self.make_share(True)
+            self.last_valid = params
+        elif kind == 'low':
+            params = self.make_share(False)
+        elif kind == 'duplicate':
+            params = self.last_valid
+        else:
+            params = self.make_share(True)
+            params[1] = self.previous_job_id
+
+        self.send('mining.submit', params, kind)
+
+    async def run(self, mix, stop_at):
+        kinds, weights = zip(*mix)
+        while True:
+            delay = random.expovariate(self.args.rate)
+            if time.perf_counter() + delay >= stop_at:
+                await asyncio.sleep(max(0, stop_at - time.perf_counter()))
+                break
+            await asyncio.sleep(delay)
+            if self.job is None or self.transport.is_closing():
+                continue
+            self.submit(random.choices(kinds, weights)[0])
+
+
+def prepare_database(path, args, port):
+    engine = create_engine('sqlite:///%s' % path)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    coin = Coins()
+    coin.name = args.coin
+    coin.algorithm = args.algorithm
+    coin.port = port
+    coin.confirmation_count = 100
+    coin.pool_address = make_address()
+    coin.shield_address = make_address()
+    session.add(coin)
+    session.commit()
+    return engine
+
+
+def count_shares(engine):
+    session = sessionmaker(bind=engine)()
+    return session.query(Shares.pool_result, func.count(Shares.id)).group_by(Shares.pool_result).all()
+
+
+def process_cpu_seconds(pid):
+    # utime + stime of the pool and its children, ex: share validation processes
+    total = 0
+    tick = os.sysconf('SC_CLK_TCK')
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        if int(entry) == pid or int(fields[1]) == pid:
+            total += (int(fields[11]) + int(fields[12])) / tick
+    return total
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def run_miners(args, stats, mix):
+    loop = asyncio.get_event_loop()
+    miners = []
+    for start in range(0, args.miners, 200):
+        connections = [loop.create_connection(lambda i=i: Miner(i, args, stats), '127.0.0.1', args.port) for i in range(start, min(start + 200, args.miners))]
+        miners += [miner for _, miner in await asyncio.gather(*connections)]
+
+    # Every miner is authorized and has a job before the measurement starts
+    deadline = time.perf_counter() + 30
+    while time.perf_counter() < deadline and any(miner.job is None for miner in miners):
+        await asyncio.sleep(0.1)
+
+    stats.notify_times.clear()
+    started = time.perf_counter()
+    await asyncio.gather(*[miner.run(mix, started + args.duration) for miner in miners])
+    elapsed = time.perf_counter() - started
+    # Responses of the last submits
+    await asyncio.sleep(1)
+    for miner in miners:
+        miner.transport.close()
+    await asyncio.sleep(1)
+    return elapsed
+
+
+def report(args, stats, elapsed, cpu_seconds, shares, daemon):
+    print('coin type : %s, miners : %d (authorized %d), duration : %.1f sec' % (args.coin_type, args.miners, stats.authorized, elapsed))
+    total = 0
+    for kind in SHARE_KINDS:
+        latencies = stats.latencies[kind]
+        total += len(latencies)
+        if not latencies:
+            continue
+        print('  %-9s : %6d submits, p50 %7.2f ms, p99 %7.2f ms, results %s' % (
+            kind, len(latencies), percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, stats.results[kind]))
+    print('  submits   : %.0f shares/sec' % (total / elapsed))
+
+    fan_out = [last - first for first, last, count in stats.notify_times.values() if count == args.miners]
+    print('  notify    : %d jobs to every miner, fan-out p50 %.2f ms, max %.2f ms' % (len(fan_out), percentile(fan_out, 0.5) * 1000, max(fan_out or [0]) * 1000))
+    print('  pool cpu  : %.1f%% of one core' % (cpu_seconds / elapsed * 100))
+    print('  database  : shares %s, blocks submitted %d' % (dict(shares), daemon.submitted_blocks))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline Stratum load test')
+    parser.add_argument('--coin-type', choices=['bitcoin', 'zcash'], default='bitcoin')
+    parser.add_argument('--miners', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=1.0, help='shares per second of one miner')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--mix', default='valid=90,low=4,duplicate=3,stale=3')
+    parser.add_argument('--port', type=int, default=13333)
+    parser.add_argument('--daemon-port', type=int, default=18332)
+    parser.add_argument('--block-interval', type=float, default=10)
+    parser.add_argument('--txs', type=int, default=100)
+    parser.add_argument('--stratum-workers', type=int, default=0)
+    args = parser.parse_args()
+
+    mix = [(kind, float(weight)) for kind, weight in (item.split('=') for item in args.mix.split(','))]
+    args.coin = 'loadtest'
+    args.algorithm = 'sha256' if args.coin_type == 'bitcoin' else 'equihash'
+    args.address = make_address()
+    # About one nonce in 16 is a valid share, miners grind a few hashes per share
+    args.pool_diff = POW_LIMITS[args.coin_type] * 16 / 2 ** 256
+
+    work_dir = tempfile.mkdtemp(prefix='load_test_')
+    database_path = os.path.join(work_dir, 'pool.db')
+    engine = prepare_database(database_path, args, args.port)
+
+    daemon = FakeCoinDaemon(args.daemon_port, args.txs, args.block_interval)
+    daemon.start()
+
+    env = dict(os.environ)
+    env.update({
+        'DEBUG': 'true', 'LOG_LEVEL': 'WARNING', 'DATABASE_URL': 'sqlite:///%s' % database_path,
+        'COIN': args.coin, 'COIN_TYPE': args.coin_type, 'COIN_ALGORITHM': args.algorithm,
+        'POW_LIMIT': '0x%064x' % POW_LIMITS[args.coin_type], 'POOL_DIFF': repr(args.pool_diff), 'VARDIFF': 'false',
+        'COIN_DAEMON_HOST': 'http://127.0.0.1', 'COIN_DAEMON_PORT': str(args.daemon_port), 'COIN_DAEMON_USER': 'load', 'COIN_DAEMON_PASSWORD': 'test',
+        'BLOCK_UPDATE_INTERVAL': '1', 'MERKLE_UPDATE_INTERVAL': '5', 'STRATUM_WORKERS': str(args.stratum_workers),
+        'BAN_FAILURE_THRESHOLD': '1000000000', 'STRATUM_MAX_MESSAGES_PER_SEC': '100000', 'STRATUM_MAX_BYTES_PER_SEC': '100000000',
+    })
+    pool = subprocess.Popen([sys.executable, 'app.py', args.coin, 'testnet'], cwd=REPO_DIR, env=env)
+
+    try:
+        # Wait the Stratum port
+        for _ in range(100):
+            time.sleep(0.1)
+            try:
+                asyncio.run(asyncio.wait_for(asyncio.open_connection('127.0.0.1', args.port), 1))
+                break
+            except OSError:
+                if pool.poll() is not None:
+                    raise Exception('app.py exited with %s' % pool.returncode)
+
+        stats = Stats()
+        cpu_started = process_cpu_seconds(pool.pid)
+        elapsed = asyncio.run(run_miners(args, stats, mix))
+        cpu_seconds = process_cpu_seconds(pool.pid) - cpu_started
+    finally:
+        pool.send_signal(signal.SIGTERM)
+        pool.wait(timeout=30)
+
+    report(args, stats, elapsed, cpu_seconds, count_shares(engine), daemon)
+
+
+if __name__ == '__main__':
+    main()
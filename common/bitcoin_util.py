@@ -24,28 +24,22 @@ def ser_string(s):
     return chr(255).encode() + struct.pack("<Q", len(s)).encode() + s
 
 
+UINT256_MASK = (1 << 256) - 1
+WORDS_BE = struct.Struct(">8I")
+WORDS_LE = struct.Struct("<8I")
+
+
 def deser_uint256(f):
-    r = 0
-    for i in range(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    return int.from_bytes(f.read(32), 'little')
 
 
 def ser_uint256(u):
-    rs = b""
-    for i in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    # Same 32 bytes as packing 8 little endian words, in one call
+    return (u & UINT256_MASK).to_bytes(32, 'little')
 
 
 def uint256_from_str(s):
-    r = 0
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in range(8):
-        r += t[i] << (i * 32)
-    return r
+    return int.from_bytes(s[:32], 'little')
 
 
 def uint256_from_str_be(s):
@@ -170,7 +164,8 @@ def reverse_hash(h):
     if len(h) != 64:
         raise Exception('hash must have 64 hexa chars')
 
-    return b''.join([h[56 - i:64 - i] for i in range(0, 64, 8)])
+    # Word order reversed = every byte reversed, then the bytes of each word swapped back
+    return binascii.hexlify(WORDS_LE.pack(*WORDS_BE.unpack(binascii.unhexlify(h)[::-1])))
 
 
 def bits_to_target(bits):
@@ -285,3 +280,61 @@ class MerkleTree:
 
     def merkleRoot(self):
         return self.withFirst(self.data[0])
+
+
+class IncrementalMerkleTree(MerkleTree):
+    # Coinbase first merkle tree that keeps every level, a tree built from a previous one only
+    # hashes the pairs after the first changed transaction. The previous tree is not modified.
+    def __init__(self, data, previous=None):
+        self.previous = previous
+        self.levels = []
+        super().__init__(data)
+
+    def recalculate(self, detailed=False):
+        L = list(self.data)
+        dirty = 0
+        old_levels = []
+        if self.previous is not None:
+            old_levels = self.previous.levels
+            old_data = old_levels[0]
+            while dirty < len(L) and dirty < len(old_data) and L[dirty] == old_data[dirty]:
+                dirty += 1
+        self.previous = None
+
+        levels = []
+        steps = []
+        k = 0
+        while True:
+            levels.append(L)
+            Ll = len(L)
+            if Ll == 1:
+                break
+            steps.append(L[1])
+
+            if k + 1 < len(old_levels):
+                old_len = len(old_levels[k])
+                # The last pair of an odd level was hashed with a copy of its first element
+                if old_len % 2 and dirty > old_len - 1:
+                    dirty = old_len - 1
+                start = max(dirty - dirty % 2, 2)
+                next_L = old_levels[k + 1][:start // 2]
+            else:
+                start = 2
+                next_L = [None]
+
+            padded = L + [L[-1]] if Ll % 2 else L
+            next_L += [double_sha(padded[i] + padded[i + 1]) for i in range(start, Ll, 2)]
+            dirty = start // 2
+            L = next_L
+            k += 1
+
+        self.levels = levels
+        self._steps = steps
+        self.detail = None
+
+    def __getstate__(self):
+        # Levels are only needed to build the next tree, a pickled copy only validates shares
+        state = self.__dict__.copy()
+        state['data'] = self.data[:1]
+        state['levels'] = []
+        return state
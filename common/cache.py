@@ -1,3 +1,85 @@
+from collections import OrderedDict
 import memcache
+import asyncio
+import time
 
 mc = memcache.Client('127.0.0.1')
+
+MISSING = object()
+
+
+class TTLCache(object):
+    # LRU of at most max_size entries, each one expires ttl seconds after it was set.
+    # Falsy values are negative results and expire after negative_ttl.
+    def __init__(self, max_size, ttl, negative_ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl if negative_ttl is not None else ttl
+        self.entries = OrderedDict()  # key: (value, expires)
+        self.loading = {}  # key: future of the lookup in progress
+
+        self.hits = 0
+        self.misses = 0
+        self.shared_loads = 0
+
+    def get(self, key, default=MISSING):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+
+        if entry[1] <= time.monotonic():
+            del self.entries[key]
+            return default
+
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def set(self, key, value):
+        ttl = self.ttl if value else self.negative_ttl
+        self.entries[key] = (value, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    async def get_or_load(self, key, loader):
+        # Single flight, concurrent lookups of the same key wait for one loader call
+        value = self.get(key)
+        if value is not MISSING:
+            self.hits += 1
+            return value
+
+        future = self.loading.get(key)
+        if future is not None:
+            self.shared_loads += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = asyncio.get_event_loop().create_future()
+        self.loading[key] = future
+        try:
+            value = await loader(key)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            # Errors are not cached, the waiting lookups get the same error
+            future.set_exception(e)
+            # Retrieved here so an error without waiters is not logged as never retrieved
+            future.exception()
+            raise
+        else:
+            self.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            del self.loading[key]
+
+    def get_stats(self):
+        stats = {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'shared_loads': self.shared_loads}
+        self.hits = 0
+        self.misses = 0
+        self.shared_loads = 0
+        return stats
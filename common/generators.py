@@ -1,4 +1,5 @@
 import struct
+from collections import deque
 import uuid
 
 
@@ -22,14 +23,36 @@ class SessionIdGenerator(object):
 
 
 class NonceGenerator(object):
-    def __init__(self, instance_id):
-        self.counter = instance_id << 27
+    # extranonce1 allocator, the high INSTANCE_BITS are the instance id so processes never overlap.
+    # Released values are reused oldest first, live sessions never share a value.
+    # A released value waits until every job issued before its release is evicted,
+    # a new session must not redo the nonce space of the old one on a retained job.
+    INSTANCE_BITS = 5
+    COUNTER_BITS = 32 - INSTANCE_BITS
+
+    def __init__(self, instance_id=0):
+        if instance_id >= 1 << self.INSTANCE_BITS:
+            raise Exception('instance id %d is out of range' % instance_id)
+        self.base = instance_id << self.COUNTER_BITS
+        self.counter = 0
+        self.free = deque()
         self.size = struct.calcsize('>L')
 
     def get_size(self):
         # Return expected size of generated extranonce in bytes
         return self.size
 
-    def get_new_nonce(self):
-        self.counter += 1
-        return struct.pack('>L', self.counter)
+    def get_new_nonce(self, oldest_job_sequence=None):
+        # oldest_job_sequence is the sequence of the oldest retained job, None when no job is retained
+        if self.free and (oldest_job_sequence is None or self.free[0][1] < oldest_job_sequence):
+            value, _ = self.free.popleft()
+        elif self.counter < 1 << self.COUNTER_BITS:
+            value = self.base | self.counter
+            self.counter += 1
+        else:
+            raise Exception('extranonce1 space is exhausted')
+        return struct.pack('>L', value)
+
+    def release(self, nonce: bytes, job_sequence: int):
+        # job_sequence is the sequence of the newest job issued at release time
+        self.free.append((struct.unpack('>L', nonce)[0], job_sequence))
@@ -6,6 +6,11 @@ import os
 import sha3
 
 
+def get_pow_limit() -> int:
+    # POW_LIMIT is written as a hex string in .env
+    return int(os.getenv("POW_LIMIT"), 16)
+
+
 def double_sha(b):
     return sha256(sha256(b).digest()).digest()
 
@@ -15,62 +20,50 @@ def sha(b):
 
 
 def hex_to_reverse_hash(_hex):
-    return binascii.hexlify(reverse_bytes(double_sha(binascii.unhexlify(_hex))))
+    return binascii.hexlify(double_sha(binascii.unhexlify(_hex))[::-1])
 
 
 def bytes_to_reverse_hash(_bytes):
-    return binascii.hexlify(reverse_bytes(double_sha(_bytes)))
+    return binascii.hexlify(double_sha(_bytes)[::-1])
 
 
 def hex_to_reverse_hex(_hex) -> str:
-    return binascii.hexlify(reverse_bytes(binascii.unhexlify(_hex))).decode()
+    return binascii.hexlify(binascii.unhexlify(_hex)[::-1]).decode()
 
 
 def bytes_to_reverse_hex(_bytes):
     return binascii.hexlify(reverse_bytes(_bytes))
 
 
-def merkle_root(hashes: list):
+def merkle_root_bytes(hashes: list) -> bytes:
+    # Binary in, binary out, hashes and root in internal byte order
     if len(hashes) == 1:
         return hashes[0]
 
-    reverse_hashes = []
-    for _hash in hashes:
-        reverse_hashes.append(reverse_bytes(binascii.unhexlify(_hash)))
-
-    _merkle_root = None
-    while _merkle_root is None:
-        tmp_tree = []
+    level = list(hashes)
+    while len(level) > 1:
+        if len(level) % 2 == 1:
+            level.append(level[-1])
+        level = [double_sha(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
 
-        if len(reverse_hashes) % 2 == 1:
-            reverse_hashes.append(reverse_hashes[len(reverse_hashes) - 1])
+    return level[0]
 
-        for i in range(len(reverse_hashes)):
-            if i % 2 == 0:
-                tmp_tree.append(double_sha(reverse_hashes[i] + reverse_hashes[i + 1]))
 
-        if len(tmp_tree) == 1:
-            _merkle_root = tmp_tree[0]
-        else:
-            reverse_hashes = tmp_tree
-
-    _merkle_root = binascii.hexlify(reverse_bytes(_merkle_root))
+def merkle_root(hashes: list):
+    # Hex wrapper of merkle_root_bytes for RPC hashes, a single hash is returned as is
+    if len(hashes) == 1:
+        return hashes[0]
 
-    return _merkle_root
+    return binascii.hexlify(merkle_root_bytes([binascii.unhexlify(_hash)[::-1] for _hash in hashes])[::-1])
 
 
 def reverse_bytes(b: bytes):
-    _list = list(b)
-    _list.reverse()
-    return bytes(_list)
+    # bytes, bytearray or memoryview, always returns bytes
+    return bytes(b[::-1])
 
 
 def uint256_from_str(s):
-    r = 0
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in range(8):
-        r += t[i] << (i * 32)
-    return r
+    return int.from_bytes(s[:32], 'little')
 
 
 def address_to_pubkeyhash(addr):
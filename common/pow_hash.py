@@ -0,0 +1,102 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from hashlib import sha256
+from common.logger import get_logger
+import asyncio
+import os
+
+logger = get_logger(__name__)
+
+# These are cheaper to run inline than to pickle through a worker process.
+INLINE_ALGORITHMS = ['sha256', 'keccak', 'keccakc']
+
+
+class PowHashQueueFullException(Exception):
+    pass
+
+
+def get_pow_hash(algorithm, header: bytes) -> bytes:
+    if algorithm == 'lyra2rev2':
+        import lyra2re2_hash
+        return lyra2re2_hash.getPoWHash(header)
+    elif algorithm == 'lyra2rev3':
+        import lyra2re3_hash
+        return lyra2re3_hash.getPoWHash(header)
+    elif algorithm == 'keccak' or algorithm == 'keccakc':
+        import sha3
+        return sha3.keccak_256(header).digest()
+    elif algorithm == 'x13-bcd':
+        import x13bcd_hash
+        return x13bcd_hash.getPoWHash(header)
+    elif algorithm == 'neoscrypt':
+        import neoscrypt
+        return neoscrypt.getPoWHash(header)
+    elif algorithm == 'yescrypt':
+        import yescrypt_hash
+        return yescrypt_hash.getHash(header, len(header))
+    elif algorithm == 'xevan':
+        import xevan_hash
+        return xevan_hash.getPoWHash(header)
+    elif algorithm == 'phi2':
+        import phi2_hash
+        return phi2_hash.getPoWHash(header)
+    elif algorithm == 'x16r':
+        import x16r_hash
+        return x16r_hash.getPoWHash(header)
+    elif algorithm == 'x16s':
+        import x16s_hash
+        return x16s_hash.getPoWHash(header)
+    elif algorithm == 'timetravel10':
+        import timetravel10_hash
+        return timetravel10_hash.getPoWHash(header)
+    else:
+        return sha256(sha256(header).digest()).digest()
+
+
+class PowHashExecutor(object):
+    def __init__(self, algorithm=None, workers=None, queue_size=None):
+        self.algorithm = algorithm if algorithm is not None else os.getenv("COIN_ALGORITHM")
+
+        if workers is None:
+            workers = int(os.getenv("SHARE_VALIDATION_WORKERS", os.cpu_count() or 1))
+        if queue_size is None:
+            queue_size = int(os.getenv("SHARE_VALIDATION_QUEUE_SIZE", 1000))
+
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pending = 0
+
+        if workers > 0 and self.algorithm not in INLINE_ALGORITHMS:
+            logger.info('Start share validation executor, algorithm : %s, workers : %d, queue size : %d' % (self.algorithm, workers, queue_size))
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = None
+
+    async def hash(self, header: bytes) -> bytes:
+        if self.executor is None:
+            return get_pow_hash(self.algorithm, header)
+
+        if self.pending >= self.queue_size:
+            raise PowHashQueueFullException('share validation queue is full (%d)' % self.pending)
+
+        self.pending += 1
+        try:
+            executor = self.executor
+            try:
+                return await asyncio.get_event_loop().run_in_executor(executor, get_pow_hash, self.algorithm, header)
+            except BrokenProcessPool:
+                # A worker process died, every pending hash of the pool fails. The first one replaces the pool, all of them retry once.
+                if self.executor is None:
+                    raise
+                if self.executor is executor:
+                    logger.error('Share validation executor is broken, restart it')
+                    executor.shutdown(wait=False)
+                    self.executor = ProcessPoolExecutor(max_workers=self.workers)
+                return await asyncio.get_event_loop().run_in_executor(self.executor, get_pow_hash, self.algorithm, header)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
@@ -0,0 +1,123 @@
+from common.cache import mc
+from common.logger import get_logger
+import asyncio
+import time
+import os
+
+logger = get_logger(__name__)
+
+
+class TokenBucket(object):
+    # rate per second, capacity is the largest burst, a single consume larger than capacity never succeeds
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def consume(self, amount=1) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens < amount:
+            return False
+
+        self.tokens -= amount
+        return True
+
+
+class IPBanList(object):
+    # Failure counter per IP, like the old memcache key each failure pushes the expiry window forward.
+    def __init__(self):
+        self.threshold = int(os.getenv("BAN_FAILURE_THRESHOLD", 50))
+        self.window = float(os.getenv("BAN_WINDOW", 60))
+        self.sync_memcached = os.getenv("BAN_SYNC_MEMCACHED") == 'true'
+        self.sync_interval = float(os.getenv("BAN_SYNC_INTERVAL", 5))
+
+        self.failures = {}  # ip: [count, expires]
+        self.pending = {}  # ip: failures not pushed to memcached yet
+        self.timer = None
+
+    def start(self):
+        if self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(self.sync_interval, self.tick)
+
+    def is_banned(self, ip) -> bool:
+        failure = self.failures.get(ip)
+        if failure is None:
+            return False
+
+        return failure[0] > self.threshold and failure[1] > time.monotonic()
+
+    def increase_failure(self, ip):
+        now = time.monotonic()
+        failure = self.failures.get(ip)
+        if failure is None or failure[1] <= now:
+            self.failures[ip] = [1, now + self.window]
+        else:
+            failure[0] += 1
+            failure[1] = now + self.window
+
+        if self.sync_memcached:
+            self.pending[ip] = self.pending.get(ip, 0) + 1
+
+        self.start()
+
+    def tick(self):
+        self.timer = None
+        self.evict()
+
+        if self.sync_memcached and self.pending:
+            pending = self.pending
+            self.pending = {}
+            future = asyncio.get_event_loop().run_in_executor(None, self.push_memcached, pending)
+            future.add_done_callback(self.push_done)
+
+        if self.failures or self.pending:
+            self.start()
+
+    def evict(self):
+        now = time.monotonic()
+        expired = [ip for ip, failure in self.failures.items() if failure[1] <= now]
+        for ip in expired:
+            del self.failures[ip]
+
+    def push_memcached(self, pending: dict) -> dict:
+        # Runs on a worker thread, returns the failure count shared by every process
+        totals = {}
+        for ip, count in pending.items():
+            fail_key = 'ban::%s' % ip
+            # add and incr are atomic in memcached, other processes push to the same key at the same time
+            if mc.add(fail_key, count, time=int(self.window)):
+                total = count
+            else:
+                total = mc.incr(fail_key, count)
+                if total is None:
+                    # Expired between add and incr
+                    mc.add(fail_key, count, time=int(self.window))
+                    total = count
+                else:
+                    mc.touch(fail_key, int(self.window))
+            totals[ip] = total
+        return totals
+
+    def push_done(self, future):
+        if future.exception() is not None:
+            logger.error('Ban list memcached sync failed, %s' % future.exception())
+            return
+
+        now = time.monotonic()
+        for ip, total in future.result().items():
+            failure = self.failures.get(ip)
+            if failure is None:
+                self.failures[ip] = [total, now + self.window]
+            elif total > failure[0]:
+                failure[0] = total
+
+        self.start()
+
+
+ban_list = IPBanList()
@@ -0,0 +1,47 @@
+from common.logger import get_logger
+import asyncio
+import socket
+import os
+
+logger = get_logger(__name__)
+
+
+def install_event_loop():
+    # UVLOOP=true uses uvloop when it is installed, otherwise the default asyncio loop
+    if os.getenv("UVLOOP") != 'true':
+        return False
+
+    try:
+        import uvloop
+    except ImportError:
+        logger.error('UVLOOP is true but uvloop is not installed, use the default event loop')
+        return False
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info('Event loop : uvloop')
+    return True
+
+
+def tune_socket(sock):
+    if sock is None:
+        return
+
+    if os.getenv("STRATUM_TCP_NODELAY", 'true') == 'true':
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    # Keepalive probes close connections of miners that disappeared without FIN
+    if os.getenv("STRATUM_KEEPALIVE", 'true') == 'true':
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(os.getenv("STRATUM_KEEPALIVE_IDLE", 60)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, int(os.getenv("STRATUM_KEEPALIVE_INTERVAL", 10)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, int(os.getenv("STRATUM_KEEPALIVE_COUNT", 5)))
+
+
+def tune_transport(transport):
+    tune_socket(transport.get_extra_info('socket'))
+    transport.set_write_buffer_limits(high=int(os.getenv("STRATUM_WRITE_BUFFER_HIGH", 65536)), low=int(os.getenv("STRATUM_WRITE_BUFFER_LOW", 16384)))
+
+
+def create_server(loop, protocol_factory, port, reuse_port=None):
+    return loop.create_server(protocol_factory, host='0.0.0.0', port=port, backlog=int(os.getenv("STRATUM_BACKLOG", 1024)), reuse_port=reuse_port)
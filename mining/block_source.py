@@ -0,0 +1,99 @@
+from stratum.coin_rpc import RPCConnection, CoinRPCTimeoutException
+from common.logger import get_logger
+import binascii
+import asyncio
+import os
+
+try:
+    import zmq
+    import zmq.asyncio
+except ImportError:
+    zmq = None
+
+logger = get_logger(__name__)
+
+
+class LongpollBlockSource(object):
+    # getblocktemplate longpoll on its own connection, the daemon answers when the template changes.
+    def __init__(self, block_updater):
+        self.block_updater = block_updater
+        self.coin_rpc = block_updater.coin_rpc
+        self.timeout = float(os.getenv("BLOCK_LONGPOLL_TIMEOUT", 120))
+        self.retry_interval = float(os.getenv("BLOCK_SOURCE_RETRY_INTERVAL", 5))
+        self.connection = RPCConnection(self.coin_rpc.service_url.hostname, self.coin_rpc.port, timeout=self.timeout)
+        self.task = None
+
+    def start(self):
+        logger.info('Block source : longpoll')
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        longpollid = None
+        while True:
+            try:
+                if longpollid is None:
+                    data = await self.coin_rpc.get_block_template()
+                else:
+                    data = await self.coin_rpc.get_block_template_longpoll(longpollid, self.connection)
+            except CoinRPCTimeoutException as e:
+                # Timeout without a new template is normal, ask again with the same longpollid
+                logger.debug('Longpoll %s' % e)
+                continue
+            except Exception as e:
+                logger.error('Longpoll failed, %s, retry after %s sec' % (e, self.retry_interval))
+                longpollid = None
+                await asyncio.sleep(self.retry_interval)
+                continue
+
+            if 'longpollid' not in data:
+                logger.error('Coin daemon does not support longpoll, polling only')
+                return
+
+            if longpollid is not None:
+                await self.block_updater.update_block(repeat=False, data=data)
+            longpollid = data['longpollid']
+
+
+class ZMQBlockSource(object):
+    # Subscribes hashblock of the coin daemon, -zmqpubhashblock=COIN_DAEMON_ZMQ
+    def __init__(self, block_updater):
+        self.block_updater = block_updater
+        self.address = os.getenv("COIN_DAEMON_ZMQ", 'tcp://127.0.0.1:28332')
+        self.context = None
+        self.task = None
+
+    def start(self):
+        logger.info('Block source : zmq %s' % self.address)
+        self.context = zmq.asyncio.Context()
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        socket = self.context.socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, b'hashblock')
+        socket.connect(self.address)
+
+        while True:
+            try:
+                topic, body, _ = await socket.recv_multipart()
+            except zmq.ZMQError as e:
+                logger.error('ZMQ receive failed, %s' % e)
+                await asyncio.sleep(1)
+                continue
+
+            logger.debug('ZMQ hashblock %s' % binascii.hexlify(body).decode())
+            await self.block_updater.update_block(repeat=False)
+
+
+def create_block_source(block_updater):
+    # polling(default), longpoll or zmq, polling keeps running with the others
+    source = os.getenv("BLOCK_SOURCE", 'polling')
+    if source == 'longpoll':
+        return LongpollBlockSource(block_updater)
+    elif source == 'zmq':
+        if zmq is None:
+            logger.error('BLOCK_SOURCE is zmq but pyzmq is not installed, polling only')
+            return None
+        return ZMQBlockSource(block_updater)
+    elif source != 'polling':
+        logger.error('Unknown BLOCK_SOURCE %s, polling only' % source)
+    return None
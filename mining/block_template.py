@@ -40,7 +40,12 @@ class BlockTemplate(object):
         self.coinbase_aux = b'https://acpool.me'
 
         self.extranonce_placeholder = b'f000000ff111111f'
+        self.coinbase_prefix = b''
+        self.coinbase_suffix = b''
         self.merkle_branch = []
+        self.merkle_tree = bitcoin_util.IncrementalMerkleTree([None])
+        self.tx_hashes = ()
+        self.template_fingerprint = None
         self.pool_address = hash_util.address_to_pubkeyhash(pool_address)[1]
 
         self.with_pos = False
@@ -49,6 +54,14 @@ class BlockTemplate(object):
 
     def merkle_update(self, data, notify: bool):
         is_merkle_change = False
+
+        # Polling mostly returns the same template, skip the coinbase and merkle rebuild then
+        tx_hashes = tuple(t['hash'] for t in data['transactions'])
+        fingerprint = (data['previousblockhash'], data.get('coinbasevalue'), tx_hashes)
+        if not notify and fingerprint == self.template_fingerprint:
+            return
+        self.template_fingerprint = fingerprint
+
         self.transactions = data['transactions']
 
         self.fee = 0
@@ -70,18 +83,19 @@ class BlockTemplate(object):
         else:
             self.create_coinbase_transaction()
 
+        # Only hashes after the first changed transaction are serialized and hashed again
+        self.merkle_tree = bitcoin_util.IncrementalMerkleTree([None] + self.serialize_tx_hashes(tx_hashes), self.merkle_tree)
+
         if os.getenv("COIN_TYPE") == 'bitcoin':
-            tx_hashes = [None] + [bitcoin_util.ser_uint256(int(t['hash'], 16)) for t in self.transactions]
-            merkle_tree = bitcoin_util.MerkleTree(tx_hashes)
-            tmp_merkle_branch = [binascii.hexlify(x).decode() for x in merkle_tree._steps]
+            tmp_merkle_branch = [binascii.hexlify(x).decode() for x in self.merkle_tree._steps]
 
             if self.merkle_branch != tmp_merkle_branch:
                 self.merkle_branch = tmp_merkle_branch
                 is_merkle_change = True
 
         elif os.getenv("COIN_TYPE") == 'zcash':
-            tx_hashes = [self.coinbase_tx_hash] + [h['hash'] for h in self.transactions]
-            tmp_merkle_root = hash_util.merkle_root(tx_hashes)
+            coinbase_hash = binascii.unhexlify(self.coinbase_tx_hash)[::-1]
+            tmp_merkle_root = binascii.hexlify(self.merkle_tree.withFirst(coinbase_hash)[::-1])
 
             if self.merkle_root != tmp_merkle_root:
                 self.merkle_root = tmp_merkle_root
@@ -96,16 +110,27 @@ class BlockTemplate(object):
                 logger.info('Merkle Changed, merkle length : %d' % len(self.transactions))
                 Interfaces.stratum_handler.notify_all()
 
+    def serialize_tx_hashes(self, tx_hashes: tuple) -> list:
+        old_hashes = self.tx_hashes
+        old_serialized = self.merkle_tree.data
+        prefix = 0
+        while prefix < len(tx_hashes) and prefix < len(old_hashes) and tx_hashes[prefix] == old_hashes[prefix]:
+            prefix += 1
+
+        self.tx_hashes = tx_hashes
+        return old_serialized[1:prefix + 1] + [bitcoin_util.ser_uint256(int(h, 16)) for h in tx_hashes[prefix:]]
+
     def block_update(self, data):
         self.version = data['version']
         self.target = data['target']
 
+        pow_limit = hash_util.get_pow_limit()
         target = int(data['target'], 16)
         if target == 0:
-            target = os.getenv("POW_LIMIT")
+            target = pow_limit
             logger.error('Target is Zero, change to 1')
 
-        self.difficulty = os.getenv("POW_LIMIT") / target
+        self.difficulty = pow_limit / target
         logger.info('Current difficulty is %f' % self.difficulty)
 
         self.curtime = binascii.hexlify(struct.pack("<I", data['curtime'])).decode()
@@ -228,43 +253,6 @@ class BlockTemplate(object):
         self.coinbase_tx = tx.to_hex()
         self.coinbase_tx_hash = hash_util.bytes_to_reverse_hash(self.coinbase_tx)
 
-    def serialize_block_header(self, n_time: bytes, nonce: bytes, merkle_root=None):
-        header = struct.pack("<I", self.version)
-        header += binascii.unhexlify(self.prev_hash_reverse_hex)
-
-        if merkle_root is not None:
-            header += binascii.unhexlify(merkle_root)
-        else:
-            header += binascii.unhexlify(self.merkle_root_reverse_hex)
-
-        if os.getenv("COIN_TYPE") == 'zcash':
-            header += binascii.unhexlify(b'0000000000000000000000000000000000000000000000000000000000000000')
-
-        header += binascii.unhexlify(n_time)
-        header += binascii.unhexlify(self.n_bits_reverse_hex)
-        header += binascii.unhexlify(nonce)
-
-        return header
-
-    def serialize_block(self, header, soln=None, coinbase=None):
-        tx_count = format(self.tx_count, 'x')
-
-        if abs(len(tx_count) % 2) == 1:
-            tx_count = '0' + tx_count
-
-        if self.tx_count <= 0x7f:
-            var_int = binascii.unhexlify(tx_count)
-        else:
-            var_int = binascii.unhexlify('FD') + binascii.unhexlify(tx_count)
-
-        if soln is not None:
-            buf = header + soln + var_int + self.coinbase_tx
-        elif coinbase is not None:
-            buf = header + var_int + coinbase
-        else:
-            raise Exception('soln or coinbase required')
-
-        for transaction in self.transactions:
-            buf += binascii.unhexlify(transaction['data'])
-
-        return buf
+        if os.getenv("COIN_TYPE") == 'bitcoin':
+            # Binary halves around the extranonce, a share only concatenates them
+            self.coinbase_prefix, _, self.coinbase_suffix = self.coinbase_tx.partition(binascii.unhexlify(self.extranonce_placeholder))
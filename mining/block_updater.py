@@ -1,7 +1,8 @@
-from stratum.coin_rpc import CoinRPC, CoinMethodNotFoundException
+from stratum.coin_rpc import CoinRPC, CoinMethodNotFoundException, CoinRPCConnectionException
 import os
 from common.logger import get_logger
 from mining.database import Database
+from mining.block_source import create_block_source
 import simplejson
 import asyncio
 
@@ -23,12 +24,21 @@ class BlockUpdater(object):
         if os.getenv("COIN_TYPE") == 'zcash':
             self.shield_address = coin.shield_address
 
-        self.update_coin_reward()
-        self.update_block()
+        self.update_lock = asyncio.Lock()
+        self.block_source = None
 
-    def update_coin_reward(self):
+    async def start(self):
+        await self.update_coin_reward()
+        await self.update_block()
+
+        # Polling keeps running as the fallback of a push source
+        self.block_source = create_block_source(self)
+        if self.block_source is not None:
+            self.block_source.start()
+
+    async def update_coin_reward(self):
         try:
-            subsidy = self.coin_rpc.get_block_subsidy()
+            subsidy = await self.coin_rpc.get_block_subsidy()
             if 'founders' in subsidy:
                 if os.getenv("COIN") == 'bitcoin-interest' or os.getenv("COIN") == 'bitcoin-gold':
                     block_reward = subsidy['miner'] + subsidy['founders']
@@ -46,12 +56,16 @@ class BlockUpdater(object):
         except Exception:
             pass
 
-    def check_unconfirmed_transactions(self):
+    async def check_unconfirmed_transactions(self):
         # TODO: transaction confirmation count 정해야함
         confirmed_count = 10
-        tx_ids = self.database_ref.get_unconfirmed_tx_ids(confirmed_count)
-        for tx_id in tx_ids:
-            result = self.coin_rpc.get_transaction(tx_id[0])
+        tx_ids = [tx_id[0] for tx_id in self.database_ref.get_unconfirmed_tx_ids(confirmed_count)]
+        results = await self.coin_rpc.get_transactions(tx_ids)
+        for tx_id, result in zip(tx_ids, results):
+            if isinstance(result, Exception):
+                logger.error('NotFound Transaction %s, message : %s' % (tx_id, result))
+                continue
+
             confirmations = result['confirmations']
 
             block_hash = None
@@ -69,7 +83,7 @@ class BlockUpdater(object):
 
                 self.database_ref.remove_lock_balance(result['txid'], real_fee=fee)
 
-    def send_auto_payout(self):
+    async def send_auto_payout(self):
         # DB에서 wallet balance가 auto payout을 설정한 양 이상이 되는 애들에게 전송
         wallets = self.database_ref.get_auto_payout_users()
         if len(wallets) > 0:
@@ -87,37 +101,47 @@ class BlockUpdater(object):
                 send_data[wallet.address] = balance
                 save_data.append({'address': wallet.address, 'amount': balance, 'username': wallet.username})
 
-            tx_id = self.coin_rpc.send_many(send_data)
+            tx_id = await self.coin_rpc.send_many(send_data)
             if tx_id is not None:
                 self.database_ref.save_transaction(tx_id=tx_id, save_data=save_data)
                 self.database_ref.lock_balance_wallets(wallets)
 
                 logger.info('Auto payout Transaction ID : %s, data %s' % (tx_id, send_data))
 
-    def update_confirmations(self):
+    async def update_confirmations(self):
         need_confirm_blocks = self.database_ref.get_need_confirmation_blocks(self.confirmation_count + 1)
 
-        for block in need_confirm_blocks:
-            try:
-                block_data = self.coin_rpc.get_block([block.hash])
-                block.confirmations = block_data['confirmations']
-
-                # Orphan Block
-                if block.confirmations == -1:
-                    self.database_ref.orphan_block_rewards_to_zero(block.id)
-
-                elif block_data['confirmations'] >= self.confirmation_count + 1:
-                    self.database_ref.add_confirmed_balance_to_wallet(block.id)
-
-            except Exception as e:
+        retry_blocks = []
+        blocks_data = await self.coin_rpc.get_blocks([block.hash for block in need_confirm_blocks])
+        for block, block_data in zip(need_confirm_blocks, blocks_data):
+            if isinstance(block_data, Exception):
                 # Sometimes Header hash != block hash (ex: monacoin testnet)
                 if block.confirmations == 0:
-                    block_hash = self.coin_rpc.get_block_hash([block.height])
-                    block_data = self.coin_rpc.get_block([block_hash])
-                    block.confirmations = block_data['confirmations']
-                    block.hash = block_hash
+                    retry_blocks.append(block)
                 else:
-                    logger.error('NotFound Block %s, message : %s' % (block.hash, e))
+                    logger.error('NotFound Block %s, message : %s' % (block.hash, block_data))
+                continue
+
+            block.confirmations = block_data['confirmations']
+
+            # Orphan Block
+            if block.confirmations == -1:
+                self.database_ref.orphan_block_rewards_to_zero(block.id)
+
+            elif block_data['confirmations'] >= self.confirmation_count + 1:
+                self.database_ref.add_confirmed_balance_to_wallet(block.id)
+
+        if len(retry_blocks) > 0:
+            block_hashes = await self.coin_rpc.get_block_hashes([block.height for block in retry_blocks])
+            found_blocks = [(block, block_hash) for block, block_hash in zip(retry_blocks, block_hashes) if not isinstance(block_hash, Exception)]
+            blocks_data = await self.coin_rpc.get_blocks([block_hash for _, block_hash in found_blocks])
+            for (block, block_hash), block_data in zip(found_blocks, blocks_data):
+                if isinstance(block_data, Exception):
+                    logger.error('NotFound Block %s, message : %s' % (block_hash, block_data))
+                    continue
+
+                block.confirmations = block_data['confirmations']
+                block.hash = block_hash
 
         if len(need_confirm_blocks) > 0:
             self.database_ref.session.commit()
@@ -126,7 +150,7 @@ class BlockUpdater(object):
             try:
                 unfinished_shield_coinbase = self.database_ref.get_unfinished_shield_coinbase_operation()
                 if unfinished_shield_coinbase is None:
-                    shield_coinbase = self.coin_rpc.zcash_shield_coinbase(self.shield_address)
+                    shield_coinbase = await self.coin_rpc.zcash_shield_coinbase(self.shield_address)
                     self.database_ref.save_or_update_operation(shield_coinbase['opid'], 'z_shieldcoinbase')
                     logger.info('New Shield Coinbase, Operation : %s' % shield_coinbase['opid'])
             except Exception:
@@ -135,7 +159,7 @@ class BlockUpdater(object):
             unfinished_operations = self.database_ref.get_unfinished_operations()
             if len(unfinished_operations) != 0:
                 unfinished_operations_ids = [item.op_id for item in unfinished_operations]
-                operations_status = self.coin_rpc.zcash_operations_status(unfinished_operations_ids)
+                operations_status = await self.coin_rpc.zcash_operations_status(unfinished_operations_ids)
                 for operation in operations_status:
                     unfinished_operations_ids.remove(operation['id'])
                     if operation['status'] == 'success':
@@ -168,10 +192,10 @@ class BlockUpdater(object):
                     logger.info('Lost Operations : %s' % unfinished_operations_ids)
                     self.database_ref.lost_operations_process(operations)
 
-    def shield_to_transparent_address(self):
+    async def shield_to_transparent_address(self):
         unfinished_to_t_address = self.database_ref.get_unfinished_to_t_address()
         if unfinished_to_t_address is None:
-            total_balance = self.coin_rpc.zcash_get_total_balance()
+            total_balance = await self.coin_rpc.zcash_get_total_balance()
             private_balance = round(float(total_balance['private']) - 0.0001, 8)
             if private_balance > 0:
                 if os.getenv("COIN") == 'buck' and private_balance > 50000:
@@ -182,17 +206,36 @@ class BlockUpdater(object):
                 save_data = [{'address': pool_address, 'amount': private_balance, 'username': 'admin'}]
                 logger.info('Shield to T address, Try data %s' % send_data)
 
-                operation = self.coin_rpc.zcash_send_many(self.shield_address, send_data)
+                operation = await self.coin_rpc.zcash_send_many(self.shield_address, send_data)
                 self.database_ref.save_or_update_operation(operation, 'to_t_address')
                 self.database_ref.save_transaction(tx_id=None, save_data=save_data, op_id=operation)
                 logger.info('Shield to T address operation : %s, data %s' % (operation, send_data))
 
-    def update_block(self, repeat=True, block_hash=None):
+    def schedule_update_block(self):
+        asyncio.ensure_future(self.update_block())
+
+    async def update_block(self, repeat=True, block_hash=None, data=None):
         if repeat:
-            asyncio.get_event_loop().call_later(float(os.getenv("BLOCK_UPDATE_INTERVAL")), self.update_block)
+            asyncio.get_event_loop().call_later(float(os.getenv("BLOCK_UPDATE_INTERVAL")), self.schedule_update_block)
+
+        if repeat and self.update_lock.locked():
+            logger.debug('Previous block update is still running')
+            return None
+
+        # Periodic update and found block update must not handle the same new block twice
+        async with self.update_lock:
+            return await self.update_block_template(repeat, block_hash, data)
 
-        logger.debug('Check new block')
-        data = self.coin_rpc.get_block_template([])
+    async def update_block_template(self, repeat, block_hash, data=None):
+        # data is a template pushed by a longpoll source, it is always checked for merkle changes
+        pushed = data is not None
+        if not pushed:
+            logger.debug('Check new block')
+            try:
+                data = await self.coin_rpc.get_block_template([])
+            except CoinRPCConnectionException as e:
+                logger.error('update_block failed, %s' % e)
+                return None
 
         if data is None:
             logger.error('update_block failed, response is None')
@@ -205,7 +248,7 @@ class BlockUpdater(object):
             self.block_template.merkle_update(data, notify=True)
             self.merkle_interval = float(os.getenv("MERKLE_UPDATE_INTERVAL"))
 
-            mining_info = self.coin_rpc.get_mining_info()
+            mining_info = await self.coin_rpc.get_mining_info()
             if mining_info is not None:
                 if 'powdifficulty' in mining_info:
                     difficulty = mining_info['powdifficulty']
@@ -221,12 +264,15 @@ class BlockUpdater(object):
 
                 self.database_ref.insert_block_info(mining_info['blocks'], difficulty, net_hashrate, self.block_template.pool_reward)
 
-            self.update_confirmations()
-            self.send_auto_payout()
-            self.check_unconfirmed_transactions()
+            try:
+                await self.update_confirmations()
+                await self.send_auto_payout()
+                await self.check_unconfirmed_transactions()
 
-            if os.getenv("PAYOUT_TYPE") == 'zcash':
-                self.shield_to_transparent_address()
+                if os.getenv("PAYOUT_TYPE") == 'zcash':
+                    await self.shield_to_transparent_address()
+            except CoinRPCConnectionException as e:
+                logger.error('Confirmation and payout sweep failed, %s' % e)
 
             # Refresh Coin data, Fee, Wallet address.
             self.database_ref.get_coin_info()
@@ -234,6 +280,9 @@ class BlockUpdater(object):
             if not repeat and block_hash != data['previousblockhash']:
                 return data['previousblockhash']
 
+        elif pushed:
+            self.block_template.merkle_update(data, notify=False)
+
         else:
             if self.merkle_interval <= 0:
                 logger.debug('Check new merkle')
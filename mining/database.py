@@ -1,12 +1,19 @@
 from sqlalchemy.engine import create_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import func, case
-from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy import func, select, and_
+from sqlalchemy.exc import InvalidRequestError, IntegrityError
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import os
-from mining.models import Block, Shares, Workers, Rewards, Wallets, Coins, Operations, Transactions, ShareStats, Users
+from mining.models import Block, Shares, Workers, Rewards, Wallets, Coins, Operations, Transactions, ShareStats, Users, ShareAggregates, \
+    ShareRollups
 from common.logger import get_logger
 from datetime import datetime, timedelta
 from common.email import send_worker_disconnect_email
+from mining.share_writer import ShareWriter
+from mining.worker_presence import WorkerPresence
+from mining.partitions import PartitionedTable
+from common.cache import TTLCache
 from copy import copy
 
 logger = get_logger(__name__)
@@ -14,15 +21,48 @@ logger = get_logger(__name__)
 
 class Database(object):
     def __init__(self):
-        postgres_url = 'postgresql://{}:{}@{}:{}/simple_mining'.format(os.getenv("POSTGRESQL_USER"), os.getenv("POSTGRESQL_PASSWORD"), os.getenv("POSTGRESQL_URL"),
-                                                                       os.getenv("POSTGRESQL_PORT"))
-        engine = create_engine(postgres_url, client_encoding='utf8')
+        if os.getenv("DATABASE_URL") is not None:
+            # Overrides POSTGRESQL_*, ex: sqlite file of the offline load test
+            self.engine = create_engine(os.getenv("DATABASE_URL"))
+        else:
+            postgres_url = 'postgresql://{}:{}@{}:{}/simple_mining'.format(os.getenv("POSTGRESQL_USER"), os.getenv("POSTGRESQL_PASSWORD"), os.getenv("POSTGRESQL_URL"),
+                                                                           os.getenv("POSTGRESQL_PORT"))
+            self.engine = create_engine(postgres_url, client_encoding='utf8')
 
-        session_maker = sessionmaker(bind=engine)
+        session_maker = sessionmaker(bind=self.engine)
         self.session = session_maker()
+        self.share_writer = ShareWriter(self.engine)
+        self.worker_presence = WorkerPresence(self.engine)
         self.coin = None
         self.fee = 2.0  # Default Fee is 2.0%
         self.pool_wallet = None
+        # username: mining wallet exists, connected_worker checks the wallet once per user instead of every connection
+        self.mining_wallet_cache = TTLCache(int(os.getenv("AUTH_CACHE_SIZE", 100000)), float(os.getenv("AUTH_CACHE_TTL", 600)))
+
+        # Retention drops partitions instead of deleting rows, see mining/partitions.py
+        self.partitioning = os.getenv("SHARE_PARTITIONING") == 'true'
+        self.share_partitions = PartitionedTable(Shares, 'block_height', int(os.getenv("SHARE_PARTITION_HEIGHTS", 100)), keep_column='share_result')
+        self.share_stat_partitions = PartitionedTable(ShareStats, 'timestamp', timedelta(days=1))
+        self.share_rollup_partitions = PartitionedTable(ShareRollups, 'minute', timedelta(days=1))
+        # Milliseconds a detach or drop waits for the coin table lock, share inserts queue behind it meanwhile
+        self.partition_lock_timeout = int(os.getenv("SHARE_PARTITION_LOCK_TIMEOUT", 500))
+        # Maintenance and retention deletes run off the event loop on their own connections, like the share writer
+        self.partition_executor = ThreadPoolExecutor(max_workers=1)
+        # Share partitions of the current height exist, until then maintenance runs before any share can be written
+        self.share_partitions_ready = False
+        self.pending_credits = {}  # (height, reward, username, hash): timer, found blocks of a Stratum worker
+
+    def before_fork(self):
+        # Pooled connections must not be shared with the forked Stratum workers
+        self.session.close()
+        self.engine.dispose()
+
+    def reset_after_fork(self):
+        # Called in a forked Stratum worker, the share writer thread does not survive fork
+        self.engine.dispose()
+        self.share_writer = ShareWriter(self.engine)
+        self.worker_presence = WorkerPresence(self.engine)
+        self.partition_executor = ThreadPoolExecutor(max_workers=1)
 
     def get_user(self, username):
         return self.session.query(Users).filter(Users.username == username).first()
@@ -137,10 +177,7 @@ class Database(object):
 
         # PPLNS Change
         # Only last 100 Block Share are valid
-        share_values = self.session.query(func.sum(Shares.pool_difficulty), Shares.username). \
-            filter(Shares.block_height > (height - int(os.getenv("PPLNS_LENGTH")))). \
-            filter(Shares.coin_name == os.getenv("COIN")).\
-            filter(Shares.pool_result.is_(True)).group_by(Shares.username).all()
+        share_values = self.get_pplns_share_values(height)
 
         fee_percent = self.fee / 100
         pool_reward = block.reward * fee_percent
@@ -172,59 +209,100 @@ class Database(object):
 
         self.session.commit()
 
-    def insert_accepted_share(self, username, worker, pool_result, share_result, block_height, share_difficulty, reward, target_diff, _hash=None):
-        try:
-            share = Shares()
-            share.coin_name = os.getenv("COIN")
-            share.username = username
-            share.worker = worker
-            share.pool_result = pool_result
-            share.share_result = share_result
-            share.block_height = block_height
-            share.share_difficulty = share_difficulty
-            share.pool_difficulty = target_diff
-
-            self.session.add(share)
+    def get_pplns_share_values(self, height):
+        # (sum of pool difficulty, username) of the PPLNS window, from the aggregates instead of every share
+        window = self.share_writer.pplns_window
+        if window is not None:
+            # Safe without a lock, the block share was flushed so no write is running
+            if not window.loaded:
+                with self.engine.connect() as conn:
+                    window.load(conn)
+            return window.get_share_values(height)
+
+        return self.session.query(func.sum(ShareAggregates.sum_pool_difficulty), ShareAggregates.username). \
+            filter(ShareAggregates.block_height > (height - int(os.getenv("PPLNS_LENGTH")))). \
+            filter(ShareAggregates.coin_name == os.getenv("COIN")). \
+            group_by(ShareAggregates.username).all()
+
+    def backfill_share_aggregates(self):
+        # One time after deploy, share_aggregate starts empty while shares still holds the current PPLNS window
+        coin_name = os.getenv("COIN")
+        if self.session.query(ShareAggregates.id).filter(ShareAggregates.coin_name == coin_name).first() is not None:
             self.session.commit()
+            return
+
+        height = self.session.query(func.max(Shares.block_height)).filter(Shares.coin_name == coin_name).scalar()
+        self.session.commit()
+        if height is None:
+            return
+
+        lowest = height - int(os.getenv("PPLNS_LENGTH"))
+        shares = Shares.__table__
+        query = select([shares.c.coin_name, shares.c.block_height, shares.c.username, func.sum(shares.c.pool_difficulty), func.count()]). \
+            where(shares.c.coin_name == coin_name). \
+            where(shares.c.pool_result.is_(True)). \
+            where(shares.c.block_height > lowest). \
+            group_by(shares.c.coin_name, shares.c.block_height, shares.c.username)
+        columns = ['coin_name', 'block_height', 'username', 'sum_pool_difficulty', 'share_count']
+        with self.engine.begin() as conn:
+            count = conn.execute(ShareAggregates.__table__.insert().from_select(columns, query)).rowcount
+        logger.info('Share aggregates backfilled from shares above height %d, %d rows' % (lowest, count))
 
-            if share_result:
-                if os.getenv("COIN") in ['shield', 'verge']:
-                    reward = reward * 100
+    def insert_accepted_share(self, username, worker, pool_result, share_result, block_height, share_difficulty, reward, target_diff, _hash=None):
+        share = {'coin_name': os.getenv("COIN"),
+                 'username': username,
+                 'worker': worker,
+                 'pool_result': pool_result,
+                 'share_result': share_result,
+                 'block_height': block_height,
+                 'share_difficulty': share_difficulty,
+                 'pool_difficulty': target_diff}
+
+        if not share_result:
+            self.share_writer.append(share)
+            return
+
+        # Block share, every buffered share must be in the database before PPLNS is calculated.
+        self.share_writer.append(share)
+        self.share_writer.flush_sync()
+
+        if os.getenv("COIN") in ['shield', 'verge']:
+            reward = reward * 100
+
+        if self.share_writer.pplns_window is None:
+            # Stratum workers, the other processes write their buffers within SHARE_FLUSH_INTERVAL, credit after that.
+            # A worker whose writes are behind by more than this delay is still missing from PPLNS.
+            delay = self.share_writer.flush_interval * 2 + 1
+            credit = (block_height, reward, username, _hash)
+            self.pending_credits[credit] = asyncio.get_event_loop().call_later(delay, self.credit_found_block, *credit)
+        else:
+            self.credit_found_block(block_height, reward, username, _hash)
 
-                self.found_block_by_pool(block_height, reward, username, _hash)
-            logger.debug('New Share Save to database %s' % share)
+    def credit_pending_blocks(self):
+        # At shutdown, found blocks waiting for the other workers are credited now
+        for credit, timer in list(self.pending_credits.items()):
+            timer.cancel()
+            self.credit_found_block(*credit)
 
+    def credit_found_block(self, height, reward, username, _hash):
+        self.pending_credits.pop((height, reward, username, _hash), None)
+        try:
+            self.found_block_by_pool(height, reward, username, _hash)
+            logger.debug('New Block %d credited, %s' % (height, _hash))
         except InvalidRequestError:
             self.session.rollback()
 
     def connected_worker(self, ip, username, worker_name, miner):
-        worker = Workers()
-        worker.name = worker_name
-        worker.username = username
-        worker.ip = ip
-        worker.miner = miner
-        worker.coin_name = os.getenv("COIN")
-
-        self.session.add(worker)
-        self.session.commit()
-        logger.debug('New Worker Save to database %s' % worker)
+        # Written with the next worker flush, not per connection
+        self.worker_presence.connect(ip, username, worker_name, miner)
+        logger.debug('New Worker %s.%s, %s' % (username, worker_name, ip))
 
-        self.get_mining_wallet(username)
+        if not self.mining_wallet_cache.get(username, False):
+            self.get_mining_wallet(username)
+            self.mining_wallet_cache.set(username, True)
 
     def disconnected_worker(self, username, worker_name, ip):
-        disconnect_worker = self.session.query(Workers).\
-            filter(Workers.username == username). \
-            filter(Workers.name == worker_name).\
-            filter(Workers.ip == ip).\
-            filter(Workers.disconnected.is_(None)).all()
-
-        if len(disconnect_worker) > 1:
-            logger.error('Duplicated worker?')
-
-        for worker in disconnect_worker:
-            worker.disconnected = datetime.now()
-
-        self.session.commit()
+        self.worker_presence.disconnect(username, worker_name, ip)
 
     def send_disconnected_worker_email(self):
         all_disconnected_workers = self.session.query(Workers, Users).join(Users).\
@@ -254,10 +332,12 @@ class Database(object):
         self.session.commit()
 
     def disconnect_all_worker(self):
-        for worker in self.session.query(Workers).\
-                filter(Workers.coin_name == os.getenv("COIN")).\
-                filter(Workers.disconnected.is_(None)).all():
-            worker.disconnected = datetime.now()
+        # One bulk update at shutdown, also closes rows left by workers of a killed process
+        self.worker_presence.close()
+        self.session.query(Workers).\
+            filter(Workers.coin_name == os.getenv("COIN")).\
+            filter(Workers.disconnected.is_(None)).\
+            update({Workers.disconnected: datetime.now()}, synchronize_session=False)
         self.session.commit()
 
     def get_coin_info(self):
@@ -277,12 +357,87 @@ class Database(object):
             filter(Block.confirmations < confirmation_count). \
             filter(Block.confirmations != -1).all()
 
+    def delete_in_batches(self, table, *conditions):
+        # Many short transactions instead of one large delete, keeps locks and vacuum work small.
+        # Runs on partition_executor with its own connections, the session belongs to the event loop.
+        batch_size = int(os.getenv("SHARE_DELETE_BATCH", 10000))
+        total = 0
+        try:
+            while True:
+                with self.engine.begin() as conn:
+                    ids = select([table.c.id]).where(and_(*conditions)).limit(batch_size)
+                    deleted = conn.execute(table.delete().where(table.c.id.in_(ids))).rowcount
+                total += deleted
+                if deleted < batch_size:
+                    break
+        except Exception as e:
+            # Retried with the next block
+            logger.error('Retention of %s failed, %s' % (table.name, e))
+        return total
+
+    def prepare_partitions(self):
+        # Converts the plain tables once, then creates the partitions of the last known height, today and the next days
+        if not self.partitioning:
+            return
+
+        # The session must not hold locks on the tables that are renamed
+        self.session.commit()
+        ahead = int(os.getenv("SHARE_PARTITION_AHEAD", 2))
+        with self.engine.begin() as conn:
+            for partitioned_table in [self.share_partitions, self.share_stat_partitions, self.share_rollup_partitions]:
+                partitioned_table.migrate(conn, ahead)
+                # Without the coin partition the first rows land in the root default partition and block it from being created
+                partitioned_table.ensure_coin(conn, os.getenv("COIN"))
+
+        height = self.session.query(func.max(Block.height)).filter(Block.coin_name == os.getenv("COIN")).scalar()
+        self.session.commit()
+        if height is not None:
+            self.share_partitions_ready = self.maintain_partitions(self.share_partitions, height, None)
+        self.maintain_time_partitions(datetime.utcnow() - timedelta(days=2), datetime.utcnow() - timedelta(days=int(os.getenv("SHARE_ROLLUP_RETENTION_DAYS", 2))))
+
+    def maintain_partitions(self, partitioned_table, value, drop_before):
+        # Creates the partitions of value and the next ones, then drops the ones before drop_before if it is set.
+        # Returns False when the partitions of value may not exist.
+        ahead = int(os.getenv("SHARE_PARTITION_AHEAD", 2))
+        try:
+            with self.engine.begin() as conn:
+                conn.execute("SET LOCAL lock_timeout = '%dms'" % self.partition_lock_timeout)
+                created = partitioned_table.ensure(conn, os.getenv("COIN"), value, ahead)
+        except Exception as e:
+            logger.error('Partition maintenance of %s failed, %s' % (partitioned_table.table, e))
+            return False
+
+        dropped = 0
+        if drop_before is not None:
+            try:
+                dropped = partitioned_table.drop_before(self.engine, os.getenv("COIN"), drop_before, self.partition_lock_timeout)
+            except Exception as e:
+                # Retried with the next block, a partition left detached is finished then
+                logger.error('Partition retention of %s failed, %s' % (partitioned_table.table, e))
+
+        if created or dropped:
+            logger.info('Partitions of %s, %d created, %d dropped' % (partitioned_table.table, created, dropped))
+        return True
+
+    def schedule_partition_maintenance(self, partitioned_table, value, drop_before):
+        self.partition_executor.submit(self.maintain_partitions, partitioned_table, value, drop_before)
+
+    def maintain_time_partitions(self, share_stat_before, share_rollup_before):
+        now = datetime.utcnow()
+        self.maintain_partitions(self.share_stat_partitions, now, share_stat_before)
+        self.maintain_partitions(self.share_rollup_partitions, now, share_rollup_before)
+
     def delete_old_infos(self, height):
-        self.session.query(Shares). \
-            filter(Shares.coin_name == os.getenv("COIN")). \
-            filter(Shares.block_height < height - int(os.getenv("PPLNS_LENGTH"))). \
-            filter(Shares.share_result.is_(False)). \
-            delete()
+        # Raw shares are only kept for payout auditing, metrics and PPLNS read the rollups and aggregates
+        retention = int(os.getenv("SHARE_RETENTION_HEIGHTS", os.getenv("PPLNS_LENGTH")))
+        if self.partitioning:
+            # Block shares are kept, they are moved to the default partition of the coin
+            if self.share_partitions_ready:
+                self.schedule_partition_maintenance(self.share_partitions, height, height - retention)
+            else:
+                # First block of a new database, the Stratum server starts after this
+                self.share_partitions_ready = self.maintain_partitions(self.share_partitions, height, height - retention)
+        self.partition_executor.submit(self.delete_old_rows, height, retention)
         self.session.query(Workers).\
             filter(Workers.coin_name == os.getenv("COIN")).\
             filter(Workers.disconnected.isnot(None)).\
@@ -290,6 +445,15 @@ class Database(object):
             delete()
         self.session.commit()
 
+    def delete_old_rows(self, height, retention):
+        if not self.partitioning:
+            shares = Shares.__table__
+            deleted = self.delete_in_batches(shares, shares.c.coin_name == os.getenv("COIN"), shares.c.block_height < height - retention,
+                                             shares.c.share_result.is_(False))
+            logger.debug('Deleted %d old shares' % deleted)
+        aggregates = ShareAggregates.__table__
+        self.delete_in_batches(aggregates, aggregates.c.coin_name == os.getenv("COIN"), aggregates.c.block_height <= height - int(os.getenv("PPLNS_LENGTH")))
+
     def get_unfinished_operations(self):
         return self.session.query(Operations).\
             filter(Operations.coin_name == os.getenv("COIN")).\
@@ -477,16 +641,17 @@ class Database(object):
             filter(Transactions.tx_id.isnot(None)).distinct()
 
     def update_metric_data(self, start, end):
+        # 1 minute rollups written with the shares, start and end are whole minutes
         metric_raws = self.session. \
-            query(func.sum(case([((Shares.pool_result.is_(True)), Shares.pool_difficulty)], else_=None)),
-                  func.count(case([((Shares.pool_result.is_(True)), Shares.username)], else_=None)),
-                  func.count(case([((Shares.pool_result.is_(False)), Shares.username)], else_=None)),
-                  Shares.username,
-                  Shares.worker). \
-            filter(Shares.timestamp >= start). \
-            filter(Shares.timestamp <= end). \
-            filter(Shares.coin_name == os.getenv("COIN")). \
-            group_by(Shares.worker).group_by(Shares.username).all()
+            query(func.sum(ShareRollups.sum_pool_difficulty),
+                  func.sum(ShareRollups.accepted_share_count),
+                  func.sum(ShareRollups.rejected_share_count),
+                  ShareRollups.username,
+                  ShareRollups.worker). \
+            filter(ShareRollups.minute >= start). \
+            filter(ShareRollups.minute < end). \
+            filter(ShareRollups.coin_name == os.getenv("COIN")). \
+            group_by(ShareRollups.worker).group_by(ShareRollups.username).all()
 
         total_sum = 0
         for metric_raw in metric_raws:
@@ -510,10 +675,12 @@ class Database(object):
 
         # Remove Old metric
         one_day_ago = datetime.utcnow() - timedelta(days=2)
-        self.session.query(ShareStats).\
-            filter(ShareStats.coin_name == os.getenv("COIN")).\
-            filter(ShareStats.timestamp < one_day_ago).\
-            delete()
+        rollup_retention = datetime.utcnow() - timedelta(days=int(os.getenv("SHARE_ROLLUP_RETENTION_DAYS", 2)))
+        if not self.partitioning:
+            self.session.query(ShareStats).\
+                filter(ShareStats.coin_name == os.getenv("COIN")).\
+                filter(ShareStats.timestamp < one_day_ago).\
+                delete()
 
         self.session.query(Coins). \
             filter(Coins.name == os.getenv("COIN")). \
@@ -521,7 +688,21 @@ class Database(object):
 
         self.session.commit()
 
+        if self.partitioning:
+            self.partition_executor.submit(self.maintain_time_partitions, one_day_ago, rollup_retention)
+        else:
+            rollups = ShareRollups.__table__
+            self.partition_executor.submit(self.delete_in_batches, rollups, rollups.c.coin_name == os.getenv("COIN"), rollups.c.minute < rollup_retention)
+
     def get_or_create_address_user(self, address):
+        # Stratum worker processes can create the same address user at the same time, the one that loses reads the rows again
+        try:
+            self.add_address_user(address)
+        except IntegrityError:
+            self.session.rollback()
+            self.add_address_user(address)
+
+    def add_address_user(self, address):
         _user = self.session.query(Users).filter(Users.username == address).first()
         if _user is None:
             _user = Users()
@@ -0,0 +1,129 @@
+from common import hash_util, bitcoin_util
+import simplejson
+import binascii
+import struct
+import os
+
+RESERVED_FIELD = bytes(32)
+
+
+class Job(object):
+    # Immutable snapshot of a block template, built once per template or merkle change and shared by every session.
+    __slots__ = ('job_id', 'version', 'prev_hash', 'prev_hash_reverse_hex', 'merkle_root_reverse_hex', 'n_bits', 'n_bits_reverse_hex', 'curtime',
+                 'difficulty', 'block_height', 'pool_reward', 'tx_count', 'transactions_data', 'coinbase_tx', 'coinbase_prefix', 'coinbase_suffix',
+                 'merkle_branch', 'merkle_tree', 'extranonce_placeholder', 'header_prefix', 'merkle_root_bytes', 'n_bits_bytes',
+                 'notify_params', 'notify_message')
+
+    def __init__(self, job_id, block_template):
+        values = {
+            'job_id': job_id,
+            'version': block_template.version,
+            'prev_hash': block_template.prev_hash,
+            'prev_hash_reverse_hex': block_template.prev_hash_reverse_hex,
+            'merkle_root_reverse_hex': block_template.merkle_root_reverse_hex,
+            'n_bits': block_template.n_bits,
+            'n_bits_reverse_hex': block_template.n_bits_reverse_hex,
+            'curtime': block_template.curtime,
+            'difficulty': block_template.difficulty,
+            'block_height': block_template.block_height,
+            'pool_reward': block_template.pool_reward,
+            'tx_count': block_template.tx_count,
+            # Hex of the template decoded once here, shares and blocks are built from bytes
+            'transactions_data': b''.join([binascii.unhexlify(transaction['data']) for transaction in block_template.transactions]),
+            'coinbase_tx': block_template.coinbase_tx,
+            'coinbase_prefix': block_template.coinbase_prefix,
+            'coinbase_suffix': block_template.coinbase_suffix,
+            'merkle_branch': tuple(block_template.merkle_branch),
+            'merkle_tree': block_template.merkle_tree,
+            'extranonce_placeholder': block_template.extranonce_placeholder,
+            'header_prefix': struct.pack("<I", block_template.version) + binascii.unhexlify(block_template.prev_hash_reverse_hex),
+            'merkle_root_bytes': binascii.unhexlify(block_template.merkle_root_reverse_hex),
+            'n_bits_bytes': binascii.unhexlify(block_template.n_bits_reverse_hex),
+        }
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+
+        object.__setattr__(self, 'notify_params', self.build_notify_params())
+        # Encoded once, written as is to every connection
+        notify_message = simplejson.dumps({'id': None, 'method': 'mining.notify', 'params': self.notify_params})
+        object.__setattr__(self, 'notify_message', ('%s\n' % notify_message).encode())
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Job is immutable')
+
+    def __delattr__(self, key):
+        raise AttributeError('Job is immutable')
+
+    def __getstate__(self):
+        # Pickled by the template owner and sent to the Stratum worker processes
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            object.__setattr__(self, key, value)
+
+    def build_notify_params(self):
+        if os.getenv("COIN_TYPE") == 'zcash':
+            version = binascii.hexlify(struct.pack("<I", self.version)).decode()
+            reserved = '0000000000000000000000000000000000000000000000000000000000000000'
+            params = [self.job_id, version, self.prev_hash_reverse_hex, self.merkle_root_reverse_hex, reserved, self.curtime, self.n_bits_reverse_hex, True]
+            if os.getenv("COIN_ALGORITHM") == 'zhash':
+                if os.getenv("COIN") == 'bitcoin-gold':
+                    pers = 'BgoldPoW'
+                elif os.getenv("COIN") == 'bitcoinz':
+                    pers = 'BitcoinZ'
+                elif os.getenv("COIN") == 'classic-bitcoin':
+                    pers = 'CbtcPoW'
+                elif os.getenv("COIN") == 'zelcash':
+                    pers = 'ZelProof'
+                else:
+                    raise Exception('invalid coin type')
+                params += [False, pers]
+            return tuple(params)
+
+        elif os.getenv("COIN_TYPE") == 'bitcoin':
+            version = binascii.hexlify(struct.pack(">I", self.version)).decode()
+            prevhash = bitcoin_util.reverse_hash(self.prev_hash.encode()).decode()
+            coinbase_1 = binascii.hexlify(self.coinbase_prefix).decode()
+            coinbase_2 = binascii.hexlify(self.coinbase_suffix).decode()
+            time = hash_util.hex_to_reverse_hex(self.curtime)
+            return self.job_id, prevhash, coinbase_1, coinbase_2, self.merkle_branch, version, self.n_bits, time, True
+
+        raise Exception('invalid coin type')
+
+    def build_block_header(self, n_time: bytes, nonce: bytes, merkle_root: bytes = None):
+        # Binary fields in header byte order
+        if merkle_root is None:
+            merkle_root = self.merkle_root_bytes
+
+        if os.getenv("COIN_TYPE") == 'zcash':
+            merkle_root += RESERVED_FIELD
+
+        return self.header_prefix + merkle_root + n_time + self.n_bits_bytes + nonce
+
+    def serialize_block_header(self, n_time: bytes, nonce: bytes, merkle_root=None):
+        # Hex fields, kept for callers of the hex API
+        if merkle_root is not None:
+            merkle_root = binascii.unhexlify(merkle_root)
+
+        return self.build_block_header(binascii.unhexlify(n_time), binascii.unhexlify(nonce), merkle_root)
+
+    def serialize_block(self, header, soln=None, coinbase=None):
+        tx_count = format(self.tx_count, 'x')
+
+        if abs(len(tx_count) % 2) == 1:
+            tx_count = '0' + tx_count
+
+        if self.tx_count <= 0x7f:
+            var_int = binascii.unhexlify(tx_count)
+        else:
+            var_int = binascii.unhexlify('FD') + binascii.unhexlify(tx_count)
+
+        if soln is not None:
+            buf = header + soln + var_int + self.coinbase_tx
+        elif coinbase is not None:
+            buf = header + var_int + coinbase
+        else:
+            raise Exception('soln or coinbase required')
+
+        return buf + self.transactions_data
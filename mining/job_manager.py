@@ -2,18 +2,25 @@ import struct
 import binascii
 import os
 from collections import OrderedDict
-from copy import copy
+from mining.job import Job
+from common.generators import NonceGenerator
 
 
 class JobManager(object):
     def __init__(self):
         self.nonces = {}
-        self.jobs = {}
-        self.block_templates = OrderedDict()
+        self.block_templates = OrderedDict()  # job_id: Job, oldest first
+        self.retention = int(os.getenv("JOB_RETENTION", 4))
+        self.stale_jobs = OrderedDict()  # job_id of evicted jobs, to tell stale from unknown
+        self.stale_jobs_size = int(os.getenv("JOB_STALE_HISTORY", 256))
+        self.stale_reject_count = 0
+        self.not_found_reject_count = 0
+        self.current_job = None
         self.job_counter = 0
+        self.job_sequence = 0  # Jobs added so far, never wraps like job_counter
         self.size = struct.calcsize('>L')
-        self.connections = set()
-        self.submits = set()
+        self.nonce_generator = NonceGenerator()
+        self.submits = {}  # job_id: set of 64 bit hashes of packed (nonce_1, nonce_2, nonce, time)
 
     def get_nonce_size(self):
         # Return expected size of generated extranonce in bytes
@@ -22,40 +29,100 @@ class JobManager(object):
     def get_nonce_from_session_id(self, session_id):
         return self.nonces[session_id]
 
+    def set_instance_id(self, instance_id):
+        # Each Stratum worker process draws extranonce1 from its own high bits range
+        self.nonce_generator = NonceGenerator(instance_id)
+
     def get_new_nonce(self, session_id):
-        new_nonce = struct.unpack("<L", os.urandom(4))[0]
-        nonce = struct.pack('>L', new_nonce)
-        nonce = binascii.hexlify(nonce)
+        if session_id in self.nonces:
+            # mining.subscribe again on the same connection
+            self.release_nonce(session_id)
+
+        nonce = binascii.hexlify(self.nonce_generator.get_new_nonce(self.get_oldest_job_sequence()))
         self.nonces[session_id] = nonce
 
         return nonce
 
-    def get_new_job_id(self, session_id, block_template):
+    def release_nonce(self, session_id):
+        # Called when the connection is lost, the extranonce1 goes back to the free list
+        nonce = self.nonces.pop(session_id, None)
+        if nonce is not None:
+            self.nonce_generator.release(binascii.unhexlify(nonce), self.job_sequence)
+
+    def new_job(self, block_template) -> Job:
         self.job_counter += 1
         if self.job_counter % 0xffff == 0:
             self.job_counter = 1
         job_id = "%x" % self.job_counter
-        self.jobs[session_id] = job_id
-        self.block_templates[job_id] = copy(block_template)
+        return self.add_job(Job(job_id, block_template))
 
-        if len(self.block_templates) > len(self.connections) * 3:
-            self.block_templates.popitem(last=False)
+    def add_job(self, job: Job) -> Job:
+        # Stratum worker processes add the jobs built by the template owner
+        job_id = job.job_id
 
-        return job_id
+        # Work on the previous block can never be a block, drop every job of it
+        if self.current_job is not None and self.current_job.prev_hash != job.prev_hash:
+            while self.block_templates:
+                self.evict_oldest_job()
 
-    def get_block_template(self, job_id):
-        if job_id in self.block_templates:
-            return self.block_templates[job_id]
-        else:
+        self.stale_jobs.pop(job_id, None)
+        self.job_sequence += 1
+        self.block_templates[job_id] = job
+        self.submits[job_id] = set()
+        self.current_job = job
+
+        # The last JOB_RETENTION templates plus the current one, whatever the connection count is
+        while len(self.block_templates) > self.retention + 1:
+            self.evict_oldest_job()
+
+        return job
+
+    def evict_oldest_job(self):
+        job_id, _ = self.block_templates.popitem(last=False)
+        self.submits.pop(job_id, None)
+        self.stale_jobs[job_id] = True
+        if len(self.stale_jobs) > self.stale_jobs_size:
+            self.stale_jobs.popitem(last=False)
+
+    def get_current_job(self, block_template) -> Job:
+        if self.current_job is None:
+            if block_template is None:
+                # Stratum worker before the first job from the template owner
+                return None
+            self.new_job(block_template)
+
+        return self.current_job
+
+    def get_oldest_job_sequence(self):
+        # Jobs are added in order and evicted oldest first, so the retained ones are the last len(block_templates)
+        if not self.block_templates:
             return None
+        return self.job_sequence - len(self.block_templates) + 1
+
+    def get_job(self, job_id) -> Job:
+        return self.block_templates.get(job_id)
+
+    def is_stale_job(self, job_id) -> bool:
+        return job_id in self.stale_jobs
 
-    def register_submit(self, nonce_1, nonce_2, nonce, time) -> bool:
-        submit = (nonce_1, nonce_2, nonce, time)
-        if submit in self.submits:
+    def get_stats(self):
+        stats = {'jobs': len(self.block_templates),
+                 'stale_reject_count': self.stale_reject_count,
+                 'not_found_reject_count': self.not_found_reject_count}
+        self.stale_reject_count = 0
+        self.not_found_reject_count = 0
+        return stats
+
+    def register_submit(self, job_id, nonce_1, nonce_2, nonce, time) -> bool:
+        submits = self.submits.get(job_id)
+        if submits is None:
+            # Evicted job, a share is never accepted without the duplicate check
+            return False
+
+        # 64 bit key instead of a tuple of hex strings, a collision in one job is practically impossible
+        submit = hash(binascii.unhexlify(nonce_1) + binascii.unhexlify(nonce_2) + binascii.unhexlify(nonce) + binascii.unhexlify(time))
+        if submit in submits:
             return False
         else:
-            self.submits.add(submit)
+            submits.add(submit)
             return True
-
-    def clear_submits(self):
-        self.submits.clear()
@@ -1,4 +1,5 @@
 from mining.database import Database
+from mining.interfaces import Interfaces
 from mining.models import Block, Rewards, Transactions, Wallets, func
 import asyncio
 from datetime import datetime, timedelta
@@ -8,12 +9,23 @@ import os
 logger = get_logger(__name__)
 
 
+def log_stratum_stats(prefix=''):
+    # Stats of the Stratum connections of this process
+    logger.info('%sShare writer stats %s' % (prefix, Interfaces.database.share_writer.get_stats()))
+    logger.info('%sJob stats %s' % (prefix, Interfaces.job_manager.get_stats()))
+    user_cache = getattr(Interfaces.stratum_handler, 'user_cache', None)
+    if user_cache is not None:
+        logger.info('%sAuthorize cache stats %s' % (prefix, user_cache.get_stats()))
+
+
 class MetricGenerator(object):
     def __init__(self, database: Database):
         self.database_ref = database
         now = datetime.now()
         self.when = now.replace(minute=now.minute - (now.minute % 10), second=0, microsecond=0)
         asyncio.get_event_loop().call_later(self.ten_minute_later(), self.generate_metric)
+        self.database_ref.prepare_partitions()
+        self.database_ref.backfill_share_aggregates()
         self.synchronize_database()
         # self.adjustment_balances()
 
@@ -29,6 +41,9 @@ class MetricGenerator(object):
         end = datetime.utcnow().replace(second=0, microsecond=0)
         start = end - timedelta(minutes=10)
         logger.info('Generate metric, %s to %s' % (start, end))
+        if int(os.getenv("STRATUM_WORKERS", 0)) == 0:
+            # The template owner of STRATUM_WORKERS has no Stratum connections, the workers log their own
+            log_stratum_stats()
         self.database_ref.update_metric_data(start, end)
         self.database_ref.send_disconnected_worker_email()
 
@@ -44,7 +59,7 @@ class MetricGenerator(object):
                 update({Rewards.reward: 0})
             uncommon_orphan_block.reward = 0
 
-    def adjustment_balances(self):
+    async def adjustment_balances(self):
         from mining.interfaces import Interfaces
         import settings
 
@@ -64,7 +79,7 @@ class MetricGenerator(object):
             filter(Wallets.coin_name == settings.COIN). \
             filter(Wallets.type == 'mining').all()
 
-        confirmed_balance = coin_rpc.get_confirmed_balance()
+        confirmed_balance = await coin_rpc.get_confirmed_balance()
 
         merged_tuple = []
         total_rewards = 0
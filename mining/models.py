@@ -1,6 +1,6 @@
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, DateTime, func
+from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, DateTime, UniqueConstraint, func
 import datetime
 
 Base = declarative_base()
@@ -70,6 +70,46 @@ class ShareStats(Base):
     timestamp = Column(DateTime, default=datetime.datetime.utcnow, index=True)
 
 
+class ShareAggregates(Base):
+    # Accepted pool difficulty per height and user, upserted with every share batch for PPLNS
+    __tablename__ = 'share_aggregate'
+    __table_args__ = (UniqueConstraint('coin_name', 'block_height', 'username'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    coin_name = Column(String, ForeignKey('coins.name'), index=True)
+    coin = relationship("Coins")
+    block_height = Column(Integer, index=True)
+    username = Column(String, ForeignKey('users.username'))
+    user = relationship("Users")
+    sum_pool_difficulty = Column(Float, default=0)
+    share_count = Column(Integer, default=0)
+
+    def __str__(self):
+        return '<ShareAggregates coin_name: %s, height: %s, username: %s, sum_pool_difficulty: %s, share_count: %s>' % \
+               (self.coin_name, self.block_height, self.username, self.sum_pool_difficulty, self.share_count)
+
+
+class ShareRollups(Base):
+    # Shares per minute and worker, upserted with every share batch, metrics read this instead of shares
+    __tablename__ = 'share_rollup'
+    __table_args__ = (UniqueConstraint('coin_name', 'minute', 'username', 'worker'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    coin_name = Column(String, ForeignKey('coins.name'), index=True)
+    coin = relationship("Coins")
+    minute = Column(DateTime, index=True)
+    username = Column(String, ForeignKey('users.username'))
+    user = relationship("Users")
+    worker = Column(String, nullable=False)
+    sum_pool_difficulty = Column(Float, default=0)
+    accepted_share_count = Column(Integer, default=0)
+    rejected_share_count = Column(Integer, default=0)
+
+    def __str__(self):
+        return '<ShareRollups coin_name: %s, minute: %s, username: %s, worker: %s, sum_pool_difficulty: %s, accepted: %s, rejected: %s>' % \
+               (self.coin_name, self.minute, self.username, self.worker, self.sum_pool_difficulty, self.accepted_share_count, self.rejected_share_count)
+
+
 class Block(Base):
     __tablename__ = 'block'
 
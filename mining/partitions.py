@@ -0,0 +1,179 @@
+from sqlalchemy import text, UniqueConstraint
+from common.logger import get_logger
+from datetime import datetime, timedelta
+import re
+
+logger = get_logger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class PartitionedTable(object):
+    # Postgres declarative partitioning of a table shared by every coin:
+    #   <table>                 PARTITION BY LIST (coin_name)
+    #   <table>_<coin>          PARTITION BY RANGE (column)
+    #   <table>_<coin>_<start>  one range of size heights, or size days when size is a timedelta
+    #   <table>_<coin>_default  rows no range partition takes, inserts never fail when maintenance is behind
+    # Retention drops whole range partitions instead of deleting rows.
+    def __init__(self, model, column, size, keep_column=None):
+        self.model = model
+        self.table = model.__tablename__
+        self.column = column
+        self.size = size
+        # Rows with keep_column true survive a drop, they are moved to the <table>_<coin>_default partition
+        self.keep_column = keep_column
+
+    def is_time(self):
+        return isinstance(self.size, timedelta)
+
+    def range_start(self, value):
+        if self.is_time():
+            days = (value - EPOCH).days
+            return EPOCH + timedelta(days=days - days % self.size.days)
+        return value - value % self.size
+
+    def literal(self, value):
+        if self.is_time():
+            return "'%s'" % value.strftime('%Y-%m-%d %H:%M:%S')
+        return '%d' % value
+
+    def coin_table(self, coin_name):
+        return '%s_%s' % (self.table, re.sub('[^a-z0-9]', '_', coin_name.lower()))
+
+    def range_table(self, coin_name, start):
+        suffix = start.strftime('%Y%m%d') if self.is_time() else '%d' % start
+        return '%s_%s' % (self.coin_table(coin_name), suffix)
+
+    def is_partitioned(self, conn):
+        return conn.execute(text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:name)"), name=self.table).first() is not None
+
+    def get_range_partitions(self, conn, coin_name):
+        # {start: table name} of the existing range partitions of a coin
+        coin_table = self.coin_table(coin_name)
+        rows = conn.execute(text("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                                 "WHERE i.inhparent = to_regclass(:name)"), name=coin_table)
+        partitions = {}
+        for row in rows:
+            suffix = row[0][len(coin_table) + 1:]
+            if not suffix.isdigit():
+                continue
+            start = datetime.strptime(suffix, '%Y%m%d') if self.is_time() else int(suffix)
+            partitions[start] = row[0]
+        return partitions
+
+    def ensure_coin(self, conn, coin_name):
+        coin_table = self.coin_table(coin_name)
+        conn.execute(text('CREATE TABLE IF NOT EXISTS "%s" PARTITION OF "%s" FOR VALUES IN (:coin_name) PARTITION BY RANGE ("%s")' %
+                          (coin_table, self.table, self.column)).bindparams(coin_name=coin_name))
+        conn.execute(text('CREATE TABLE IF NOT EXISTS "%s_default" PARTITION OF "%s" DEFAULT' % (coin_table, coin_table)))
+
+    def ensure(self, conn, coin_name, value, ahead):
+        # Range of value and the ahead next ranges, created before any row needs them
+        self.ensure_coin(conn, coin_name)
+        partitions = self.get_range_partitions(conn, coin_name)
+        start = self.range_start(value)
+        created = 0
+        for _ in range(ahead + 1):
+            end = start + self.size
+            if start not in partitions:
+                self.create_range(conn, coin_name, start, end)
+                created += 1
+            start = end
+        return created
+
+    def create_range(self, conn, coin_name, start, end):
+        coin_table = self.coin_table(coin_name)
+        name = self.range_table(coin_name, start)
+        condition = '"%s" >= %s AND "%s" < %s' % (self.column, self.literal(start), self.column, self.literal(end))
+        if conn.execute(text('SELECT 1 FROM "%s_default" WHERE %s LIMIT 1' % (coin_table, condition))).first() is None:
+            conn.execute(text('CREATE TABLE "%s" PARTITION OF "%s" FOR VALUES FROM (%s) TO (%s)' % (name, coin_table, self.literal(start), self.literal(end))))
+            return
+
+        # Rows of this range were written to the default partition while maintenance was behind, the range can not be created over them
+        logger.warning('Move rows of %s from the default partition' % name)
+        conn.execute(text('CREATE TABLE "%s" (LIKE "%s" INCLUDING DEFAULTS)' % (name, coin_table)))
+        conn.execute(text('WITH moved AS (DELETE FROM "%s_default" WHERE %s RETURNING *) INSERT INTO "%s" SELECT * FROM moved' %
+                          (coin_table, condition, name)))
+        conn.execute(text('ALTER TABLE "%s" ATTACH PARTITION "%s" FOR VALUES FROM (%s) TO (%s)' % (coin_table, name, self.literal(start), self.literal(end))))
+
+    def drop_before(self, engine, coin_name, value, lock_timeout):
+        # Drops the range partitions that end at or before value. Detach and drop lock the coin table, so each one is its own
+        # short transaction and the parent is never locked while rows are copied.
+        with engine.connect() as conn:
+            partitions = self.get_range_partitions(conn, coin_name)
+
+        dropped = 0
+        for start, name in sorted(partitions.items()):
+            if start + self.size > value:
+                break
+
+            with engine.begin() as conn:
+                conn.execute(text("SET LOCAL lock_timeout = '%dms'" % lock_timeout))
+                if self.keep_column is not None:
+                    conn.execute(text('ALTER TABLE "%s" DETACH PARTITION "%s"' % (self.coin_table(coin_name), name)))
+                    conn.execute(text('ALTER TABLE "%s" RENAME TO "%s_detached"' % (name, name)))
+                else:
+                    conn.execute(text('DROP TABLE "%s"' % name))
+            dropped += 1
+
+        if self.keep_column is not None:
+            self.drop_detached(engine, coin_name)
+        return dropped
+
+    def drop_detached(self, engine, coin_name):
+        # Kept rows go back through the parent to the <table>_<coin>_default partition, a plain insert that never blocks the share writer.
+        # Also finishes the tables left by a failed earlier run.
+        with engine.connect() as conn:
+            rows = conn.execute(text("SELECT relname FROM pg_class WHERE relkind = 'r' AND relname ~ :pattern"),
+                                pattern='^%s_[0-9]+_detached$' % self.coin_table(coin_name)).fetchall()
+        for row in rows:
+            with engine.begin() as conn:
+                conn.execute(text('INSERT INTO "%s" SELECT * FROM "%s" WHERE "%s" IS TRUE' % (self.table, row[0], self.keep_column)))
+                conn.execute(text('DROP TABLE "%s"' % row[0]))
+
+    def migrate(self, conn, ahead):
+        # One time conversion of the plain table created from mining/models.py, run in a single transaction
+        if self.is_partitioned(conn):
+            return False
+
+        old_table = '%s_unpartitioned' % self.table
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence(:name, 'id')"), name=self.table).scalar()
+
+        conn.execute(text('ALTER TABLE "%s" RENAME TO "%s"' % (self.table, old_table)))
+        conn.execute(text('CREATE TABLE "%s" (LIKE "%s" INCLUDING DEFAULTS) PARTITION BY LIST (coin_name)' % (self.table, old_table)))
+        conn.execute(text('CREATE TABLE "%s_default" PARTITION OF "%s" DEFAULT' % (self.table, self.table)))
+
+        ranges = conn.execute(text('SELECT coin_name, MIN("%s"), MAX("%s") FROM "%s" WHERE coin_name IS NOT NULL GROUP BY coin_name' %
+                                   (self.column, self.column, old_table))).fetchall()
+        for coin_name, lowest, highest in ranges:
+            if lowest is None:
+                self.ensure_coin(conn, coin_name)
+                continue
+            count = 0
+            start = self.range_start(lowest)
+            while start <= highest:
+                count += 1
+                start += self.size
+            self.ensure(conn, coin_name, lowest, count + ahead - 1)
+
+        conn.execute(text('INSERT INTO "%s" SELECT * FROM "%s"' % (self.table, old_table)))
+        if sequence is not None:
+            conn.execute(text('ALTER SEQUENCE %s OWNED BY "%s".id' % (sequence, self.table)))
+        conn.execute(text('DROP TABLE "%s"' % old_table))
+
+        # Constraint and index names are free once the old table is dropped, the partition keys must be part of the primary key
+        conn.execute(text('ALTER TABLE "%s" ADD PRIMARY KEY (id, coin_name, "%s")' % (self.table, self.column)))
+
+        for column in self.model.__table__.columns:
+            if column.index:
+                conn.execute(text('CREATE INDEX "ix_%s_%s" ON "%s" ("%s")' % (self.table, column.name, self.table, column.name)))
+        for constraint in self.model.__table__.constraints:
+            if isinstance(constraint, UniqueConstraint):
+                # Upsert targets, they already contain coin_name and the range column
+                conn.execute(text('ALTER TABLE "%s" ADD UNIQUE (%s)' % (self.table, ', '.join('"%s"' % column.name for column in constraint.columns))))
+        for foreign_key in self.model.__table__.foreign_keys:
+            conn.execute(text('ALTER TABLE "%s" ADD FOREIGN KEY ("%s") REFERENCES "%s" ("%s")' %
+                              (self.table, foreign_key.parent.name, foreign_key.column.table.name, foreign_key.column.name)))
+
+        logger.info('Table %s is partitioned, %d coins' % (self.table, len(ranges)))
+        return True
@@ -0,0 +1,67 @@
+from sqlalchemy import select
+from mining.models import ShareAggregates
+from mining.upsert import upsert_add
+import os
+
+
+def aggregate_shares(batch):
+    # (block_height, username): [pool difficulty, share count] of the accepted shares in a batch
+    aggregates = {}
+    for share in batch:
+        if not share['pool_result']:
+            continue
+
+        key = (share['block_height'], share['username'])
+        aggregate = aggregates.get(key)
+        if aggregate is None:
+            aggregates[key] = [share['pool_difficulty'], 1]
+        else:
+            aggregate[0] += share['pool_difficulty']
+            aggregate[1] += 1
+
+    return aggregates
+
+
+def upsert_aggregates(conn, aggregates):
+    coin_name = os.getenv("COIN")
+    rows = [{'coin_name': coin_name, 'block_height': height, 'username': username, 'sum_pool_difficulty': difficulty, 'share_count': count}
+            for (height, username), (difficulty, count) in aggregates.items()]
+    upsert_add(conn, ShareAggregates.__table__, ('coin_name', 'block_height', 'username'), rows)
+
+
+class PPLNSWindow(object):
+    # In memory copy of share_aggregate for the last PPLNS_LENGTH heights.
+    # Only valid when this process writes every share, with Stratum workers the table is read instead.
+    def __init__(self):
+        self.length = int(os.getenv("PPLNS_LENGTH"))
+        self.heights = {}
+        self.loaded = False
+
+    def load(self, conn):
+        table = ShareAggregates.__table__
+        rows = conn.execute(select([table.c.block_height, table.c.username, table.c.sum_pool_difficulty, table.c.share_count]).
+                            where(table.c.coin_name == os.getenv("COIN")))
+        self.heights = {}
+        self.add({(row[0], row[1]): [row[2], row[3]] for row in rows})
+        self.loaded = True
+
+    def add(self, aggregates):
+        for (height, username), (difficulty, _) in aggregates.items():
+            users = self.heights.setdefault(height, {})
+            users[username] = users.get(username, 0) + difficulty
+
+        if self.heights:
+            lowest = max(self.heights) - self.length
+            for height in [height for height in self.heights if height <= lowest]:
+                del self.heights[height]
+
+    def get_share_values(self, height):
+        # Same rows as SUM(pool_difficulty) GROUP BY username over the window, O(users)
+        totals = {}
+        for block_height, users in self.heights.items():
+            if block_height <= height - self.length:
+                continue
+            for username, difficulty in users.items():
+                totals[username] = totals.get(username, 0) + difficulty
+
+        return [(difficulty, username) for username, difficulty in totals.items()]
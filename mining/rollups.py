@@ -0,0 +1,32 @@
+from mining.models import ShareRollups
+from mining.upsert import upsert_add
+import os
+
+DEFAULT_WORKER = 'default'
+
+
+def rollup_shares(batch):
+    # (minute, username, worker): [accepted pool difficulty, accepted count, rejected count] of a batch
+    rollups = {}
+    for share in batch:
+        # NULL is never equal to NULL in the unique key, shares without a worker name are kept under the worker name authorize uses
+        key = (share['timestamp'].replace(second=0, microsecond=0), share['username'], share['worker'] or DEFAULT_WORKER)
+        rollup = rollups.get(key)
+        if rollup is None:
+            rollup = rollups[key] = [0.0, 0, 0]
+
+        if share['pool_result']:
+            rollup[0] += share['pool_difficulty']
+            rollup[1] += 1
+        else:
+            rollup[2] += 1
+
+    return rollups
+
+
+def upsert_rollups(conn, rollups):
+    coin_name = os.getenv("COIN")
+    rows = [{'coin_name': coin_name, 'minute': minute, 'username': username, 'worker': worker,
+             'sum_pool_difficulty': difficulty, 'accepted_share_count': accepted, 'rejected_share_count': rejected}
+            for (minute, username, worker), (difficulty, accepted, rejected) in rollups.items()]
+    upsert_add(conn, ShareRollups.__table__, ('coin_name', 'minute', 'username', 'worker'), rows)
@@ -0,0 +1,196 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from sqlalchemy.exc import IntegrityError, DataError
+from collections import deque
+from datetime import datetime
+from mining.models import Shares
+from mining.pplns import PPLNSWindow, aggregate_shares, upsert_aggregates
+from mining.rollups import rollup_shares, upsert_rollups
+from common.logger import get_logger
+import asyncio
+import time
+import os
+
+logger = get_logger(__name__)
+
+
+class ShareWriter(object):
+    # Buffers share rows in memory and writes them with a single executemany per batch.
+    # Writes run on a dedicated thread with their own connection, not on the Database session.
+    def __init__(self, engine):
+        self.engine = engine
+        self.buffer = deque()
+        self.batch_size = int(os.getenv("SHARE_FLUSH_SIZE", 500))
+        self.flush_interval = float(os.getenv("SHARE_FLUSH_INTERVAL", 500)) / 1000
+        self.max_buffer_size = int(os.getenv("SHARE_BUFFER_SIZE", 100000))
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.flushing = None  # asyncio future of flushing_write
+        self.flushing_write = None
+        self.flushing_batch = None
+        self.timer = None
+        # With Stratum workers each process writes only its own shares, PPLNS reads share_aggregate
+        self.pplns_window = PPLNSWindow() if int(os.getenv("STRATUM_WORKERS", 0)) == 0 else None
+
+        self.flush_count = 0
+        self.written_count = 0
+        self.rejected_count = 0
+        self.dropped_count = 0
+        self.logged_dropped_count = 0
+        self.max_queue_depth = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    def append(self, row: dict):
+        if len(self.buffer) >= self.max_buffer_size:
+            # The writer can not keep up, new shares are dropped until the buffer drains. The event loop never waits for the database.
+            if self.dropped_count == self.logged_dropped_count:
+                logger.warning('Share buffer is full (%d), dropping shares' % len(self.buffer))
+            self.dropped_count += 1
+            self.flush()
+            return False
+
+        if self.dropped_count != self.logged_dropped_count:
+            logger.warning('Share buffer has room again, %d shares dropped' % (self.dropped_count - self.logged_dropped_count))
+            self.logged_dropped_count = self.dropped_count
+
+        row['timestamp'] = datetime.utcnow()
+        self.buffer.append(row)
+
+        queue_depth = len(self.buffer)
+        if queue_depth > self.max_queue_depth:
+            self.max_queue_depth = queue_depth
+
+        if queue_depth >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+        return True
+
+    def take_batch(self):
+        batch = []
+        while self.buffer and len(batch) < self.batch_size:
+            batch.append(self.buffer.popleft())
+        return batch
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if self.flushing is not None or not self.buffer:
+            return
+
+        batch = self.take_batch()
+        self.flushing_write = self.executor.submit(self.write_batch, batch)
+        self.flushing_batch = batch
+        self.flushing = asyncio.wrap_future(self.flushing_write)
+        self.flushing.add_done_callback(lambda future: self.flush_done(future, batch))
+
+    def flush_done(self, future, batch):
+        if future is not self.flushing:
+            # flush_sync already waited for this write and kept its batch if it failed
+            if not future.cancelled():
+                future.exception()
+            return
+
+        self.flushing = None
+        if future.exception() is not None:
+            # Keep the shares, they are retried with the next flush.
+            logger.error('Share flush failed, %s' % future.exception())
+            self.buffer.extendleft(reversed(batch))
+
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        elif self.buffer and self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+
+    def flush_sync(self, timeout=None):
+        # Write everything that is buffered before returning, used before a block is credited and at shutdown.
+        started = time.time()
+        if self.flushing is not None:
+            try:
+                error = self.flushing_write.exception(timeout=timeout)
+            except FutureTimeoutError:
+                logger.error('Share flush timeout, %d shares are not saved' % (len(self.buffer) + len(self.flushing_batch)))
+                return False
+
+            self.flushing = None
+            if error is not None:
+                # The failed batch is written below with the rest
+                logger.error('Share flush failed, %s' % error)
+                self.buffer.extendleft(reversed(self.flushing_batch))
+
+        while self.buffer:
+            if timeout is not None and time.time() - started > timeout:
+                logger.error('Share flush timeout, %d shares are not saved' % len(self.buffer))
+                return False
+            batch = self.take_batch()
+            try:
+                self.write_batch(batch)
+            except Exception:
+                self.buffer.extendleft(reversed(batch))
+                raise
+
+        return True
+
+    def write_batch(self, batch):
+        # A row the database rejects must not keep the rest of its batch in the buffer forever.
+        # Written rows are removed from batch, what is left is buffered again when another error is raised.
+        try:
+            self.write(batch)
+            del batch[:]
+            return
+        except (IntegrityError, DataError) as e:
+            logger.error('Share batch rejected, write %d shares one by one, %s' % (len(batch), e))
+
+        while batch:
+            try:
+                self.write(batch[:1])
+            except (IntegrityError, DataError) as e:
+                self.rejected_count += 1
+                logger.error('Share dropped, %s, %s' % (batch[0], e))
+            del batch[0]
+
+    def write(self, batch):
+        started = time.time()
+        aggregates = aggregate_shares(batch)
+        rollups = rollup_shares(batch)
+        with self.engine.begin() as conn:
+            if self.pplns_window is not None and not self.pplns_window.loaded:
+                # Loaded before this batch is counted, then kept in step with the table
+                self.pplns_window.load(conn)
+            conn.execute(Shares.__table__.insert(), batch)
+            if aggregates:
+                upsert_aggregates(conn, aggregates)
+            if rollups:
+                upsert_rollups(conn, rollups)
+
+        if self.pplns_window is not None:
+            self.pplns_window.add(aggregates)
+
+        self.last_flush_latency = time.time() - started
+        if self.last_flush_latency > self.max_flush_latency:
+            self.max_flush_latency = self.last_flush_latency
+        self.flush_count += 1
+        self.written_count += len(batch)
+        logger.debug('Flush %d shares, %.3f sec, queue depth %d' % (len(batch), self.last_flush_latency, len(self.buffer)))
+
+    def get_stats(self):
+        stats = {'queue_depth': len(self.buffer),
+                 'max_queue_depth': self.max_queue_depth,
+                 'flush_count': self.flush_count,
+                 'written_count': self.written_count,
+                 'rejected_count': self.rejected_count,
+                 'dropped_count': self.dropped_count,
+                 'last_flush_latency': self.last_flush_latency,
+                 'max_flush_latency': self.max_flush_latency}
+        self.max_queue_depth = len(self.buffer)
+        self.max_flush_latency = 0.0
+        return stats
+
+    def close(self, timeout=None):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        self.flush_sync(timeout)
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,208 @@
+from mining.interfaces import Interfaces
+from mining.metric_generator import log_stratum_stats
+from common.logger import get_logger
+import subprocess
+import asyncio
+import struct
+import pickle
+import signal
+import sys
+import os
+
+logger = get_logger(__name__)
+
+FRAME_HEADER = struct.Struct('>I')
+UPDATE_BLOCK_REQUEST = b'u'
+
+
+class JobPipeProtocol(asyncio.Protocol):
+    # Worker side, length prefixed pickled Jobs from the template owner
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def data_received(self, data):
+        buffer = self._buffer
+        buffer += data
+
+        while len(buffer) >= FRAME_HEADER.size:
+            size = FRAME_HEADER.unpack_from(buffer)[0]
+            if len(buffer) < FRAME_HEADER.size + size:
+                break
+
+            job = pickle.loads(bytes(buffer[FRAME_HEADER.size:FRAME_HEADER.size + size]))
+            del buffer[:FRAME_HEADER.size + size]
+
+            Interfaces.job_manager.add_job(job)
+            Interfaces.stratum_handler.notify_all(job)
+
+    def connection_lost(self, exc):
+        # Same shutdown as SIGTERM, buffered shares and worker connects are written before the worker exits
+        logger.error('Template owner is gone, stop the Stratum worker')
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+class UpdateRequestProtocol(asyncio.Protocol):
+    # Owner side, a worker found a block and the template must be refreshed now
+    def __init__(self, supervisor, worker_id):
+        self.supervisor = supervisor
+        self.worker_id = worker_id
+
+    def data_received(self, data):
+        for _ in range(data.count(UPDATE_BLOCK_REQUEST)):
+            asyncio.ensure_future(Interfaces.block_updater.update_block(repeat=False))
+
+    def connection_lost(self, exc):
+        # The pipe closes when the worker process exits
+        self.supervisor.worker_exited(self.worker_id)
+
+
+class WorkerBlockUpdater(object):
+    # Stands in for BlockUpdater in a Stratum worker, only the found block path uses it
+    def __init__(self, coin_rpc, update_pipe):
+        self.coin_rpc = coin_rpc
+        self.update_pipe = update_pipe
+
+    async def update_block(self, repeat=False, block_hash=None, data=None):
+        self.update_pipe.write(UPDATE_BLOCK_REQUEST)
+
+        # Same result as BlockUpdater, the new previous block hash when it is not block_hash
+        data = await self.coin_rpc.get_block_template()
+        current_job = Interfaces.job_manager.current_job
+        if data is None or current_job is None or data['previousblockhash'] == current_job.prev_hash:
+            return None
+        if block_hash != data['previousblockhash']:
+            return data['previousblockhash']
+        return None
+
+
+class Supervisor(object):
+    # Template owner process runs BlockUpdater and sends every new Job to STRATUM_WORKERS forked processes.
+    # Workers listen on the same port with SO_REUSEPORT. A worker that exits is started again as a new interpreter,
+    # forking the running owner would share its event loop, threads and database connections.
+    def __init__(self, worker_count):
+        self.worker_count = worker_count
+        self.worker_id = None
+        self.pids = []
+        self.job_pipes = []  # Owner : write fds, worker : read fd
+        self.update_pipes = []  # Owner : read fds, worker : write fd
+        self.job_transports = []
+        self.update_transport = None
+        self.respawn_delay = float(os.getenv("STRATUM_WORKER_RESPAWN_DELAY", 1))
+        self.stopping = False
+
+    def fork_workers(self):
+        # Returns the worker id in a worker, None in the template owner
+        if os.getenv("STRATUM_WORKER_ID") is not None:
+            # Respawned worker, started with the pipes of the worker it replaces
+            self.worker_id = int(os.getenv("STRATUM_WORKER_ID"))
+            job_read, update_write = [int(fd) for fd in os.getenv("STRATUM_WORKER_PIPES").split(',')]
+            self.job_pipes = [job_read]
+            self.update_pipes = [update_write]
+            return self.worker_id
+
+        for worker_id in range(self.worker_count):
+            job_read, job_write = os.pipe()
+            update_read, update_write = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(job_write)
+                os.close(update_read)
+                for fd in self.job_pipes + self.update_pipes:
+                    os.close(fd)
+                self.worker_id = worker_id
+                self.job_pipes = [job_read]
+                self.update_pipes = [update_write]
+                return worker_id
+
+            os.close(job_read)
+            os.close(update_write)
+            self.pids.append(pid)
+            self.job_pipes.append(job_write)
+            self.update_pipes.append(update_read)
+
+        logger.info('Forked %d Stratum workers %s' % (self.worker_count, self.pids))
+        return None
+
+    async def connect_worker(self, worker_id, job_write, update_read):
+        loop = asyncio.get_event_loop()
+        transport, _ = await loop.connect_write_pipe(asyncio.Protocol, os.fdopen(job_write, 'wb'))
+        await loop.connect_read_pipe(lambda: UpdateRequestProtocol(self, worker_id), os.fdopen(update_read, 'rb'))
+        return transport
+
+    async def start_owner(self):
+        for worker_id, (job_write, update_read) in enumerate(zip(self.job_pipes, self.update_pipes)):
+            self.job_transports.append(await self.connect_worker(worker_id, job_write, update_read))
+
+    def worker_exited(self, worker_id):
+        if self.stopping:
+            return
+
+        try:
+            _, status = os.waitpid(self.pids[worker_id], 0)
+        except ChildProcessError:
+            status = None
+        logger.error('Stratum worker %d exited, status %s, respawn after %s sec' % (worker_id, status, self.respawn_delay))
+        self.job_transports[worker_id].close()
+        asyncio.get_event_loop().call_later(self.respawn_delay, lambda: asyncio.ensure_future(self.respawn_worker(worker_id)))
+
+    async def respawn_worker(self, worker_id):
+        if self.stopping:
+            return
+
+        job_read, job_write = os.pipe()
+        update_read, update_write = os.pipe()
+        env = dict(os.environ, STRATUM_WORKER_ID=str(worker_id), STRATUM_WORKER_PIPES='%d,%d' % (job_read, update_write))
+        process = subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=(job_read, update_write))
+        os.close(job_read)
+        os.close(update_write)
+
+        self.pids[worker_id] = process.pid
+        self.job_transports[worker_id] = await self.connect_worker(worker_id, job_write, update_read)
+        logger.info('Respawned Stratum worker %d, pid %d' % (worker_id, process.pid))
+
+        current_job = Interfaces.job_manager.current_job
+        if current_job is not None:
+            self.job_transports[worker_id].write(self.encode_job(current_job))
+
+    async def start_worker(self):
+        # The Stratum handler must be set, a job can arrive as soon as the pipe is read
+        loop = asyncio.get_event_loop()
+        await loop.connect_read_pipe(JobPipeProtocol, os.fdopen(self.job_pipes[0], 'rb'))
+        self.update_transport, _ = await loop.connect_write_pipe(asyncio.Protocol, os.fdopen(self.update_pipes[0], 'wb'))
+        self.schedule_stats()
+        return self.update_transport
+
+    def schedule_stats(self):
+        # The template owner has no Stratum connections, every worker logs its own stats
+        asyncio.get_event_loop().call_later(float(os.getenv("STRATUM_STATS_INTERVAL", 600)), self.log_stats)
+
+    def log_stats(self):
+        self.schedule_stats()
+        log_stratum_stats('Stratum worker %d, ' % self.worker_id)
+
+    @staticmethod
+    def encode_job(job):
+        data = pickle.dumps(job, protocol=pickle.HIGHEST_PROTOCOL)
+        return FRAME_HEADER.pack(len(data)) + data
+
+    def notify_all(self, job=None):
+        # Stratum handler of the template owner, called by BlockTemplate
+        job = Interfaces.job_manager.new_job(Interfaces.block_template)
+        frame = self.encode_job(job)
+        for transport in self.job_transports:
+            if not transport.is_closing():
+                transport.write(frame)
+
+    def stop_workers(self):
+        self.stopping = True
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        for pid in self.pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
@@ -0,0 +1,23 @@
+from sqlalchemy.dialects import postgresql
+from sqlalchemy import and_
+
+
+def upsert_add(conn, table, key_columns, rows):
+    # Insert rows, or add their values to the row with the same key columns
+    value_columns = [column for column in rows[0] if column not in key_columns]
+
+    if conn.dialect.name == 'postgresql':
+        statement = postgresql.insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c[column] for column in key_columns],
+            set_={column: table.c[column] + statement.excluded[column] for column in value_columns})
+        conn.execute(statement, rows)
+        return
+
+    # Other databases, ex: sqlite of the load test
+    for row in rows:
+        result = conn.execute(table.update().
+                              where(and_(*[table.c[column] == row[column] for column in key_columns])).
+                              values({column: table.c[column] + row[column] for column in value_columns}))
+        if result.rowcount == 0:
+            conn.execute(table.insert(), row)
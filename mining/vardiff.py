@@ -0,0 +1,49 @@
+import time
+import os
+
+
+class VarDiff(object):
+    # Share rate estimator of one connection, retargets the difficulty toward VARDIFF_TARGET_SPM shares per minute.
+    def __init__(self):
+        self.target_spm = float(os.getenv("VARDIFF_TARGET_SPM", 20))
+        self.min_difficulty = float(os.getenv("VARDIFF_MIN_DIFF", float(os.getenv("POOL_DIFF")) / 64))
+        self.max_difficulty = float(os.getenv("VARDIFF_MAX_DIFF", float(os.getenv("POOL_DIFF")) * 65536))
+        self.retarget_time = float(os.getenv("VARDIFF_RETARGET_TIME", 90))
+        self.variance = float(os.getenv("VARDIFF_VARIANCE", 0.3))
+
+        self.window_start = time.monotonic()
+        self.share_count = 0
+        self.pending_difficulty = None
+
+    def add_share(self, difficulty):
+        self.share_count += 1
+        self.retarget(difficulty)
+
+    def retarget(self, difficulty):
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed < self.retarget_time:
+            return
+
+        spm = self.share_count * 60 / elapsed
+        self.window_start = now
+        self.share_count = 0
+
+        ratio = spm / self.target_spm
+        if abs(ratio - 1) <= self.variance:
+            return
+
+        # At most x4 per retarget, a few lucky shares should not jump the difficulty
+        ratio = min(max(ratio, 0.25), 4)
+        new_difficulty = min(max(difficulty * ratio, self.min_difficulty), self.max_difficulty)
+        if new_difficulty != difficulty:
+            self.pending_difficulty = new_difficulty
+
+    def take_pending_difficulty(self, difficulty):
+        # Called on notify, the new difficulty is sent together with the next job
+        if self.pending_difficulty is None:
+            self.retarget(difficulty)
+
+        new_difficulty = self.pending_difficulty
+        self.pending_difficulty = None
+        return new_difficulty
@@ -0,0 +1,134 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from mining.models import Workers
+from sqlalchemy import and_, bindparam
+from common.logger import get_logger
+import asyncio
+import time
+import os
+
+logger = get_logger(__name__)
+
+
+class WorkerPresence(object):
+    # Worker connects and disconnects are kept in memory and written to Workers every WORKER_FLUSH_INTERVAL seconds,
+    # one executemany insert and one executemany update per flush, on a dedicated thread like the share writer.
+    def __init__(self, engine):
+        self.engine = engine
+        self.flush_interval = float(os.getenv("WORKER_FLUSH_INTERVAL", 5))
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.flushing = None
+        self.timer = None
+
+        self.inserts = []  # new Workers rows
+        self.open_inserts = {}  # (username, name, ip): rows of inserts that are still connected
+        self.disconnects = {}  # (username, name, ip): disconnected time of rows already in the database
+        self.online = {}  # (username, name, ip): open connections of this process
+
+    def connect(self, ip, username, worker_name, miner):
+        key = (username, worker_name, ip)
+        row = {'name': worker_name, 'username': username, 'ip': ip, 'miner': miner, 'coin_name': os.getenv("COIN"),
+               'connected': datetime.utcnow(), 'disconnected': None}
+        self.inserts.append(row)
+        self.open_inserts.setdefault(key, []).append(row)
+        self.online[key] = self.online.get(key, 0) + 1
+        self.schedule()
+
+    def disconnect(self, username, worker_name, ip):
+        if username is None:
+            return
+
+        key = (username, worker_name, ip)
+        count = self.online.get(key, 0)
+        if count <= 1:
+            self.online.pop(key, None)
+        else:
+            self.online[key] = count - 1
+
+        # Like the old per event update, every open row of the worker is closed
+        now = datetime.now()
+        for row in self.open_inserts.pop(key, []):
+            # Connected and disconnected between two flushes, inserted as a closed row
+            row['disconnected'] = now
+        self.disconnects[key] = now
+        self.schedule()
+
+    def schedule(self):
+        if self.timer is None and self.flushing is None:
+            self.timer = asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+
+    def take_batch(self):
+        inserts, disconnects = self.inserts, self.disconnects
+        self.inserts = []
+        self.open_inserts = {}
+        self.disconnects = {}
+        return inserts, disconnects
+
+    def flush(self):
+        self.timer = None
+        if self.flushing is not None or not (self.inserts or self.disconnects):
+            return
+
+        batch = self.take_batch()
+        self.flushing = asyncio.get_event_loop().run_in_executor(self.executor, self.write, *batch)
+        self.flushing.add_done_callback(lambda future: self.flush_done(future, batch))
+
+    def flush_done(self, future, batch):
+        self.flushing = None
+        if future.exception() is not None:
+            logger.error('Worker flush failed, %s' % future.exception())
+            self.restore(*batch)
+
+        if self.inserts or self.disconnects:
+            self.schedule()
+
+    def restore(self, inserts, disconnects):
+        # Retried with the next flush, events that happened meanwhile are newer
+        self.inserts[:0] = inserts
+        for row in reversed(inserts):
+            if row['disconnected'] is not None:
+                continue
+            key = (row['username'], row['name'], row['ip'])
+            if key in self.disconnects:
+                # Disconnected while the failed flush was running
+                row['disconnected'] = self.disconnects[key]
+            else:
+                self.open_inserts.setdefault(key, []).insert(0, row)
+        for key, disconnected in disconnects.items():
+            self.disconnects.setdefault(key, disconnected)
+
+    def write(self, inserts, disconnects):
+        started = time.time()
+        table = Workers.__table__
+        with self.engine.begin() as conn:
+            # Disconnects first, they only close rows written by earlier flushes
+            if disconnects:
+                statement = table.update(). \
+                    where(and_(table.c.coin_name == os.getenv("COIN"), table.c.username == bindparam('b_username'), table.c.name == bindparam('b_name'),
+                               table.c.ip == bindparam('b_ip'), table.c.disconnected.is_(None))). \
+                    values(disconnected=bindparam('b_disconnected'))
+                conn.execute(statement, [{'b_username': username, 'b_name': name, 'b_ip': ip, 'b_disconnected': disconnected}
+                                         for (username, name, ip), disconnected in disconnects.items()])
+            if inserts:
+                conn.execute(table.insert(), inserts)
+
+        logger.debug('Flush workers, %d connects, %d disconnects, %.3f sec' % (len(inserts), len(disconnects), time.time() - started))
+
+    def close(self):
+        # Every connection of this process ends, nothing is left connected in the database
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        for key in list(self.online):
+            for _ in range(self.online.get(key, 0)):
+                self.disconnect(*key)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if self.flushing is not None:
+            self.executor.submit(lambda: None).result()
+        if self.inserts or self.disconnects:
+            self.write(*self.take_batch())
+        self.executor.shutdown(wait=False)
@@ -1,6 +1,6 @@
 from common.logger import get_logger
 import os
-from http import client
+import asyncio
 from urllib import parse
 import base64
 import simplejson
@@ -20,6 +20,93 @@ class CoinMethodNotFoundException(Exception):
     code = -32601
 
 
+class CoinRPCConnectionException(Exception):
+    pass
+
+
+class CoinRPCTimeoutException(CoinRPCConnectionException):
+    # The daemon did not answer in time, the connection itself was fine
+    pass
+
+
+# Seconds, methods not listed here use COIN_RPC_TIMEOUT
+METHOD_TIMEOUTS = {
+    'getblocktemplate': 10,
+    'getmininginfo': 10,
+    'validateaddress': 5,
+    'submitblock': 30,
+    'sendmany': 60,
+    'z_sendmany': 60,
+    'z_shieldcoinbase': 60,
+}
+
+# Sending these twice can move coins twice, never retried after a connection failure
+NOT_RETRYABLE_METHODS = ['sendmany', 'z_sendmany', 'z_shieldcoinbase']
+
+
+class RPCConnection(object):
+    # One persistent HTTP/1.1 keep-alive connection to the coin daemon.
+    def __init__(self, host, port, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout  # Overrides METHOD_TIMEOUTS, ex: longpoll
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    async def request(self, path, headers: dict, body: bytes) -> bytes:
+        if self.writer is None:
+            await self.connect()
+
+        request = ['POST %s HTTP/1.1' % path] + ['%s: %s' % (k, v) for k, v in headers.items()]
+        request += ['Content-Length: %d' % len(body), 'Connection: keep-alive', '', '']
+        self.writer.write('\r\n'.join(request).encode() + body)
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError('connection closed by coin daemon')
+        status = int(status_line.split(b' ', 2)[1])
+
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode().partition(':')
+            response_headers[key.strip().lower()] = value.strip()
+
+        if 'content-length' in response_headers:
+            response_data = await self.reader.readexactly(int(response_headers['content-length']))
+        elif response_headers.get('transfer-encoding') == 'chunked':
+            response_data = b''
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                response_data += chunk[:-2]
+        else:
+            response_data = await self.reader.read()
+            self.close()
+
+        if response_headers.get('connection') == 'close':
+            self.close()
+
+        if status == 401:
+            raise Exception('coin daemon authorization failed')
+
+        return response_data
+
+
 class CoinRPC(object):
     def __init__(self):
         logger.debug("Got to Coin RPC")
@@ -34,112 +121,195 @@ class CoinRPC(object):
         url_port = '{}:{}'.format(url, port)
         self.service_url = parse.urlparse(url_port)
         self.port = self.service_url.port
+        self.headers = {
+            'Host': self.service_url.hostname,
+            'User-Agent': USER_AGENT,
+            'Authorization': self.auth_header.decode(),
+            'Content-type': 'application/json'
+        }
+
+        self.timeout = float(os.getenv("COIN_RPC_TIMEOUT", 30))
+        self.pool_size = int(os.getenv("COIN_RPC_POOL_SIZE", 4))
+        self.pool_semaphore = asyncio.Semaphore(self.pool_size)
+        self.idle_connections = []
+
+        # submitblock never waits behind getblocktemplate or payout calls
+        self.submit_connection = RPCConnection(self.service_url.hostname, self.port)
+
+    async def request(self, connection: RPCConnection, methods: list, post_data: bytes):
+        timeout = connection.timeout or max(METHOD_TIMEOUTS.get(method, self.timeout) for method in methods)
+        retry = not any(method in NOT_RETRYABLE_METHODS for method in methods)
+        method = methods[0] if len(methods) == 1 else 'batch of %d' % len(methods)
+
+        async with connection.lock:
+            while True:
+                try:
+                    return await asyncio.wait_for(connection.request(self.service_url.path or '/', self.headers, post_data), timeout)
+                except asyncio.TimeoutError:
+                    connection.close()
+                    raise CoinRPCTimeoutException('%s timeout after %s sec' % (method, timeout))
+                except asyncio.CancelledError:
+                    connection.close()
+                    raise
+                except (ConnectionError, OSError, asyncio.IncompleteReadError) as e:
+                    connection.close()
+                    if not retry:
+                        raise CoinRPCConnectionException('%s failed, %s' % (method, e))
+                    logger.error('Coin daemon connection error %s, reconnect' % e)
+                    retry = False
+
+    async def send(self, methods: list, post_data: bytes, connection=None):
+        if connection is not None:
+            response_data = await self.request(connection, methods, post_data)
+        else:
+            async with self.pool_semaphore:
+                if self.idle_connections:
+                    connection = self.idle_connections.pop()
+                else:
+                    connection = RPCConnection(self.service_url.hostname, self.port)
+                try:
+                    response_data = await self.request(connection, methods, post_data)
+                except BaseException:
+                    # Failed or cancelled in the middle of a response, the rest of it would be read by the next request
+                    connection.close()
+                    raise
+                self.idle_connections.append(connection)
+
+        return simplejson.loads(response_data, parse_float=decimal.Decimal)
+
+    @staticmethod
+    def get_exception(error):
+        if error['code'] == -32601:
+            return CoinMethodNotFoundException(error)
+        else:
+            return Exception(error)
 
-        self.conn = client.HTTPConnection(self.service_url.hostname, self.port, timeout=30)
+    async def call(self, method, params, connection=None):
+        post_data = simplejson.dumps({'version': '1.1', 'method': method, 'params': params, 'id': 1}, default=encode_decimal).encode()
+        response = await self.send([method], post_data, connection)
 
-    def call(self, method, params):
+        if response['error'] is None:
+            return response['result']
+        else:
+            raise self.get_exception(response['error'])
+
+    async def call_or_exception(self, method, params):
+        # Connection failures still raise, like a batch that gets no response
         try:
-            post_data = simplejson.dumps({'version': '1.1', 'method': method, 'params': params, 'id': 1}, default=encode_decimal)
-            self.conn.request('POST', self.service_url.path, post_data, {
-                'Host': self.service_url.hostname,
-                'User-Agent': "SimpleMining/0.1",
-                'Authorization': self.auth_header,
-                'Content-type': 'application/json'
-            })
-            self.conn.sock.settimeout(30)
-
-            response = self.conn.getresponse()
-            response_data = response.read()
-            response = simplejson.loads(response_data, parse_float=decimal.Decimal)
-
-            if response['error'] is None:
-                return response['result']
+            return await self.call(method, params)
+        except CoinRPCConnectionException:
+            raise
+        except Exception as e:
+            return e
+
+    async def call_batch(self, calls: list):
+        # calls is [(method, params), ...], results keep the same order and a failed call is its exception instance
+        if len(calls) == 0:
+            return []
+
+        batch = [{'jsonrpc': '2.0', 'method': method, 'params': params, 'id': i} for i, (method, params) in enumerate(calls)]
+        post_data = simplejson.dumps(batch, default=encode_decimal).encode()
+        response = await self.send([method for method, _ in calls], post_data)
+
+        if isinstance(response, dict):
+            # Whole batch is rejected, ex: daemon without batch support, send the calls one by one
+            logger.warning('Batch of %d rejected, %s, call one by one' % (len(calls), response.get('error')))
+            return [await self.call_or_exception(method, params) for method, params in calls]
+
+        results = [CoinRPCConnectionException('no response for batch item')] * len(calls)
+        for item in response:
+            if item.get('error') is None:
+                results[item['id']] = item['result']
             else:
-                if response['error']['code'] == -32601:
-                    raise CoinMethodNotFoundException(response['error'])
-                else:
-                    raise Exception(response['error'])
+                results[item['id']] = self.get_exception(item['error'])
 
-        except (ConnectionResetError, ConnectionRefusedError):
-            logger.error('Connection Reset Error')
-            self.conn = client.HTTPConnection(self.service_url.hostname, self.port, timeout=30)
-            # return self.call(method, params)
-        except client.CannotSendRequest:
-            logger.error('CannotSendRequest')
-            self.conn = client.HTTPConnection(self.service_url.hostname, self.port, timeout=30)
+        return results
 
-    def get_block_subsidy(self):
-        return self.call('getblocksubsidy', [])
+    async def get_block_subsidy(self):
+        return await self.call('getblocksubsidy', [])
 
-    def get_block_template(self, params=None):
+    async def get_block_template(self, params=None):
         if params is None:
             params = []
         if os.getenv("COIN") == 'phoenixcoin':
             params = [{}]
-        return self.call('getblocktemplate', params)
+        return await self.call('getblocktemplate', params)
 
-    def get_work_ex(self):
-        return self.call('getworkex', [])
+    async def get_block_template_longpoll(self, longpollid, connection: RPCConnection):
+        # Returns when the daemon has a new template, the connection timeout must cover the wait
+        return await self.call('getblocktemplate', [{'longpollid': longpollid}], connection=connection)
 
-    def get_mining_info(self):
-        return self.call('getmininginfo', [])
+    async def get_work_ex(self):
+        return await self.call('getworkex', [])
 
-    def submit_block(self, solver):
+    async def get_mining_info(self):
+        return await self.call('getmininginfo', [])
+
+    async def submit_block(self, solver):
         if os.getenv("COIN") in ['phoenixcoin']:
-            return self.call('getblocktemplate', [{'mode': 'submit', 'data': solver}])
-        return self.call('submitblock', [solver])
+            return await self.call('getblocktemplate', [{'mode': 'submit', 'data': solver}], connection=self.submit_connection)
+        return await self.call('submitblock', [solver], connection=self.submit_connection)
+
+    async def get_block(self, params):
+        return await self.call('getblock', params)
 
-    def get_block(self, params):
-        return self.call('getblock', params)
+    async def get_block_hash(self, params):
+        return await self.call('getblockhash', params)
 
-    def get_block_hash(self, params):
-        return self.call('getblockhash', params)
+    async def get_blocks(self, block_hashes):
+        return await self.call_batch([('getblock', [block_hash]) for block_hash in block_hashes])
 
-    def list_accounts(self):
-        return self.call('listaccounts', [])
+    async def get_block_hashes(self, heights):
+        return await self.call_batch([('getblockhash', [height]) for height in heights])
 
-    def validate_address(self, address):
-        return self.call('validateaddress', [address])
+    async def list_accounts(self):
+        return await self.call('listaccounts', [])
 
-    def send_many(self, send_data):
+    async def validate_address(self, address):
+        return await self.call('validateaddress', [address])
+
+    async def send_many(self, send_data):
         try:
-            return self.call('sendmany', ['', send_data])
+            return await self.call('sendmany', ['', send_data])
         except Exception as e:
             print(e)
             return None
 
-    def get_transaction(self, tx_id):
-        return self.call('gettransaction', [tx_id])
+    async def get_transaction(self, tx_id):
+        return await self.call('gettransaction', [tx_id])
+
+    async def get_transactions(self, tx_ids):
+        return await self.call_batch([('gettransaction', [tx_id]) for tx_id in tx_ids])
 
-    def get_confirmed_balance(self):
+    async def get_confirmed_balance(self):
         if os.getenv("COIN_TYPE") == 'zcash':
-            total_balance = self.call('z_gettotalbalance', [])
+            total_balance = await self.call('z_gettotalbalance', [])
             balance = total_balance['total']
         else:
-            balance = self.call('getbalance', [])
+            balance = await self.call('getbalance', [])
 
         return balance
 
-    def zcash_shield_coinbase(self, to_address):
+    async def zcash_shield_coinbase(self, to_address):
         if os.getenv("COIN_TYPE") != 'zcash':
             raise Exception('this operations is only supported zcash')
 
-        return self.call('z_shieldcoinbase', ['*', to_address])
+        return await self.call('z_shieldcoinbase', ['*', to_address])
 
-    def zcash_operations_status(self, opids):
+    async def zcash_operations_status(self, opids):
         if os.getenv("COIN_TYPE") != 'zcash':
             raise Exception('this operations is only supported zcash')
 
-        return self.call('z_getoperationstatus', [opids])
+        return await self.call('z_getoperationstatus', [opids])
 
-    def zcash_send_many(self, pool_z_address, send_data):
+    async def zcash_send_many(self, pool_z_address, send_data):
         if os.getenv("COIN_TYPE") != 'zcash':
             raise Exception('this operations is only supported zcash')
 
-        return self.call('z_sendmany', [pool_z_address, send_data])
+        return await self.call('z_sendmany', [pool_z_address, send_data])
 
-    def zcash_get_total_balance(self):
+    async def zcash_get_total_balance(self):
         if os.getenv("COIN_TYPE") != 'zcash':
             raise Exception('this operations is only supported zcash')
 
-        return self.call('z_gettotalbalance', [])
+        return await self.call('z_gettotalbalance', [])
@@ -1,9 +1,12 @@
 from mining.interfaces import Interfaces
 from common.hash_util import double_sha, uint256_from_str
-from common import hash_util, bitcoin_util
+from common import hash_util
 from common.logger import get_logger
+from common.cache import TTLCache
+from common.pow_hash import PowHashExecutor, PowHashQueueFullException
+from stratum.coin_rpc import CoinRPCConnectionException
+from mining.vardiff import VarDiff
 import binascii
-import struct
 import os
 
 logger = get_logger(__name__)
@@ -17,7 +20,12 @@ class ACPoolHandler(object):
         self.job_manager = Interfaces.job_manager
         self.database_ref = Interfaces.database
         self.connections = set()
-        self.user_diffs = {}
+        self.vardiff_enabled = os.getenv("VARDIFF") == 'true'
+        self.pow_hash_executor = PowHashExecutor()
+        self.pow_limit = hash_util.get_pow_limit()
+        # username: known user or valid address, unknown usernames are cached for a shorter time
+        self.user_cache = TTLCache(int(os.getenv("AUTH_CACHE_SIZE", 100000)), float(os.getenv("AUTH_CACHE_TTL", 600)),
+                                   float(os.getenv("AUTH_CACHE_NEGATIVE_TTL", 60)))
 
     def disconnect(self, connection_ref):
         self.database_ref.disconnected_worker(connection_ref.username, connection_ref.worker_name, connection_ref.host)
@@ -48,11 +56,10 @@ class ACPoolHandler(object):
         return result
 
     def set_target(self, connection_ref):
-        # TODO: Var Diff 고려
-        diff = self.user_diffs[connection_ref.username]
+        diff = connection_ref.difficulty
 
         if os.getenv("COIN_TYPE") == 'zcash':
-            target_diff = format(int(os.getenv("POW_LIMIT") / diff), 'x')
+            target_diff = format(int(self.pow_limit / diff), 'x')
             for i in range(64 - len(target_diff)):
                 target_diff = '0' + target_diff
             connection_ref.send_message({'id': None, 'method': 'mining.set_target', 'params': [target_diff]})
@@ -66,51 +73,46 @@ class ACPoolHandler(object):
                 target_diff = diff * 256
             connection_ref.send_message({'id': None, 'method': 'mining.set_difficulty', 'params': [target_diff]})
 
-    def notify(self, connection_ref, first):
-        # TODO: Notify 시 무조건 Target Setting 에서 적절한 Target Setting 으로 변경 필요
-        if first:
-            self.set_target(connection_ref)
-        session_id = connection_ref.get_session()
-        job_id = self.job_manager.get_new_job_id(session_id, self.block_template)
+    @staticmethod
+    def update_difficulty(connection_ref) -> bool:
+        if connection_ref.vardiff is None:
+            return False
 
-        if os.getenv("COIN_TYPE") == 'zcash':
-            version = binascii.hexlify(struct.pack("<I", self.block_template.version)).decode()
-            prevhash = self.block_template.prev_hash_reverse_hex
-            bits = self.block_template.n_bits_reverse_hex
-            reserved = '0000000000000000000000000000000000000000000000000000000000000000'
-            time = self.block_template.curtime
-            merkle_root = self.block_template.merkle_root_reverse_hex
-            if os.getenv("COIN_ALGORITHM") == 'zhash':
-                if os.getenv("COIN") == 'bitcoin-gold':
-                    pers = 'BgoldPoW'
-                elif os.getenv("COIN") == 'bitcoinz':
-                    pers = 'BitcoinZ'
-                elif os.getenv("COIN") == 'classic-bitcoin':
-                    pers = 'CbtcPoW'
-                elif os.getenv("COIN") == 'zelcash':
-                    pers = 'ZelProof'
-                else:
-                    raise Exception('invalid coin type')
-                params = [job_id, version, prevhash, merkle_root, reserved, time, bits, True, False, pers]
-            else:
-                params = [job_id, version, prevhash, merkle_root, reserved, time, bits, True]
-            connection_ref.send_message({'id': None, 'method': 'mining.notify', 'params': params})
+        new_difficulty = connection_ref.vardiff.take_pending_difficulty(connection_ref.difficulty)
+        if new_difficulty is None:
+            return False
 
-        elif os.getenv("COIN_TYPE") == 'bitcoin':
-            version = binascii.hexlify(struct.pack(">I", self.block_template.version)).decode()
-            prevhash = bitcoin_util.reverse_hash(self.block_template.prev_hash.encode()).decode()
-            coinbase = binascii.hexlify(self.block_template.coinbase_tx).split(self.block_template.extranonce_placeholder)
-            merkle_branch = self.block_template.merkle_branch
-            bits = self.block_template.n_bits
-            time = hash_util.hex_to_reverse_hex(self.block_template.curtime)
-            params = [job_id, prevhash, coinbase[0].decode(), coinbase[1].decode(), merkle_branch, version, bits, time, True]
-            connection_ref.send_message({'id': None, 'method': 'mining.notify', 'params': params})
-
-    def notify_all(self):
-        for connection_ref in self.connections:
-            self.notify(connection_ref, False)
+        logger.debug('Retarget %s.%s, difficulty %s to %s' % (connection_ref.username, connection_ref.worker_name, connection_ref.difficulty, new_difficulty))
+        connection_ref.difficulty = new_difficulty
+        return True
 
-        self.job_manager.clear_submits()
+    @staticmethod
+    def set_job_difficulty(connection_ref, job_id):
+        # Shares are validated against the difficulty that was active when their job was sent
+        job_difficulties = connection_ref.job_difficulties
+        job_difficulties[job_id] = connection_ref.difficulty
+        if len(job_difficulties) > 16:
+            job_difficulties.popitem(last=False)
+
+    def notify(self, connection_ref, first):
+        if first or self.update_difficulty(connection_ref):
+            self.set_target(connection_ref)
+        job = self.job_manager.get_current_job(self.block_template)
+        if job is None:
+            return
+        self.set_job_difficulty(connection_ref, job.job_id)
+        connection_ref.send_raw(job.notify_message)
+
+    def notify_all(self, job=None):
+        # job is given in a Stratum worker process, it was added from the template owner
+        if job is None:
+            job = self.job_manager.new_job(self.block_template)
+        notify_message = job.notify_message
+        for connection_ref in self.connections:
+            if self.update_difficulty(connection_ref):
+                self.set_target(connection_ref)
+            self.set_job_difficulty(connection_ref, job.job_id)
+            connection_ref.send_raw(notify_message)
 
     def subscribe(self, connection_ref, _id, _params: list):
         session_id = connection_ref.get_session()
@@ -124,7 +126,7 @@ class ACPoolHandler(object):
             build_result = [['mining.notify', session_id], nonce_1, 4]
             return {'id': _id, 'result': build_result, 'error': None}
 
-    def authorize(self, connection_ref, _id, _params):
+    async def authorize(self, connection_ref, _id, _params):
         split_username = _params[0].strip().split('.')
         username = split_username[0]
         if len(split_username) == 2:
@@ -132,19 +134,17 @@ class ACPoolHandler(object):
         else:
             worker_name = 'default'
 
-        if self.database_ref.get_user(username) is None:
-            valid_result = self.coin_rpc.validate_address(username)
-            if valid_result['isvalid']:
-                self.database_ref.get_or_create_address_user(username)
-            else:
-                logger.info('Unknown user %s' % _params[0])
-                return {'id': _id, 'result': False, 'error': None}
+        if not await self.user_cache.get_or_load(username, self.load_user):
+            logger.info('Unknown user %s' % _params[0])
+            return {'id': _id, 'result': False, 'error': None}
 
         if 'd=' in _params[1]:
-            diff = float(_params[1].replace('d=', ''))
-            self.user_diffs[username] = diff
+            # Difficulty requested by the miner is kept as is
+            connection_ref.difficulty = float(_params[1].replace('d=', ''))
+            connection_ref.vardiff = None
         else:
-            self.user_diffs[username] = float(os.getenv("POOL_DIFF"))
+            connection_ref.difficulty = float(os.getenv("POOL_DIFF"))
+            connection_ref.vardiff = VarDiff() if self.vardiff_enabled else None
 
         connection_ref.worker_name = worker_name
         connection_ref.username = username
@@ -155,11 +155,22 @@ class ACPoolHandler(object):
         self.connections.add(connection_ref)
         return {'id': _id, 'result': True, 'error': None}
 
+    async def load_user(self, username):
+        if self.database_ref.get_user(username) is not None:
+            return True
+
+        valid_result = await self.coin_rpc.validate_address(username)
+        if not valid_result['isvalid']:
+            return False
+
+        self.database_ref.get_or_create_address_user(username)
+        return True
+
     @staticmethod
     def extranonce_subscribe(_id):
         return {'id': _id, 'result': True, 'error': None}
 
-    def submit(self, connection_ref, _id, _params):
+    async def submit(self, connection_ref, _id, _params):
         # TODO: Job ID Check 구현해야함
         # TODO: Diff Check 해서 그냥 Share 기록 or Submit 구별 해야함
         # TODO: Share Result를 Database에 기록 해야함 - Database 는 Redis가 될듯
@@ -167,80 +178,61 @@ class ACPoolHandler(object):
 
         _worker_name = _params[0]
         _split_worker_name = _worker_name.strip().split('.')
-        username = _split_worker_name[0]
         if len(_split_worker_name) == 2:
             worker = _split_worker_name[1]
         else:
             worker = None
         _job_id = _params[1]
 
+        if connection_ref.username is None:
+            return {'id': _id, 'result': None, 'error': [24, 'unauthorized worker']}
+
+        # Shares are credited to the authorized user, not to the name sent with the submit
+        username = connection_ref.username
+        if _split_worker_name[0] != username:
+            logger.info('rejected share, worker : %s, reason : unauthorized user' % _worker_name)
+            return {'id': _id, 'result': None, 'error': [24, 'unauthorized worker']}
+
         _nonce_1 = self.job_manager.get_nonce_from_session_id(session_id)
-        _block_template = self.job_manager.get_block_template(_job_id)
+        _job = self.job_manager.get_job(_job_id)
+
+        if _job is None:
+            if self.job_manager.is_stale_job(_job_id):
+                self.job_manager.stale_reject_count += 1
+                logger.info('rejected share, worker : %s, reason : stale job' % _worker_name)
+                return {'id': _id, 'result': False, 'error': [21, 'stale job']}
 
-        if _block_template is None:
+            self.job_manager.not_found_reject_count += 1
             logger.info('rejected share, worker : %s, reason : job not found' % _worker_name)
             return {'id': _id, 'result': False, 'error': [21, 'job not found']}
 
         if os.getenv("COIN_TYPE") == 'bitcoin':
             _nonce_2 = _params[2]
             _time = _params[3]
-            _time_reverse = hash_util.hex_to_reverse_hex(_time)
             _nonce = _params[4]
-            _nonce_reverse = hash_util.hex_to_reverse_hex(_nonce)
 
             if len(_nonce) != 8:
                 logger.info('rejected share, worker : %s, reason : incorrect size of nonce' % _worker_name)
                 return {'id': _id, 'result': False, 'error': [20, 'incorrect size of nonce']}
 
-            coinbase = binascii.hexlify(_block_template.coinbase_tx).split(_block_template.extranonce_placeholder)
-            serialized_coinbase = binascii.unhexlify(coinbase[0] + _nonce_1 + _nonce_2.encode() + coinbase[1])
+            serialized_coinbase = _job.coinbase_prefix + binascii.unhexlify(_nonce_1 + _nonce_2.encode()) + _job.coinbase_suffix
 
             if os.getenv("COIN_ALGORITHM") == 'keccak':
-                coinbase_hash = binascii.hexlify(hash_util.reverse_bytes(hash_util.sha(serialized_coinbase)))
+                coinbase_hash = hash_util.sha(serialized_coinbase)
             else:
-                coinbase_hash = hash_util.bytes_to_reverse_hash(serialized_coinbase)
+                coinbase_hash = double_sha(serialized_coinbase)
 
-            tx_hashes = [coinbase_hash] + [h['hash'] for h in _block_template.transactions]
-            merkle_root_reverse_hex = hash_util.hex_to_reverse_hex(hash_util.merkle_root(tx_hashes))
+            # Only the merkle branch is walked, the other transactions are already hashed in the template
+            merkle_root = _job.merkle_tree.withFirst(coinbase_hash)
 
             # Header POW 종류별 구별 해야댐
-            header = _block_template.serialize_block_header(_time_reverse, _nonce_reverse, merkle_root_reverse_hex)  # 80 bytes
-            block_hex = _block_template.serialize_block(header, None, serialized_coinbase)
-            if os.getenv("COIN_ALGORITHM") == 'lyra2rev2':
-                import lyra2re2_hash
-                header_hash = lyra2re2_hash.getPoWHash(header)
-            elif os.getenv("COIN_ALGORITHM") == 'lyra2rev3':
-                import lyra2re3_hash
-                header_hash = lyra2re3_hash.getPoWHash(header)
-            elif os.getenv("COIN_ALGORITHM") == 'keccak' or os.getenv("COIN_ALGORITHM") == 'keccakc':
-                import sha3
-                header_hash = sha3.keccak_256(header).digest()
-            elif os.getenv("COIN_ALGORITHM") == 'x13-bcd':
-                import x13bcd_hash
-                header_hash = x13bcd_hash.getPoWHash(header)
-            elif os.getenv("COIN_ALGORITHM") == 'neoscrypt':
-                import neoscrypt
-                header_hash = neoscrypt.getPoWHash(header)
-            elif os.getenv("COIN_ALGORITHM") == 'yescrypt':
-                import yescrypt_hash
-                header_hash = yescrypt_hash.getHash(header, len(header))
-            elif os.getenv("COIN_ALGORITHM") == 'xevan':
-                import xevan_hash
-                header_hash = xevan_hash.getPoWHash(header)
-            elif os.getenv("COIN_ALGORITHM") == 'phi2':
-                import phi2_hash
-                header_hash = phi2_hash.getPoWHash(header)
-            elif os.getenv("COIN_ALGORITHM") == 'x16r':
-                import x16r_hash
-                header_hash = x16r_hash.getPoWHash(header)
-            elif os.getenv("COIN_ALGORITHM") == 'x16s':
-                import x16s_hash
-                header_hash = x16s_hash.getPoWHash(header)
-            elif os.getenv("COIN_ALGORITHM") == 'timetravel10':
-                import timetravel10_hash
-                header_hash = timetravel10_hash.getPoWHash(header)
-            else:
-                header_hash = double_sha(header)
+            header = _job.build_block_header(binascii.unhexlify(_time)[::-1], binascii.unhexlify(_nonce)[::-1], merkle_root)  # 80 bytes
+            soln = None
+            try:
+                header_hash = await self.pow_hash_executor.hash(header)
+            except PowHashQueueFullException as e:
+                logger.warning('rejected share, worker : %s, reason : %s' % (_worker_name, e))
+                return {'id': _id, 'result': None, 'error': [20, 'server is busy']}
 
         elif os.getenv("COIN_TYPE") == 'zcash':
             _time = _params[2]
@@ -258,73 +250,85 @@ class ACPoolHandler(object):
                 return {'id': _id, 'result': False, 'error': [20, 'incorrect size of solution']}
 
             n_time_int = int(_time, 16)
-            curtime_int = int(_block_template.curtime, 16)
+            curtime_int = int(_job.curtime, 16)
 
             if n_time_int < curtime_int:
                 return {'id': _id, 'result': False, 'error': [20, 'ntime out of range']}
 
-            header = _block_template.serialize_block_header(_time.encode(), _nonce)  # 140 bytes
+            header = _job.build_block_header(binascii.unhexlify(_time), binascii.unhexlify(_nonce))  # 140 bytes
 
-            header_soln = header + binascii.unhexlify(_soln)
-            header_hash = double_sha(header_soln)
-
-            block_hex = _block_template.serialize_block(header, binascii.unhexlify(_soln), None)
+            soln = binascii.unhexlify(_soln)
+            serialized_coinbase = None
+            header_hash = double_sha(header + soln)
         else:
             raise Exception('invalid coin type')
 
         header_bignum = uint256_from_str(header_hash)
 
-        share_diff = os.getenv("POW_LIMIT") / header_bignum
+        share_diff = self.pow_limit / header_bignum
         logger.debug('share diff : {0:.8f}'.format(share_diff))
 
-        diff = self.user_diffs[connection_ref.username]
+        diff = connection_ref.job_difficulties.get(_job_id, connection_ref.difficulty)
 
         if share_diff < diff:
             # logger.debug('low difficulty share of %s' % share_diff)
             logger.info('rejected share, worker : %s, reason : low difficulty share' % _worker_name)
-            self.database_ref.insert_accepted_share(username, worker, False, False, _block_template.block_height, share_diff, _block_template.pool_reward, diff)
+            self.database_ref.insert_accepted_share(username, worker, False, False, _job.block_height, share_diff, _job.pool_reward, diff)
             return {'id': _id, 'result': None, 'error': [23, 'low difficulty share of %s' % share_diff]}
 
-        if not self.job_manager.register_submit(_nonce_1, _nonce_2, _nonce, _time):
+        if self.job_manager.get_job(_job_id) is not _job:
+            # Evicted while the hash was computed, its submits are no longer tracked for duplicates
+            self.job_manager.stale_reject_count += 1
+            logger.info('rejected share, worker : %s, reason : stale job' % _worker_name)
+            return {'id': _id, 'result': False, 'error': [21, 'stale job']}
+
+        if not self.job_manager.register_submit(_job_id, _nonce_1, _nonce_2, _nonce, _time):
             logger.info('rejected share, worker : %s, reason : duplicate share' % _worker_name)
             return {'id': _id, 'result': None, 'error': [22, 'duplicate share']}
 
-        if share_diff >= _block_template.difficulty * 0.99:
-            block_hash = binascii.hexlify(hash_util.reverse_bytes(header_hash)).decode()
+        if share_diff >= _job.difficulty * 0.99:
+            block_hash = hash_util.bytes_to_reverse_hex(header_hash).decode()
             if os.getenv("COIN") in ['monacoin', 'feathercoin', 'phoenixcoin', 'vertcoin', 'shield']:
-                temp_hash = double_sha(header)
-                block_hash = binascii.hexlify(hash_util.reverse_bytes(temp_hash)).decode()
+                block_hash = hash_util.bytes_to_reverse_hash(header).decode()
 
             logger.info('Try new block share, worker : %s, share diff : %s' % (_worker_name, share_diff))
-            share_result = self.coin_rpc.submit_block(binascii.hexlify(block_hex).decode())
+            # Only block candidates are serialized, not every share
+            block_hex = _job.serialize_block(header, soln, serialized_coinbase)
+            try:
+                share_result = await self.coin_rpc.submit_block(binascii.hexlify(block_hex).decode())
+            except CoinRPCConnectionException as e:
+                share_result = str(e)
 
             if share_result is None:
                 logger.info('Found Block, result : %s, block hash : %s' % (share_result, block_hash))
-                result_hash = Interfaces.block_updater.update_block(repeat=False, block_hash=block_hash)
+                result_hash = await Interfaces.block_updater.update_block(repeat=False, block_hash=block_hash)
                 if result_hash is not None:
                     block_hash = result_hash
-                self.database_ref.insert_accepted_share(username, worker, True, True, _block_template.block_height, share_diff, _block_template.pool_reward, diff, block_hash)
+                self.database_ref.insert_accepted_share(username, worker, True, True, _job.block_height, share_diff, _job.pool_reward, diff, block_hash)
             else:
-                logger.error('undefined share_result %s, block hash %s, coinbase tx %s' % (share_result, block_hash, binascii.hexlify(_block_template.coinbase_tx)))
-                self.database_ref.insert_accepted_share(username, worker, False, False, _block_template.block_height, share_diff, _block_template.pool_reward, diff)
+                logger.error('undefined share_result %s, block hash %s, coinbase tx %s' % (share_result, block_hash, binascii.hexlify(_job.coinbase_tx)))
+                self.database_ref.insert_accepted_share(username, worker, False, False, _job.block_height, share_diff, _job.pool_reward, diff)
 
                 if os.getenv("COIN_TYPE") == 'bitcoin':
                     logger.error('Header : %s' % binascii.hexlify(header).decode())
                 else:
-                    logger.error('Header : %s' % binascii.hexlify(header_soln).decode())
+                    logger.error('Header : %s' % binascii.hexlify(header + soln).decode())
                 return {'id': _id, 'result': None, 'error': [20, 'invalid solution']}
         else:
             logger.info('accepted share, worker : %s, share diff : %s' % (_worker_name, '{0:.8f}'.format(share_diff)))
-            self.database_ref.insert_accepted_share(username, worker, True, False, _block_template.block_height, share_diff, _block_template.pool_reward, diff)
+            self.database_ref.insert_accepted_share(username, worker, True, False, _job.block_height, share_diff, _job.pool_reward, diff)
+
+        if connection_ref.vardiff is not None:
+            connection_ref.vardiff.add_share(connection_ref.difficulty)
 
         return {'id': _id, 'result': True, 'error': None}
 
-    def validate_address(self, _id, _params: list):
+    async def validate_address(self, _id, _params: list):
         address = _params[0]
-        valid_result = self.coin_rpc.validate_address(address)
+        valid_result = await self.coin_rpc.validate_address(address)
         return {'id': _id, 'result': valid_result, 'error': None}
 
-    def payout(self, _id, _params: list):
+    async def payout(self, _id, _params: list):
         address = _params[0]
         amount = _params[1]
         username = _params[2]
@@ -337,7 +341,7 @@ class ACPoolHandler(object):
                 save_data = [{'address': address, 'amount': amount, 'username': username}]
                 send_data = {address: amount}
 
-                tx_id = self.coin_rpc.send_many(send_data)
+                tx_id = await self.coin_rpc.send_many(send_data)
                 if tx_id is not None:
                     self.database_ref.save_transaction(tx_id, save_data, coin.tx_fee, 'manual')
                     self.database_ref.manual_payout_lock(wallet, amount, coin.tx_fee)
@@ -1,9 +1,12 @@
 import asyncio
 import simplejson
+from collections import OrderedDict
 from mining.interfaces import Interfaces
 from common.generators import SessionIdGenerator
 from common.logger import get_logger
-from common.cache import mc
+from common.rate_limiter import ban_list, TokenBucket
+from common.server import tune_transport
+import os
 
 logger = get_logger(__name__)
 
@@ -16,50 +19,58 @@ class StratumProtocol(asyncio.Protocol):
         self.session_id_generator = SessionIdGenerator()
         self.session_id = None
         self.job_manager = Interfaces.job_manager
-        self._buffer = b''
+        self._buffer = bytearray()
+        self.max_line_length = int(os.getenv("STRATUM_MAX_LINE_LENGTH", 16384))
         self.miner_program = None
         self.worker_name = None
         self.username = None
+        self.difficulty = None
+        self.vardiff = None
+        self.job_difficulties = OrderedDict()
         self.host = None
         self.ip = None
+        # The burst must hold one whole read of the transport, 256KB on asyncio and uvloop
+        self.bytes_limit = TokenBucket(float(os.getenv("STRATUM_MAX_BYTES_PER_SEC", 65536)), float(os.getenv("STRATUM_MAX_BYTES_BURST", 262144)))
+        self.messages_limit = TokenBucket(float(os.getenv("STRATUM_MAX_MESSAGES_PER_SEC", 100)))
 
     def get_session(self):
         return self.session_id
 
     def check_banned_ip(self):
-        fail_key = 'ban::%s' % self.ip
-        fail_count = mc.get(fail_key)
-        if fail_count is not None and fail_count > 50:
-            return True
-
-        return False
+        return ban_list.is_banned(self.ip)
 
     def increase_failure(self):
-        fail_key = 'ban::%s' % self.ip
-        fail_count = mc.get(fail_key)
-        if fail_count is None:
-            mc.set(fail_key, 1, time=60)
-        else:
-            mc.set(fail_key, fail_count + 1, time=60)
+        ban_list.increase_failure(self.ip)
+
+    def rate_limited(self, reason):
+        logger.info('Rate limit exceeded, %s, %s' % (self.ip, reason))
+        self.increase_failure()
+        self.transport.close()
 
     def connection_made(self, transport):
         connector_address = transport.get_extra_info('peername')
         logger.debug("Connected %s:%s" % (connector_address[0], connector_address[1]))
         self.transport = transport
+        tune_transport(transport)
         self.host = '%s:%s' % (connector_address[0], connector_address[1])
         self.ip = connector_address[0]
         self.session_id = self.session_id_generator.get_session_id()
-        self.job_manager.connections.add(self)
 
     def connection_lost(self, exc):
         logger.debug("Disconnected %s" % self.host)
         if '127.0.0.1' not in self.host:
             logger.info('Disconnected %s, %s ' % (self.host, exc))
         self.handler.disconnect(self)
-        self.job_manager.connections.remove(self)
+        self.job_manager.release_nonce(self.session_id)
+
+    def pause_writing(self):
+        # Miner does not read its responses, stop reading its requests until the write buffer drains
+        logger.info('pause_writing %s' % self.host)
+        self.transport.pause_reading()
 
     def resume_writing(self):
-        logger.info('resume_writing!!')
+        logger.info('resume_writing %s' % self.host)
+        self.transport.resume_reading()
 
     def data_received(self, data):
         if self.check_banned_ip():
@@ -68,40 +79,72 @@ class StratumProtocol(asyncio.Protocol):
             self.transport.close()
             return
 
-        if b'\n' in data:
-            _data = data.split(b'\n')
+        if not self.bytes_limit.consume(len(data)):
+            self.rate_limited('bytes per second')
+            return
 
-            temp = None
-            if _data[-1] != b'':
-                temp = _data[-1]
+        buffer = self._buffer
+        buffer += data
 
-            _data.pop(-1)
+        start = 0
+        while True:
+            end = buffer.find(b'\n', start)
+            if end == -1:
+                break
 
-            for _line in _data:
-                if self._buffer != b'':
-                    _line = self._buffer + _line
-                    self._buffer = b''
+            if end - start > self.max_line_length:
+                break
 
-                try:
-                    _json = simplejson.loads(_line)
-                    self.line_received(_json)
+            _line = bytes(buffer[start:end])
+            start = end + 1
 
-                except simplejson.JSONDecodeError:
-                    logger.debug('json decode fail %s ' % _line)
-                    self.increase_failure()
+            if not self.messages_limit.consume():
+                self.rate_limited('messages per second')
+                return
 
-            if temp is not None:
-                self._buffer += temp
-        else:
-            self._buffer += data
+            try:
+                _json = simplejson.loads(_line)
+                self.line_received(_json)
+
+            except simplejson.JSONDecodeError:
+                logger.debug('json decode fail %s ' % _line)
+                self.increase_failure()
+
+            if self.transport.is_closing():
+                return
+
+        del buffer[:start]
+
+        if len(buffer) > self.max_line_length:
+            logger.info('Line is too long, %s' % self.host)
+            buffer.clear()
+            self.increase_failure()
+            self.transport.close()
 
     def line_received(self, line):
         logger.debug('lineReceived : %s', line)
 
         result = self.handler.handle_event(self, line)
+        if asyncio.iscoroutine(result):
+            # Share validation runs off the loop thread, response is written when it is done.
+            asyncio.ensure_future(self.async_result_received(line, result))
+        else:
+            self.result_received(line, result)
+
+    async def async_result_received(self, line, coro):
+        try:
+            result = await coro
+        except Exception as e:
+            logger.exception('handle event failed %s, %s' % (line, e))
+            result = {'id': line.get('id', 0), 'result': None, 'error': [20, 'other/unknown']}
+
+        self.result_received(line, result)
+
+    def result_received(self, line, result):
         self.send_message(result)
 
-        if line.get('method') == 'mining.authorize':
+        if line.get('method') == 'mining.authorize' and result is not None and result.get('result') is True:
+            # Only an authorized connection has a difficulty and gets jobs
             self.handler.notify(self, True)
 
         if result is None or result['error'] is not None:
@@ -113,3 +156,8 @@ class StratumProtocol(asyncio.Protocol):
 
         if self.transport is not None:
             self.transport.write(('%s\n' % json_str).encode())
+
+    def send_raw(self, data: bytes):
+        # Already encoded message, ex: mining.notify shared by every connection
+        if self.transport is not None:
+            self.transport.write(data)
@@ -0,0 +1,91 @@
+# Longpoll block source against the fake coin daemon of the load test
+import os
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from benchmarks.load_test import FakeCoinDaemon  # noqa: E402
+from unittest import mock  # noqa: E402
+import unittest  # noqa: E402
+import asyncio  # noqa: E402
+
+from stratum.coin_rpc import CoinRPC  # noqa: E402
+from mining.block_source import LongpollBlockSource  # noqa: E402
+from tests import free_port  # noqa: E402
+
+
+class FakeBlockUpdater(object):
+    def __init__(self, coin_rpc):
+        self.coin_rpc = coin_rpc
+        self.templates = []
+
+    async def update_block(self, repeat=True, block_hash=None, data=None):
+        self.templates.append(data)
+
+
+class LongpollBlockSourceTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.port = free_port()
+        self.env = mock.patch.dict(os.environ, {
+            'COIN_DAEMON_USER': 'user',
+            'COIN_DAEMON_PASSWORD': 'password',
+            'COIN_DAEMON_HOST': 'http://127.0.0.1',
+            'COIN_DAEMON_PORT': str(self.port),
+            'BLOCK_LONGPOLL_TIMEOUT': '0.3',
+            'BLOCK_SOURCE_RETRY_INTERVAL': '0.5',
+        })
+        self.env.start()
+        self.daemon = None
+
+    async def asyncTearDown(self):
+        self.source.task.cancel()
+        await asyncio.gather(self.source.task, return_exceptions=True)
+        self.source.connection.close()
+        for connection in self.source.coin_rpc.idle_connections:
+            connection.close()
+        if self.daemon is not None:
+            self.daemon.new_block()  # Releases a held longpoll
+            self.daemon.stop()
+        self.env.stop()
+
+    def start_daemon(self):
+        self.daemon = FakeCoinDaemon(self.port, tx_count=2, block_interval=0)
+        self.daemon.start()
+
+    def start_source(self):
+        self.updater = FakeBlockUpdater(CoinRPC())
+        self.source = LongpollBlockSource(self.updater)
+        self.source.start()
+
+    async def test_new_block_is_pushed(self):
+        self.start_daemon()
+        self.start_source()
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.updater.templates, [])
+
+        self.daemon.new_block()
+        await asyncio.sleep(0.1)
+        self.assertEqual([data['height'] for data in self.updater.templates], [self.daemon.height])
+
+    async def test_timeout_asks_again_without_retry_interval(self):
+        self.start_daemon()
+        self.start_source()
+        await asyncio.sleep(1)
+        # 0.3 sec longpoll timeout, the 0.5 sec retry interval would allow 2 at most
+        self.assertGreaterEqual(self.daemon.longpoll_requests, 3)
+        self.assertEqual(self.updater.templates, [])
+
+    async def test_daemon_down_waits_retry_interval(self):
+        self.start_source()
+        with mock.patch.object(self.updater.coin_rpc, 'get_block_template', wraps=self.updater.coin_rpc.get_block_template) as get_block_template:
+            await asyncio.sleep(1.2)
+            # Connection refused is retried every 0.5 sec, not in a busy loop
+            self.assertLessEqual(get_block_template.call_count, 3)
+
+            self.start_daemon()
+            await asyncio.sleep(0.7)
+            self.daemon.new_block()
+            await asyncio.sleep(0.1)
+        self.assertEqual([data['height'] for data in self.updater.templates], [self.daemon.height])
+
+
+if __name__ == '__main__':
+    unittest.main()
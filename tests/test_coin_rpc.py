@@ -0,0 +1,60 @@
+import os
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from benchmarks.load_test import FakeCoinDaemon  # noqa: E402
+from unittest import mock  # noqa: E402
+import unittest  # noqa: E402
+import asyncio  # noqa: E402
+
+from stratum.coin_rpc import CoinRPC, CoinMethodNotFoundException  # noqa: E402
+from tests import free_port  # noqa: E402
+
+
+class CallBatchTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        port = free_port()
+        self.env = mock.patch.dict(os.environ, {
+            'COIN_DAEMON_USER': 'user',
+            'COIN_DAEMON_PASSWORD': 'password',
+            'COIN_DAEMON_HOST': 'http://127.0.0.1',
+            'COIN_DAEMON_PORT': str(port),
+        })
+        self.env.start()
+        self.daemon = FakeCoinDaemon(port, tx_count=0, block_interval=0)
+        self.daemon.start()
+        self.coin_rpc = CoinRPC()
+
+    async def asyncTearDown(self):
+        for connection in self.coin_rpc.idle_connections:
+            connection.close()
+        self.daemon.stop()
+        self.env.stop()
+
+    async def check_results(self):
+        results = await self.coin_rpc.call_batch([('getmininginfo', []), ('getblock', ['00'])])
+        self.assertEqual(results[0]['blocks'], self.daemon.height)
+        self.assertIsInstance(results[1], CoinMethodNotFoundException)
+
+    async def test_batch(self):
+        await self.check_results()
+
+    async def test_rejected_batch_is_called_one_by_one(self):
+        self.daemon.batch_support = False
+        await self.check_results()
+
+    async def test_cancelled_request_does_not_return_connection(self):
+        longpoll = asyncio.ensure_future(self.coin_rpc.call('getblocktemplate', [{'longpollid': str(self.daemon.height)}]))
+        while self.daemon.longpoll_requests == 0:
+            await asyncio.sleep(0.01)
+        longpoll.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await longpoll
+        self.daemon.new_block()
+
+        # The template sent after the cancel is not read as the response of the next call
+        self.assertEqual(self.coin_rpc.idle_connections, [])
+        await self.check_results()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from datetime import datetime  # noqa: E402
+from unittest import mock  # noqa: E402
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+import shutil  # noqa: E402
+import threading  # noqa: E402
+
+from mining.models import Base, Shares, ShareAggregates, Users, Wallets, Workers  # noqa: E402
+from mining.database import Database  # noqa: E402
+
+
+def make_share(username, height, difficulty, pool_result=True):
+    return {'coin_name': 'testcoin', 'username': username, 'worker': 'rig', 'pool_result': pool_result, 'share_result': False,
+            'block_height': height, 'share_difficulty': difficulty, 'pool_difficulty': difficulty, 'timestamp': datetime.utcnow()}
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.env = mock.patch.dict(os.environ, {'DATABASE_URL': 'sqlite:///%s/pool.db' % self.work_dir, 'COIN': 'testcoin',
+                                                'PPLNS_LENGTH': '10', 'STRATUM_WORKERS': '0'})
+        self.env.start()
+        self.database = Database()
+        Base.metadata.create_all(self.database.engine, tables=[Shares.__table__, ShareAggregates.__table__])
+
+    def tearDown(self):
+        self.database.session.close()
+        self.database.engine.dispose()
+        self.env.stop()
+        shutil.rmtree(self.work_dir)
+
+
+class ShareAggregateBackfillTest(DatabaseTestCase):
+    def test_backfill_matches_shares_of_the_window(self):
+        shares = [make_share('alice', 100, 2.0), make_share('alice', 100, 3.0), make_share('bob', 95, 4.0),
+                  make_share('bob', 95, 8.0, pool_result=False), make_share('carol', 90, 16.0)]
+        with self.database.engine.begin() as conn:
+            conn.execute(Shares.__table__.insert(), shares)
+
+        self.database.backfill_share_aggregates()
+        self.assertEqual(sorted(self.database.get_pplns_share_values(100)), [(4.0, 'bob'), (5.0, 'alice')])
+
+        # Only once, rows written after the deploy are not counted twice
+        self.database.backfill_share_aggregates()
+        self.assertEqual(self.database.session.query(ShareAggregates).count(), 2)
+
+
+class RetentionTest(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        Base.metadata.create_all(self.database.engine, tables=[Workers.__table__])
+
+    def test_old_rows_are_deleted_off_the_loop(self):
+        shares = [make_share('alice', 80, 2.0), make_share('alice', 95, 3.0), make_share('bob', 80, 4.0, pool_result=False)]
+        with self.database.engine.begin() as conn:
+            conn.execute(Shares.__table__.insert(), shares)
+        self.database.backfill_share_aggregates()
+
+        # The deletes wait behind other maintenance instead of running on the caller
+        maintenance = threading.Event()
+        self.database.partition_executor.submit(maintenance.wait)
+        with mock.patch.dict(os.environ, {'SHARE_RETENTION_HEIGHTS': '10', 'SHARE_DELETE_BATCH': '1'}):
+            self.database.delete_old_infos(100)
+            self.assertEqual(self.database.session.query(Shares).count(), 3)
+            maintenance.set()
+            self.database.partition_executor.submit(lambda: None).result()
+
+        self.assertEqual([share.block_height for share in self.database.session.query(Shares)], [95])
+        self.assertEqual([aggregate.block_height for aggregate in self.database.session.query(ShareAggregates)], [95])
+
+
+class AddressUserTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.env = mock.patch.dict(os.environ, {'DATABASE_URL': 'sqlite:///%s/pool.db' % self.work_dir, 'COIN': 'testcoin',
+                                                'PPLNS_LENGTH': '10', 'STRATUM_WORKERS': '2'})
+        self.env.start()
+        # Two Stratum worker processes, each one has its own Database
+        self.databases = [Database(), Database()]
+        Base.metadata.create_all(self.databases[0].engine, tables=[Users.__table__, Wallets.__table__])
+
+    def tearDown(self):
+        for database in self.databases:
+            database.session.close()
+            database.engine.dispose()
+        self.env.stop()
+        shutil.rmtree(self.work_dir)
+
+    def test_two_workers_create_the_same_address(self):
+        first, second = self.databases
+        address = '1BoatSLRHtKNngkdXEeobR76b53LETtpyT'
+        add = first.session.add
+
+        def add_after_other_worker(instance):
+            # The other worker commits the user after this one found none
+            if isinstance(instance, Users):
+                second.get_or_create_address_user(address)
+            add(instance)
+
+        with mock.patch.object(first.session, 'add', side_effect=add_after_other_worker):
+            first.get_or_create_address_user(address)
+
+        # The session is usable again and both workers see one user and one wallet
+        self.assertIsNotNone(first.get_user(address))
+        self.assertEqual(first.session.query(Users).filter(Users.username == address).count(), 1)
+        self.assertEqual(second.session.query(Wallets).filter(Wallets.username == address).count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from types import SimpleNamespace  # noqa: E402
+import unittest  # noqa: E402
+
+from mining.job_manager import JobManager  # noqa: E402
+
+
+def make_job(job_id, prev_hash='00' * 32):
+    # add_job only reads job_id and prev_hash
+    return SimpleNamespace(job_id=job_id, prev_hash=prev_hash)
+
+
+class JobRetentionTest(unittest.TestCase):
+    def test_job_is_kept_without_connections(self):
+        # Eviction does not depend on the connection count, the first job exists before any miner connects
+        job_manager = JobManager()
+        job = job_manager.add_job(make_job('1'))
+        self.assertIs(job_manager.get_job('1'), job)
+
+    def test_retention_and_new_block(self):
+        job_manager = JobManager()
+        job_manager.retention = 2
+        for job_id in ['1', '2', '3', '4']:
+            job_manager.add_job(make_job(job_id))
+        self.assertEqual(list(job_manager.block_templates), ['2', '3', '4'])
+        self.assertTrue(job_manager.is_stale_job('1'))
+
+        job_manager.add_job(make_job('5', prev_hash='11' * 32))
+        self.assertEqual(list(job_manager.block_templates), ['5'])
+        self.assertTrue(job_manager.is_stale_job('4'))
+
+
+class RegisterSubmitTest(unittest.TestCase):
+    def test_duplicate_and_evicted_job(self):
+        job_manager = JobManager()
+        job_manager.add_job(make_job('1'))
+        self.assertTrue(job_manager.register_submit('1', b'00000000', '00000000', '00000000', '5a000000'))
+        self.assertFalse(job_manager.register_submit('1', b'00000000', '00000000', '00000000', '5a000000'))
+
+        job_manager.add_job(make_job('2', prev_hash='11' * 32))
+        self.assertFalse(job_manager.register_submit('1', b'00000000', '00000000', '00000001', '5a000000'))
+
+
+class ExtranonceReuseTest(unittest.TestCase):
+    def setUp(self):
+        self.job_manager = JobManager()
+        self.job_manager.retention = 2
+        self.job_manager.add_job(make_job('1'))
+
+    def test_released_nonce_waits_for_retained_jobs(self):
+        released = self.job_manager.get_new_nonce('old')
+        self.job_manager.release_nonce('old')
+
+        # Job 1 is still retained, the old session could have submitted on it
+        self.assertNotEqual(self.job_manager.get_new_nonce('new'), released)
+
+        for job_id in ['2', '3', '4']:
+            self.job_manager.add_job(make_job(job_id))
+        self.assertEqual(self.job_manager.get_new_nonce('newer'), released)
+
+    def test_new_block_frees_released_nonce(self):
+        released = self.job_manager.get_new_nonce('old')
+        self.job_manager.release_nonce('old')
+
+        self.job_manager.add_job(make_job('2', prev_hash='11' * 32))
+        self.assertEqual(self.job_manager.get_new_nonce('new'), released)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import os
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from concurrent.futures.process import BrokenProcessPool  # noqa: E402
+from hashlib import sha256  # noqa: E402
+import unittest  # noqa: E402
+
+from common.pow_hash import PowHashExecutor  # noqa: E402
+
+
+class PowHashExecutorTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # Not an inline algorithm, hashed by a worker process
+        self.pow_hash_executor = PowHashExecutor('sha256d', workers=1, queue_size=10)
+
+    def tearDown(self):
+        self.pow_hash_executor.shutdown()
+
+    async def test_hash_after_worker_crash(self):
+        header = b'\x00' * 80
+        # A worker process dies, ex: segfault of a hash extension
+        with self.assertRaises(BrokenProcessPool):
+            self.pow_hash_executor.executor.submit(os._exit, 1).result()
+
+        self.assertEqual(await self.pow_hash_executor.hash(header), sha256(sha256(header).digest()).digest())
+        self.assertEqual(await self.pow_hash_executor.hash(header), sha256(sha256(header).digest()).digest())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import os
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+# Interfaces creates the Database on import, it does not connect until it is used
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('PPLNS_LENGTH', '100')
+
+from unittest import mock  # noqa: E402
+import unittest  # noqa: E402
+
+from mining.interfaces import Interfaces  # noqa: E402
+from stratum.protocol import StratumProtocol  # noqa: E402
+
+
+class AuthorizeResultTest(unittest.TestCase):
+    def setUp(self):
+        Interfaces.set_stratum_handler(mock.Mock())
+        self.protocol = StratumProtocol()
+        self.protocol.transport = mock.Mock()
+        self.protocol.increase_failure = mock.Mock()
+
+    def test_authorized_connection_gets_jobs(self):
+        self.protocol.result_received({'id': 2, 'method': 'mining.authorize'}, {'id': 2, 'result': True, 'error': None})
+        self.protocol.handler.notify.assert_called_once_with(self.protocol, True)
+
+    def test_failed_authorize_gets_no_jobs(self):
+        self.protocol.result_received({'id': 2, 'method': 'mining.authorize'}, {'id': 2, 'result': False, 'error': None})
+        self.protocol.result_received({'id': 3, 'method': 'mining.authorize'}, {'id': 3, 'result': None, 'error': [20, 'other/unknown']})
+        self.protocol.handler.notify.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from unittest import mock  # noqa: E402
+import unittest  # noqa: E402
+
+from common.rate_limiter import TokenBucket, IPBanList  # noqa: E402
+
+
+class FakeMemcached(object):
+    def __init__(self):
+        self.values = {}
+
+    def add(self, key, value, time=0):
+        if key in self.values:
+            return False
+        self.values[key] = value
+        return True
+
+    def incr(self, key, delta=1):
+        if key not in self.values:
+            return None
+        self.values[key] += delta
+        return self.values[key]
+
+    def touch(self, key, time=0):
+        return key in self.values
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_larger_than_rate(self):
+        bucket = TokenBucket(65536, 262144)
+        self.assertTrue(bucket.consume(262144))
+        self.assertFalse(bucket.consume(65536))
+
+
+class IPBanListTest(unittest.TestCase):
+    def test_memcached_counts_of_every_process_add_up(self):
+        memcached = FakeMemcached()
+        with mock.patch('common.rate_limiter.mc', memcached):
+            self.assertEqual(IPBanList().push_memcached({'10.0.0.1': 3}), {'10.0.0.1': 3})
+            self.assertEqual(IPBanList().push_memcached({'10.0.0.1': 2, '10.0.0.2': 1}), {'10.0.0.1': 5, '10.0.0.2': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import os
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from datetime import datetime  # noqa: E402
+from unittest import mock  # noqa: E402
+import unittest  # noqa: E402
+
+from sqlalchemy.engine import create_engine  # noqa: E402
+
+from mining.models import Base, ShareRollups  # noqa: E402
+from mining.rollups import rollup_shares, upsert_rollups  # noqa: E402
+
+
+def make_share(worker, pool_result=True):
+    return {'username': 'miner', 'worker': worker, 'pool_result': pool_result, 'pool_difficulty': 2.0,
+            'timestamp': datetime(2026, 1, 1, 12, 30, 15)}
+
+
+class RollupTest(unittest.TestCase):
+    def setUp(self):
+        self.env = mock.patch.dict(os.environ, {'COIN': 'testcoin'})
+        self.env.start()
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine, tables=[ShareRollups.__table__])
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.env.stop()
+
+    def test_shares_without_worker_share_one_row(self):
+        # Two batches of the same minute, each one is upserted on its own
+        for batch in [[make_share(None), make_share(None, pool_result=False)], [make_share(None)]]:
+            with self.engine.begin() as conn:
+                upsert_rollups(conn, rollup_shares(batch))
+
+        rows = self.engine.execute(ShareRollups.__table__.select()).fetchall()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['worker'], 'default')
+        self.assertEqual((rows[0]['sum_pool_difficulty'], rows[0]['accepted_share_count'], rows[0]['rejected_share_count']), (4.0, 2, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
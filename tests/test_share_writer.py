@@ -0,0 +1,86 @@
+import os
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from unittest import mock  # noqa: E402
+import unittest  # noqa: E402
+import asyncio  # noqa: E402
+import time  # noqa: E402
+
+from sqlalchemy.exc import IntegrityError  # noqa: E402
+
+from mining.share_writer import ShareWriter  # noqa: E402
+
+
+class FlakyWrites(object):
+    # Stands in for ShareWriter.write, the first write fails after a short wait
+    def __init__(self):
+        self.calls = 0
+        self.written = []
+
+    def __call__(self, batch):
+        self.calls += 1
+        if self.calls == 1:
+            time.sleep(0.05)
+            raise Exception('connection lost')
+        self.written.extend(row['id'] for row in batch)
+
+
+class ShareWriterTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.env = mock.patch.dict(os.environ, {'PPLNS_LENGTH': '100', 'SHARE_FLUSH_SIZE': '2', 'SHARE_BUFFER_SIZE': '3'})
+        self.env.start()
+        self.writer = ShareWriter(None)
+        self.writes = FlakyWrites()
+        self.writer.write = self.writes
+
+    def tearDown(self):
+        if self.writer.timer is not None:
+            self.writer.timer.cancel()
+        self.writer.executor.shutdown()
+        self.env.stop()
+
+    async def test_flush_sync_writes_failed_in_flight_batch(self):
+        for i in range(3):
+            self.writer.append({'id': i})
+        self.assertIsNotNone(self.writer.flushing)
+
+        self.assertTrue(self.writer.flush_sync())
+        self.assertEqual(sorted(self.writes.written), [0, 1, 2])
+
+        # The done callback of the failed write must not add its batch again
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(self.writer.buffer), 0)
+        self.assertIsNone(self.writer.flushing)
+
+    async def test_full_buffer_drops_new_shares(self):
+        # The first batch is in flight while the buffer fills up
+        for i in range(6):
+            self.writer.append({'id': i})
+
+        # The buffer stays bounded and nothing is written on the caller
+        self.assertEqual([row['id'] for row in self.writer.buffer], [2, 3, 4])
+        self.assertEqual(self.writer.dropped_count, 1)
+        self.assertFalse(self.writer.append({'id': 6}))
+        self.assertEqual([row['id'] for row in self.writer.flushing_batch], [0, 1])
+
+    async def test_rejected_row_is_dropped(self):
+        def write(batch):
+            if any(row['username'] == 'bogus' for row in batch):
+                raise IntegrityError('INSERT INTO shares', batch, Exception('violates foreign key constraint'))
+            self.writes.written.extend(row['id'] for row in batch)
+
+        self.writer.write = write
+        self.writer.append({'id': 0, 'username': 'miner'})
+        self.writer.append({'id': 1, 'username': 'bogus'})
+        await self.writer.flushing
+        self.writer.append({'id': 2, 'username': 'miner'})
+
+        # The other rows of the batch are written, the rejected one is not buffered again
+        self.assertTrue(self.writer.flush_sync())
+        self.assertEqual(self.writes.written, [0, 2])
+        self.assertEqual(self.writer.rejected_count, 1)
+        self.assertEqual(len(self.writer.buffer), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()